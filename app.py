@@ -11,18 +11,38 @@
     location and why it is set up that way!
 '''
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-from werkzeug.security import check_password_hash
-from database import SessionLocal, engine
-from models import Base, Employee, Client, Investment, Company, InvestmentRequest
+import time
+from datetime import date, timedelta
+from sqlalchemy import update
+from flask import (Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify, abort,
+                   stream_with_context)
+from database import get_db, init_app, init_db, pool_stats
+from models import Employee, Client, InvestmentRequest, ClientRollup, AdvisorRollup, ManagerRollup
+import sql_stats
+from auth import authenticate, verify_password, LoginBusyError
+from company_cache import company_catalog
+from loaders import (load_manager_hierarchy, load_client_investments, load_advisor_clients_page,
+                     load_advisor_clients, load_advisor_requests, load_employee, load_client,
+                     CLIENTS_PER_EMPLOYEE)
+from rollups import get_rollup, get_rollups
+from page_cache import conditional_page, client_page_version, advisor_page_version
+from request_review import review_requests, MAX_BULK_REVIEW
+from job_queue import approve_and_enqueue, APPROVABLE
+from book_export import export_chunks, FORMATS as EXPORT_FORMATS, EXPORT_REAUTH_SECONDS
+from audit_log import audit_log, client_access_history
+from valuation_history import client_history, GRANULARITIES
+
+# the routes below are collected here and added to every app create_app() makes,
+# so importing this file doesn't build an app or touch the database
+_routes = []
+
+
+def route(rule, **options):
+    def decorator(view):
+        _routes.append((rule, view, options))
+        return view
+    return decorator
 
-app = Flask(__name__, static_folder='static', template_folder='templates')
-app.secret_key = "fake_investing_secret"
-
-'''
-    this will create the tables for all of the data storage
-'''
-Base.metadata.create_all(bind=engine)
 
 '''
     This method starts the login (root) page for the user
@@ -32,10 +52,10 @@ Base.metadata.create_all(bind=engine)
 '''
 
 
-@app.route("/", methods=["GET", "POST"])
-@app.route("/login", methods=["GET", "POST"])
+@route("/", methods=["GET", "POST"])
+@route("/login", methods=["GET", "POST"])
 def login():
-    db = SessionLocal()
+    db = get_db()
     # send request for post to get email and password
     if request.method == "POST":
         email = request.form.get("email")
@@ -46,25 +66,28 @@ def login():
             flash("Please enter both email and password")
             return render_template("login.html")
 
-        # getting clients from the database
-        client = db.query(Client).filter(Client.email == email).first()
-        if client and check_password_hash(client.password_hash, password):
+        # look up the client or employee (including managers) with this email
+        try:
+            identity = authenticate(db, email, password)
+        except LoginBusyError:
+            flash("Too many people are logging in right now, please try again")
+            return render_template("login.html"), 503
+
+        if identity and identity.kind == "client":
             session.clear()
             session["user_type"] = "client"
-            session["user_id"] = client.client_id
+            session["user_id"] = identity.user_id
             return redirect(url_for("client_dashboard"))
 
-        # getting employees from the database (including managers)
-        employee = db.query(Employee).filter(Employee.work_email == email).first()
-        if employee and check_password_hash(employee.password_hash, password):
+        if identity:
             session.clear()
-            if employee.job_title == "Manager":
+            if identity.job_title == "Manager":
                 session["user_type"] = "manager"
-                session["user_id"] = employee.employee_id
+                session["user_id"] = identity.user_id
                 return redirect(url_for("manager_dashboard"))
             else:
                 session["user_type"] = "employee"
-                session["user_id"] = employee.employee_id
+                session["user_id"] = identity.user_id
                 return redirect(url_for("employee_dashboard"))
 
         # if we didn't have the right credentials, prompt the user.
@@ -74,142 +97,286 @@ def login():
 
 
 # -- manager dashboard --
-@app.route("/manager_dashboard")
+@route("/manager_dashboard")
 def manager_dashboard():
     # check we are a manager (not an employee or client)
     if session.get("user_type") != "manager":
         return redirect(url_for("login"))
 
     # make sure we have this user as a manger
-    db = SessionLocal()
-    manager = db.query(Employee).get(session["user_id"])
+    db = get_db()
+    manager = load_employee(db, session["user_id"])
     if not manager:
         return "Manager not found", 404
 
-    # get the employees under this manager
-    employees = db.query(Employee).filter(Employee.manager_id == manager.employee_id).all()
+    # get one page of the employees under this manager and their first clients
     verified_client_id = session.get("verified_client_id")
+    after = request.args.get("after", 0, type=int)
+    employees, hierarchy, next_after = load_manager_hierarchy(
+        db, manager.employee_id, verified_client_id, after_employee_id=after
+    )
 
-    # create the table information for the employees and their clients
-    hierarchy = []
-    for employee in employees:
-        # create the filter
-        emp_clients = db.query(Client).filter(Client.advisor_id == employee.employee_id).all()
-        clients_list = []
-
-        for client in emp_clients:
-            # load investments only if this client is verified and we have access
-            if verified_client_id == client.client_id:
-                investments = db.query(Investment).filter(Investment.client_id == client.client_id).all()
-
-                # get investment company ID too
-                for inv in investments:
-                    inv.company = db.query(Company).get(inv.company_id)
-                c_investments = investments
-            else:
-                c_investments = []
-
-            clients_list.append({"client": client, "investments": c_investments})
-        hierarchy.append({"employee": employee, "clients": clients_list})
+    # team totals, and the totals for each employee on this page
+    team_totals = get_rollup(db, ManagerRollup, manager.employee_id)
+    employee_totals = get_rollups(db, AdvisorRollup, [e.employee_id for e in employees])
 
     # show to user
     return render_template(
         "manager_dashboard.html",
         manager=manager,
         employees=employees,
-        hierarchy=hierarchy
+        hierarchy=hierarchy,
+        after=after,
+        next_after=next_after,
+        team_totals=team_totals,
+        employee_totals=employee_totals
+    )
+
+
+# -- checking a manager / advisor can see an advisor's book --
+def can_view_advisor(db, advisor_id):
+    if session.get("user_type") == "employee":
+        return session.get("user_id") == advisor_id
+    if session.get("user_type") == "manager":
+        advisor = db.query(Employee).get(advisor_id)
+        return advisor is not None and advisor.manager_id == session.get("user_id")
+    return False
+
+
+# -- json: the next page of an advisor's clients --
+@route("/api/advisors/<int:advisor_id>/clients")
+def api_advisor_clients(advisor_id):
+    db = get_db()
+    if not can_view_advisor(db, advisor_id):
+        return jsonify({"error": "not allowed"}), 403
+
+    after = request.args.get("after", 0, type=int)
+    limit = max(1, min(request.args.get("limit", CLIENTS_PER_EMPLOYEE, type=int), 200))
+    clients, next_after = load_advisor_clients_page(db, advisor_id, after, limit)
+    return jsonify({
+        "clients": [
+            {"client_id": c.client_id, "first_name": c.first_name, "last_name": c.last_name}
+            for c in clients
+        ],
+        "next_after": next_after,
+    })
+
+
+# -- json: a verified client's investments --
+@route("/api/clients/<int:client_id>/investments")
+def api_client_investments(client_id):
+    db = get_db()
+    client = load_client(db, client_id)
+    # you need to have passed the security check for this exact client
+    if (client is None or session.get("verified_client_id") != client_id
+            or not can_view_advisor(db, client.advisor_id)):
+        return jsonify({"error": "not allowed"}), 403
+
+    return jsonify({
+        "client_id": client_id,
+        "investments": [
+            {
+                "investment_id": inv.investment_id,
+                "company_name": inv.company_name,
+                "shares_purchased": inv.shares_purchased,
+                "purchase_price_per_share": inv.purchase_price_per_share,
+                "current_price": inv.current_price,
+                "market_value": inv.market_value,
+                "gain_loss_percent": inv.gain_loss_percent,
+            }
+            for inv in load_client_investments(db, client_id)
+        ],
+    })
+
+
+# -- json: a client's value over time (for the chart on the client dashboard) --
+@route("/api/clients/<int:client_id>/valuation_history")
+def api_client_valuation_history(client_id):
+    db = get_db()
+    client = load_client(db, client_id)
+    # the client themselves, or an advisor / manager who passed the security check for them
+    if client is None or not (
+        (session.get("user_type") == "client" and session.get("user_id") == client_id)
+        or (session.get("verified_client_id") == client_id and can_view_advisor(db, client.advisor_id))
+    ):
+        return jsonify({"error": "not allowed"}), 403
+
+    try:
+        end = date.fromisoformat(request.args["end"]) if request.args.get("end") else date.today()
+        start = date.fromisoformat(request.args["start"]) if request.args.get("start") else end - timedelta(days=365)
+    except ValueError:
+        return jsonify({"error": "start and end must be dates (YYYY-MM-DD)"}), 400
+    granularity = request.args.get("granularity")
+    if granularity is not None and granularity not in GRANULARITIES:
+        return jsonify({"error": f"granularity must be one of {', '.join(GRANULARITIES)}"}), 400
+    if start > end:
+        return jsonify({"error": "start is after end"}), 400
+
+    granularity, points = client_history(db, client_id, start, end, granularity)
+    return jsonify({
+        "client_id": client_id,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "granularity": granularity,
+        "points": [
+            {
+                "period_start": point.period_start.isoformat(),
+                "market_value": point.market_value,
+                "cost_basis": point.cost_basis,
+                "high_value": point.high_value,
+                "low_value": point.low_value,
+            }
+            for point in points
+        ],
+    })
+
+
+# -- export an advisor's book (or a manager's whole team) as csv / json lines --
+@route("/export/book")
+def export_book():
+    db = get_db()
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+
+    # an employee gets their own book, a manager their team (or one advisor on it)
+    advisor_id = request.args.get("advisor_id", type=int)
+    manager_id = None
+    if session.get("user_type") == "employee":
+        advisor_id = session["user_id"]
+    elif session.get("user_type") == "manager":
+        if advisor_id is None:
+            manager_id = session["user_id"]
+        elif not can_view_advisor(db, advisor_id):
+            return jsonify({"error": "not allowed"}), 403
+    else:
+        return redirect(url_for("login"))
+
+    # a whole book is a lot of client data, so it needs the password again first
+    if time.time() - session.get("export_verified_at", 0) > EXPORT_REAUTH_SECONDS:
+        session["export_next"] = request.full_path
+        return redirect(url_for("security_check_export"))
+
+    # investment values only for the client that passed the security check,
+    # and every export goes in the audit log with how many rows it had
+    verified_client_id = session.get("verified_client_id")
+    actor_type, actor_id, remote_addr = session["user_type"], session["user_id"], request.remote_addr
+
+    def record_export(row_count, completed):
+        audit_log.record(actor_type, actor_id, "export_book", verified_client_id,
+                         "completed" if completed else "aborted", remote_addr=remote_addr, row_count=row_count)
+
+    # the rows are written while they come out of the database, so the
+    # request (and its session) has to stay around until the last one
+    chunks = export_chunks(db, export_format, advisor_id=advisor_id, manager_id=manager_id,
+                           investment_client_ids=[verified_client_id] if verified_client_id else [],
+                           on_finish=record_export)
+    filename = f"book_{advisor_id or manager_id}.{export_format}"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
 
 
 # -- employee dashboard --
-@app.route("/employee_dashboard")
+@route("/employee_dashboard")
 def employee_dashboard():
     # check we have an employee
     if session.get("user_type") != "employee":
         return redirect(url_for("login"))
 
+    # nothing changed since the browser's copy -> 304 (see page_cache.py)
+    db = get_db()
+    verified_client_id = session.get("verified_client_id")
+    version = advisor_page_version(db, session["user_id"], verified_client_id)
+    return conditional_page(
+        ("employee_dashboard", session["user_id"], verified_client_id), version,
+        lambda: render_employee_dashboard(db, session["user_id"], verified_client_id)
+    )
+
+
+def render_employee_dashboard(db, employee_id, verified_client_id):
     # make sure we have this user as an employee
-    db = SessionLocal()
-    employee = db.query(Employee).get(session["user_id"])
+    employee = load_employee(db, employee_id)
     if not employee:
         return "Employee not found", 404
 
-    requests = db.query(InvestmentRequest).filter(
-        InvestmentRequest.advisor_id == employee.employee_id
-    ).all()
-
-    # build clients for the table for this employee
-    verified_client_id = session.get("verified_client_id")
+    # build clients for the table for this employee (read only rows, see loaders.py)
     clients_list = []
-    emp_clients = db.query(Client).filter(Client.advisor_id == employee.employee_id).all()
+    emp_clients = load_advisor_clients(db, employee.employee_id)
 
     # for all the clients this employee has
     for clients in emp_clients:
         if verified_client_id == clients.client_id:
-            investments = db.query(Investment).filter(Investment.client_id == clients.client_id).all()
-            # get investment info
-            for inv in investments:
-                inv.company = db.query(Company).get(inv.company_id)
-            c_investments = investments
+            c_investments = load_client_investments(db, clients.client_id)
         else:
             c_investments = []
 
         clients_list.append({"client": clients, "investments": c_investments})
 
-    client_requests = db.query(InvestmentRequest).filter(
-        InvestmentRequest.advisor_id == employee.employee_id
-    ).order_by(InvestmentRequest.created_at.desc()).all()
-    for req in client_requests:
-        req.client = db.query(Client).get(req.client_id)
-        req.company = db.query(Company).get(req.company_id)
+    # get the request queue with the client and company names
+    client_requests = load_advisor_requests(db, employee.employee_id)
 
     return render_template(
         "employee_dashboard.html",
         employee=employee,
         clients=clients_list,
-        client_requests=client_requests
+        client_requests=client_requests,
+        totals=get_rollup(db, AdvisorRollup, employee.employee_id)
     )
 
 
 # -- employee approval --
-@app.route("/advisor_create_investment/<int:request_id>", methods=["POST"])
+@route("/advisor_create_investment/<int:request_id>", methods=["POST"])
 def advisor_create_investment(request_id):
     if session.get("user_type") != "employee":
         return redirect(url_for("login"))
 
-    db = SessionLocal()
-    req = db.query(InvestmentRequest).get(request_id)
-    req.status = "AdvisorCreated"  # Flag that advisor has prepared investment
-
+    # only the advisor's own request, and only while it can still be approved
+    db = get_db()
+    result = db.execute(
+        update(InvestmentRequest)
+        .where(InvestmentRequest.request_id == request_id,
+               InvestmentRequest.advisor_id == session["user_id"],
+               InvestmentRequest.status.in_(APPROVABLE))
+        .values(status="AdvisorCreated")  # Flag that advisor has prepared investment
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        db.rollback()
+        flash("Request not found or already handled")
+        return redirect(url_for("employee_dashboard"))
     db.commit()
     flash("Investment prepared. Client must approve.")
     return redirect(url_for("employee_dashboard"))
 
 
 # -- client dashboard --
-@app.route("/client_dashboard")
+@route("/client_dashboard")
 def client_dashboard():
     # check if this is a user
     if session.get("user_type") != "client":
         return redirect(url_for("login"))
 
+    # nothing changed since the browser's copy -> 304 (see page_cache.py)
+    db = get_db()
+    version = client_page_version(db, session["user_id"])
+    return conditional_page(
+        ("client_dashboard", session["user_id"]), version,
+        lambda: render_client_dashboard(db, session["user_id"])
+    )
+
+
+def render_client_dashboard(db, client_id):
     # check if this is a valid user
-    db = SessionLocal()
-    client = db.query(Client).get(session["user_id"])
+    client = load_client(db, client_id)
     if not client:
         return "Client not found", 404
 
-    # get their financial advisor
-    advisor = db.query(Employee).get(client.advisor_id)
-
-    # attach companies to each investment
-    investments = db.query(Investment).filter(Investment.client_id == client.client_id).all()
-    for inv in investments:
-        inv.company = db.query(Company).get(inv.company_id)
-
-    requests = db.query(InvestmentRequest).filter(InvestmentRequest.client_id == client.client_id).all()
-    for req in requests:
-        req.company = db.query(Company).get(req.company_id)
+    # get their financial advisor and their investments (read only rows, see loaders.py)
+    advisor = load_employee(db, client.advisor_id)
+    investments = load_client_investments(db, client.client_id)
 
     # show to client user
     return render_template(
@@ -217,17 +384,17 @@ def client_dashboard():
         client=client,
         advisor=advisor,
         investments=investments,
-        requests=requests
+        totals=get_rollup(db, ClientRollup, client.client_id)
     )
 
 
 # -- client request investment --
-@app.route("/create_investment_request", methods=["POST"])
+@route("/create_investment_request", methods=["POST"])
 def create_investment_request():
     if session.get("user_type") != "client":
         return redirect(url_for("login"))
 
-    db = SessionLocal()
+    db = get_db()
     client_id = session["user_id"]
     company_name = request.form.get("company_name")
     shares = int(request.form.get("shares"))
@@ -244,51 +411,99 @@ def create_investment_request():
     return redirect(url_for("client_dashboard"))
 
 
-@app.route("/approve_request/<int:request_id>", methods=["POST"])
+@route("/approve_request/<int:request_id>", methods=["POST"])
 def approve_request(request_id):
-    db = SessionLocal()
-    req = db.query(InvestmentRequest).get(request_id)
-    if not req:
-        flash("Request not found")
-        return redirect(url_for("employee_dashboard"))
+    if session.get("user_type") != "employee":
+        return redirect(url_for("login"))
 
-    req.status = "Approved"
-    # Optionally create the investment automatically
-    new_investment = Investment(
-        client_id=req.client_id,
-        advisor_id=req.advisor_id,
-        company_id=req.company_id,
-        shares_purchased=req.shares,
-        purchase_price_per_share=req.purchase_price_per_share,
-        current_price=req.purchase_price_per_share
-    )
-    db.add(new_investment)
+    # only the first click approves it, the worker makes the investment (see job_queue.py)
+    db = get_db()
+    if not approve_and_enqueue(db, request_id, advisor_id=session["user_id"]):
+        db.rollback()
+        flash("Request not found or already handled")
+        return redirect(url_for("employee_dashboard"))
     db.commit()
-    flash("Investment request approved and investment created")
+    flash("Investment request approved, the investment will show up shortly")
     return redirect(url_for("employee_dashboard"))
 
 
-@app.route("/deny_request/<int:request_id>", methods=["POST"])
+@route("/deny_request/<int:request_id>", methods=["POST"])
 def deny_request(request_id):
-    db = SessionLocal()
-    req = db.query(InvestmentRequest).get(request_id)
-    if not req:
-        flash("Request not found")
-        return redirect(url_for("employee_dashboard"))
+    if session.get("user_type") != "employee":
+        return redirect(url_for("login"))
 
-    req.status = "Rejected"
+    # same check as denying many at once: the advisor's own request, still Pending / AdvisorCreated
+    db = get_db()
+    result = review_requests(db, session["user_id"], [request_id], "deny")[request_id]
+    if result["result"] != "denied":
+        db.rollback()
+        flash("Request not found or already handled")
+        return redirect(url_for("employee_dashboard"))
     db.commit()
     flash("Investment request denied")
     return redirect(url_for("employee_dashboard"))
 
 
+# -- approve / deny many requests at once --
+def _is_request_id(value):
+    # json sends numbers, the form sends strings of digits (true / false aren't ids)
+    if isinstance(value, str):
+        return value.isascii() and value.isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+@route("/review_requests", methods=["POST"])
+def review_requests_bulk():
+    # takes JSON {"action": "approve" | "deny", "request_ids": [...]} or the dashboard's form
+    wants_json = request.is_json
+    if session.get("user_type") != "employee":
+        return (jsonify({"error": "not allowed"}), 403) if wants_json else redirect(url_for("login"))
+
+    if wants_json:
+        data = request.get_json(silent=True) or {}
+        action, request_ids = data.get("action"), data.get("request_ids") or []
+    else:
+        action, request_ids = request.form.get("action"), request.form.getlist("request_id")
+
+    # check the input here so a bad request gets a plain message back
+    error = None
+    if action not in ("approve", "deny"):
+        error = "action must be approve or deny"
+    elif not isinstance(request_ids, list) or not all(_is_request_id(i) for i in request_ids):
+        error = "request_ids must be a list of integers"
+    elif len(request_ids) > MAX_BULK_REVIEW:
+        error = f"Can't review more than {MAX_BULK_REVIEW} requests at once"
+    if error:
+        if wants_json:
+            return jsonify({"error": error}), 400
+        flash(error)
+        return redirect(url_for("employee_dashboard"))
+
+    # every request in one transaction, see request_review.py
+    db = get_db()
+    results = review_requests(db, session["user_id"], [int(i) for i in request_ids], action)
+    db.commit()
+
+    summary = {}
+    for result in results.values():
+        summary[result["result"]] = summary.get(result["result"], 0) + 1
+    if wants_json:
+        return jsonify({
+            "action": action,
+            "results": [{"request_id": request_id, **result} for request_id, result in results.items()],
+            "summary": summary,
+        })
+    flash(", ".join(f"{count} {result.replace('_', ' ')}" for result, count in summary.items()) or "No requests picked")
+    return redirect(url_for("employee_dashboard"))
+
+
 # -- request investments with no parmas
-@app.route("/request_investment", methods=["GET", "POST"])
+@route("/request_investment", methods=["GET", "POST"])
 def request_investment():
     if session.get("user_type") != "client":
         return redirect(url_for("login"))
 
-    db = SessionLocal()
+    db = get_db()
     client = db.query(Client).get(session["user_id"])
     if not client:
         return "Client not found", 404
@@ -297,8 +512,8 @@ def request_investment():
     if not advisor:
         return "Advisor not found", 404
 
-    # Get all companies for dropdown
-    companies = db.query(Company).all()
+    # Get all companies for dropdown (cached, see company_cache.py)
+    companies = company_catalog.dropdown(db)
 
     # Verify if the company can be invested in
     if request.method == "POST":
@@ -339,7 +554,7 @@ def request_investment():
 
 
 # -- client investment approval -- 
-@app.route("/approve_investment/<int:request_id>", methods=["POST"])
+@route("/approve_investment/<int:request_id>", methods=["POST"])
 def approve_investment(request_id):
     if session.get("user_type") != "client":
         return redirect(url_for("login"))
@@ -348,40 +563,82 @@ def approve_investment(request_id):
     return redirect(url_for("security_check_for_investment"))
 
 
+# -- audit log of the security checks (written in the background, see audit_log.py) --
+def audit_security_check(action, client_id, outcome, request_id=None):
+    audit_log.record(session.get("user_type"), session.get("user_id"), action, client_id, outcome,
+                     request_id=request_id, remote_addr=request.remote_addr)
+
+
+# -- json: who has looked at (or approved for) a client --
+@route("/api/clients/<int:client_id>/access_history")
+def api_client_access_history(client_id):
+    db = get_db()
+    client = db.query(Client).get(client_id)
+    # the client themselves, or their advisor / the advisor's manager
+    if client is None or not (
+        (session.get("user_type") == "client" and session.get("user_id") == client_id)
+        or can_view_advisor(db, client.advisor_id)
+    ):
+        return jsonify({"error": "not allowed"}), 403
+
+    limit = max(1, min(request.args.get("limit", 100, type=int), 500))
+    events = client_access_history(db, client_id, limit, request.args.get("before", type=int))
+    return jsonify({
+        "client_id": client_id,
+        "events": [
+            {
+                "event_id": e.event_id,
+                "occurred_at": e.occurred_at.isoformat(),
+                "actor_type": e.actor_type,
+                "actor_id": e.actor_id,
+                "action": e.action,
+                "request_id": e.request_id,
+                "outcome": e.outcome,
+                "row_count": e.row_count,
+            }
+            for e in events
+        ],
+        "next_before": events[-1].event_id if events and len(events) == limit else None,
+    })
+
+
 # -- client investment approval validation --
-@app.route("/security_check_investment", methods=["GET", "POST"])
+@route("/security_check_investment", methods=["GET", "POST"])
 def security_check_for_investment():
-    db = SessionLocal()
+    db = get_db()
     client = db.query(Client).get(session["user_id"])
     request_id = session.get("requested_request_id")
-    req = db.query(InvestmentRequest).get(request_id)
 
     if request.method == "POST":
         password = request.form.get("password")  # Verify the requestor of the investment
-        if check_password_hash(client.password_hash, password):
-            # Create the actual investment
-            investment = Investment(
-                client_id=client.client_id,
-                company_id=None,  # create company if needed
-                shares_purchased=req.shares,
-                purchase_price_per_share=0,  # set current price
-                current_price=0,
-                market_value=0
-            )
-            db.add(investment)
-            req.status = "Approved"
+        # the hash check runs on the same limited pool as logins (see auth.py)
+        try:
+            matches, _ = verify_password(client.password_hash, password)
+        except LoginBusyError:
+            flash("Too many people are logging in right now, please try again")
+            return render_template("security_check.html", client_id=client.client_id), 503
+        if matches:
+            # approve it (only once) and let the worker make the investment
+            if not approve_and_enqueue(db, request_id, client_id=client.client_id):
+                db.rollback()
+                audit_security_check("approve_request", client.client_id, "already_handled", request_id)
+                session.pop("requested_request_id", None)
+                flash("This request was already handled")
+                return redirect(url_for("client_dashboard"))
             db.commit()
+            audit_security_check("approve_request", client.client_id, "granted", request_id)
             session.pop("requested_request_id", None)
-            flash("Investment approved and created!")
+            flash("Investment approved, it will show up shortly!")
             return redirect(url_for("client_dashboard"))
         else:
+            audit_security_check("approve_request", client.client_id, "denied", request_id)
             flash("Incorrect password")
 
     return render_template("security_check.html", client_id=client.client_id)
 
 
 # -- requesting to see information --
-@app.route("/request_client_info/<int:client_id>", methods=["POST"])
+@route("/request_client_info/<int:client_id>", methods=["POST"])
 def request_client_info(client_id):
     # check we are a manager / advisor
     if session.get("user_type") not in ["manager", "employee"]:
@@ -393,19 +650,25 @@ def request_client_info(client_id):
 
 
 # -- security check for seeing investments --
-@app.route("/security_check/<int:client_id>", methods=["GET", "POST"])
+@route("/security_check/<int:client_id>", methods=["GET", "POST"])
 def security_check(client_id):
-    db = SessionLocal()
+    db = get_db()
     # get users
     user = db.query(Employee).get(session["user_id"])
 
     if request.method == "POST":
         password = request.form.get("password")
-        # check if we have the right password
-        if check_password_hash(user.password_hash, password):
+        # check if we have the right password (on the limited hash pool, see auth.py)
+        try:
+            matches, _ = verify_password(user.password_hash, password)
+        except LoginBusyError:
+            flash("Too many people are logging in right now, please try again")
+            return render_template("security_check.html", client_id=client_id), 503
+        if matches:
 
             # if so, we are verified (yay)
             session["verified_client_id"] = client_id
+            audit_security_check("view_investments", client_id, "granted")
 
             if session["user_type"] == "manager":
                 return redirect(url_for("manager_dashboard"))
@@ -413,19 +676,101 @@ def security_check(client_id):
                 return redirect(url_for("employee_dashboard"))
         # else, we are not verified and cannot see the investments
         else:
+            audit_security_check("view_investments", client_id, "denied")
             flash("Incorrect password")
 
     # return security check
     return render_template("security_check.html", client_id=client_id)
 
 
+# -- password re-check before exporting a book --
+@route("/security_check_export", methods=["GET", "POST"])
+def security_check_export():
+    if session.get("user_type") not in ["manager", "employee"]:
+        return redirect(url_for("login"))
+
+    db = get_db()
+    user = db.query(Employee).get(session["user_id"])
+    form_action = url_for("security_check_export")
+    if request.method == "POST":
+        try:
+            matches, _ = verify_password(user.password_hash, request.form.get("password"))
+        except LoginBusyError:
+            flash("Too many people are logging in right now, please try again")
+            return render_template("security_check.html", form_action=form_action), 503
+        if matches:
+            session["export_verified_at"] = time.time()
+            audit_security_check("export_reauth", None, "granted")
+            return redirect(session.pop("export_next", None) or url_for("export_book"))
+        audit_security_check("export_reauth", None, "denied")
+        flash("Incorrect password")
+
+    return render_template("security_check.html", form_action=form_action)
+
+
+# -- connection pool statistics (only from the server itself) --
+@route("/internal/pool_stats")
+def internal_pool_stats():
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(404)
+    return jsonify(pool_stats())
+
+
+# -- query counts and database time per endpoint (only from the server itself) --
+@route("/internal/sql_stats")
+def internal_sql_stats():
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(404)
+    summary = sql_stats.sql_stats.summary()
+    if request.args.get("reset"):
+        sql_stats.sql_stats.reset()
+    return jsonify(summary)
+
+
+# -- audit log counters (only from the server itself) --
+@route("/internal/audit_stats")
+def internal_audit_stats():
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(404)
+    return jsonify(audit_log.stats())
+
+
 # -- logout user --
-@app.route("/logout")
+@route("/logout")
 def logout():
     # logout!
     session.clear()
     return redirect(url_for("login"))
 
 
+'''
+    This method makes the flask app. Nothing here connects to the database, the
+    engine is only made when the first request asks for a session. The tables
+    are made with "flask --app app init-db" (or python create_data.py).
+'''
+
+
+def create_app():
+    app = Flask(__name__, static_folder='static', template_folder='templates')
+    app.secret_key = "fake_investing_secret"
+
+    for rule, view, options in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+
+    # every request gets its own session which is closed when the request ends
+    init_app(app)
+
+    # count the queries and database time of every request (see sql_stats.py)
+    sql_stats.init_app(app)
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create any missing tables."""
+        init_db()
+        print("Tables created")
+
+    return app
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
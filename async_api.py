@@ -0,0 +1,487 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - async_api.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This async_api.py file is a JSON version of the dashboards that runs on
+    asyncio! The Flask routes hold a worker thread for the whole time the
+    database is working, so a slow database means running out of threads.
+    Here every database call is awaited instead, and the queries a page needs
+    that don't depend on each other (like a client's advisor, investments and
+    requests) are sent at the same time, each on its own connection.
+
+    It uses the same models.py classes with SQLAlchemy's asyncio extension and
+    the same login as the website (it reads the Flask session cookie), so log
+    in on the website first. It is a plain ASGI app, run it with for example:
+        pip install uvicorn aiosqlite asyncpg
+        uvicorn async_api:app --port 5001
+
+    GET /api/v2/client/portfolio                        (client)
+    GET /api/v2/advisor/book?after=&limit=&advisor_id=  (employee, or their manager)
+    GET /api/v2/advisor/requests?status=&limit=&advisor_id=
+    GET /api/v2/manager/hierarchy?after=                (manager)
+'''
+import asyncio
+import json
+import os
+from datetime import date, datetime
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from itsdangerous import BadSignature
+from sqlalchemy import select, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+import database
+from app import create_app
+from models import (Employee, Client, Investment, Company, InvestmentRequest,
+                    ClientRollup, AdvisorRollup, ManagerRollup)
+from loaders import EMPLOYEE_PAGE_SIZE, CLIENTS_PER_EMPLOYEE, ClientRow
+
+MAX_PAGE = 200
+REQUEST_QUEUE_SIZE = 50
+
+# the client columns the pages show (same as loaders.py), never SSNs or contact details
+_CLIENT_COLUMNS = (Client.client_id, Client.first_name, Client.last_name, Client.advisor_id)
+
+# the async driver to use for each database
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+# -- the async engine (made the first time a request needs it) --
+def async_database_url(url):
+    '''
+        Turns DATABASE_URL into the same database with an async driver.
+        Set ASYNC_DATABASE_URL to pick one yourself.
+    '''
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in _ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver for {backend}, set ASYNC_DATABASE_URL")
+    url = url.set(drivername=_ASYNC_DRIVERS[backend])
+    # asyncpg takes ssl=require instead of libpq's sslmode=require
+    if "sslmode" in url.query:
+        query = dict(url.query)
+        query["ssl"] = query.pop("sslmode")
+        url = url.set(query=query)
+    return url
+
+
+_engine = None
+_sessions = async_sessionmaker(expire_on_commit=False)
+
+
+def get_async_engine():
+    # only ever called from the event loop's thread, so no lock is needed
+    global _engine
+    if _engine is None:
+        url = os.environ.get("ASYNC_DATABASE_URL") or async_database_url(database.DATABASE_URL)
+        _engine = create_async_engine(
+            url,
+            echo=database.DB_ECHO,
+            pool_size=database.POOL_SIZE,
+            max_overflow=database.MAX_OVERFLOW,
+            pool_timeout=database.POOL_TIMEOUT,
+            pool_recycle=database.POOL_RECYCLE,
+            pool_pre_ping=database.POOL_PRE_PING,
+        )
+        _sessions.configure(bind=_engine)
+    return _engine
+
+
+async def dispose_engine():
+    global _engine
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+
+
+# -- running queries (each call gets its own session, so they can run at the same time) --
+async def _all(stmt):
+    get_async_engine()
+    async with _sessions() as db:
+        return (await db.execute(stmt)).all()
+
+
+async def _first(stmt):
+    rows = await _all(stmt.limit(1))
+    return rows[0] if rows else None
+
+
+async def _get(model, key):
+    get_async_engine()
+    async with _sessions() as db:
+        return await db.get(model, key)
+
+
+async def _nothing():
+    return []
+
+
+# -- turning rows into JSON --
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _person(row, id_column):
+    if row is None:
+        return None
+    return {id_column: getattr(row, id_column), "first_name": row.first_name, "last_name": row.last_name}
+
+
+def _client(client):
+    data = _person(client, "client_id")
+    data["advisor_id"] = client.advisor_id
+    return data
+
+
+def _employee(employee):
+    data = _person(employee, "employee_id")
+    data.update({"work_email": employee.work_email, "job_title": employee.job_title})
+    return data
+
+
+def _investment(investment, company_name):
+    return {
+        "investment_id": investment.investment_id,
+        "company_id": investment.company_id,
+        "company_name": company_name,
+        "date": investment.date,
+        "shares_purchased": investment.shares_purchased,
+        "purchase_price_per_share": investment.purchase_price_per_share,
+        "current_price": investment.current_price,
+        "market_value": investment.market_value,
+        "gain_loss_percent": investment.gain_loss_percent,
+        "exit_date": investment.exit_date,
+    }
+
+
+def _request(req, company_name, client=None):
+    data = {
+        "request_id": req.request_id,
+        "client_id": req.client_id,
+        "company_id": req.company_id,
+        "company_name": company_name,
+        "shares": req.shares,
+        "purchase_price_per_share": req.purchase_price_per_share,
+        "status": req.status,
+        "created_at": req.created_at,
+    }
+    if client is not None:
+        data["client"] = client
+    return data
+
+
+def _totals(rollup):
+    if rollup is None:
+        return {"position_count": 0, "cost_basis": 0.0, "market_value": 0.0, "updated_at": None}
+    return {
+        "position_count": rollup.position_count,
+        "cost_basis": rollup.cost_basis,
+        "market_value": rollup.market_value,
+        "updated_at": rollup.updated_at,
+    }
+
+
+# -- statements shared by the endpoints --
+def _investments_for(client_id):
+    return (
+        select(Investment, Company.company_name)
+        .outerjoin(Company, Company.company_id == Investment.company_id)
+        .where(Investment.client_id == client_id)
+        .order_by(Investment.investment_id)
+    )
+
+
+def _clients_page(advisor_id, after, limit):
+    return (
+        select(*_CLIENT_COLUMNS)
+        .where(Client.advisor_id == advisor_id, Client.client_id > after)
+        .order_by(Client.client_id)
+        .limit(limit + 1)
+    )
+
+
+def _int_param(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise BadRequest(f"{name} must be a number")
+
+
+class BadRequest(Exception):
+    pass
+
+
+async def _viewable_advisor(session, params):
+    '''
+        The advisor whose book is asked for, or None if this user can't see
+        it. Employees see their own, managers the ones who report to them.
+    '''
+    if session.get("user_type") == "employee":
+        advisor_id = session.get("user_id")
+    elif session.get("user_type") == "manager":
+        advisor_id = _int_param(params, "advisor_id", 0)
+    else:
+        return None
+    advisor = await _get(Employee, advisor_id)
+    if advisor is None:
+        return None
+    if session.get("user_type") == "manager" and advisor.manager_id != session.get("user_id"):
+        return None
+    return advisor
+
+
+# -- endpoints: each gets the Flask session and the query string, returns (status, body) --
+async def client_portfolio(session, params):
+    if session.get("user_type") != "client":
+        return 403, {"error": "not allowed"}
+    client_id = session.get("user_id")
+
+    # the client + advisor, investments, requests and totals don't depend on each other
+    client_row, investments, requests, totals = await asyncio.gather(
+        _first(
+            select(*_CLIENT_COLUMNS, Employee)
+            .outerjoin(Employee, Employee.employee_id == Client.advisor_id)
+            .where(Client.client_id == client_id)
+        ),
+        _all(_investments_for(client_id)),
+        _all(
+            select(InvestmentRequest, Company.company_name)
+            .outerjoin(Company, Company.company_id == InvestmentRequest.company_id)
+            .where(InvestmentRequest.client_id == client_id)
+            .order_by(InvestmentRequest.created_at.desc())
+        ),
+        _get(ClientRollup, client_id),
+    )
+    if client_row is None:
+        return 404, {"error": "client not found"}
+
+    client, advisor = ClientRow(*client_row[:-1]), client_row[-1]
+    return 200, {
+        "client": _client(client),
+        "advisor": _employee(advisor) if advisor else None,
+        "investments": [_investment(inv, name) for inv, name in investments],
+        "requests": [_request(req, name) for req, name in requests],
+        "totals": _totals(totals),
+    }
+
+
+async def advisor_book(session, params):
+    after = _int_param(params, "after", 0)
+    limit = max(1, min(_int_param(params, "limit", CLIENTS_PER_EMPLOYEE), MAX_PAGE))
+    advisor = await _viewable_advisor(session, params)
+    if advisor is None:
+        return 403, {"error": "not allowed"}
+
+    clients, totals = await asyncio.gather(
+        _all(_clients_page(advisor.employee_id, after, limit)),
+        _get(AdvisorRollup, advisor.employee_id),
+    )
+    next_after = None
+    if len(clients) > limit:
+        clients = clients[:limit]
+        next_after = clients[-1].client_id
+    return 200, {
+        "advisor": _employee(advisor),
+        "clients": [_client(c) for c in clients],
+        "next_after": next_after,
+        "totals": _totals(totals),
+    }
+
+
+async def advisor_requests(session, params):
+    status = params.get("status")
+    limit = max(1, min(_int_param(params, "limit", REQUEST_QUEUE_SIZE), MAX_PAGE))
+    advisor = await _viewable_advisor(session, params)
+    if advisor is None:
+        return 403, {"error": "not allowed"}
+
+    filters = [InvestmentRequest.advisor_id == advisor.employee_id]
+    if status:
+        filters.append(InvestmentRequest.status == status)
+    queue = (
+        select(InvestmentRequest, Company.company_name, Client.first_name, Client.last_name)
+        .outerjoin(Company, Company.company_id == InvestmentRequest.company_id)
+        .outerjoin(Client, Client.client_id == InvestmentRequest.client_id)
+        .where(*filters)
+        .order_by(InvestmentRequest.created_at.desc())
+        .limit(limit)
+    )
+    counts = (
+        select(InvestmentRequest.status, func.count())
+        .where(InvestmentRequest.advisor_id == advisor.employee_id)
+        .group_by(InvestmentRequest.status)
+    )
+
+    rows, status_counts = await asyncio.gather(_all(queue), _all(counts))
+    return 200, {
+        "advisor_id": advisor.employee_id,
+        "requests": [
+            _request(req, company_name, {"client_id": req.client_id, "first_name": first, "last_name": last})
+            for req, company_name, first, last in rows
+        ],
+        "status_counts": {row[0]: row[1] for row in status_counts},
+    }
+
+
+async def manager_hierarchy(session, params):
+    if session.get("user_type") != "manager":
+        return 403, {"error": "not allowed"}
+    manager_id = session.get("user_id")
+    after = _int_param(params, "after", 0)
+    verified_client_id = session.get("verified_client_id")
+
+    # first the manager, their team totals and one page of employees
+    manager, team_totals, employees = await asyncio.gather(
+        _get(Employee, manager_id),
+        _get(ManagerRollup, manager_id),
+        _all(
+            select(Employee)
+            .where(Employee.manager_id == manager_id, Employee.employee_id > after)
+            .order_by(Employee.employee_id)
+            .limit(EMPLOYEE_PAGE_SIZE + 1)
+        ),
+    )
+    if manager is None:
+        return 404, {"error": "manager not found"}
+    employees = [row[0] for row in employees]
+    next_after = None
+    if len(employees) > EMPLOYEE_PAGE_SIZE:
+        employees = employees[:EMPLOYEE_PAGE_SIZE]
+        next_after = employees[-1].employee_id
+    employee_ids = [e.employee_id for e in employees]
+
+    # then their first clients, their totals and the verified client's investments
+    row_number = func.row_number().over(
+        partition_by=Client.advisor_id, order_by=Client.client_id
+    ).label("row_number")
+    numbered = select(Client.client_id, row_number).where(Client.advisor_id.in_(employee_ids)).subquery()
+    clients, employee_totals, verified_investments = await asyncio.gather(
+        _all(
+            select(*_CLIENT_COLUMNS)
+            .join(numbered, Client.client_id == numbered.c.client_id)
+            .where(numbered.c.row_number <= CLIENTS_PER_EMPLOYEE + 1)
+            .order_by(Client.advisor_id, Client.client_id)
+        ) if employee_ids else _nothing(),
+        _all(select(AdvisorRollup).where(AdvisorRollup.advisor_id.in_(employee_ids))) if employee_ids else _nothing(),
+        _all(_investments_for(verified_client_id)) if verified_client_id else _nothing(),
+    )
+
+    by_advisor = {}
+    for client in clients:
+        by_advisor.setdefault(client.advisor_id, []).append(client)
+    totals_by_advisor = {row[0].advisor_id: row[0] for row in employee_totals}
+
+    hierarchy = []
+    for employee in employees:
+        emp_clients = by_advisor.get(employee.employee_id, [])
+        more_after = None
+        if len(emp_clients) > CLIENTS_PER_EMPLOYEE:
+            emp_clients = emp_clients[:CLIENTS_PER_EMPLOYEE]
+            more_after = emp_clients[-1].client_id
+        clients_list = []
+        for client in emp_clients:
+            data = _client(client)
+            # only the verified client shows their investments
+            if verified_client_id == client.client_id:
+                data["investments"] = [_investment(inv, name) for inv, name in verified_investments]
+            clients_list.append(data)
+        hierarchy.append({
+            "employee": _employee(employee),
+            "totals": _totals(totals_by_advisor.get(employee.employee_id)),
+            "clients": clients_list,
+            "more_clients_after": more_after,
+        })
+
+    return 200, {
+        "manager": _employee(manager),
+        "team_totals": _totals(team_totals),
+        "employees": hierarchy,
+        "next_after": next_after,
+    }
+
+
+ROUTES = {
+    "/api/v2/client/portfolio": client_portfolio,
+    "/api/v2/advisor/book": advisor_book,
+    "/api/v2/advisor/requests": advisor_requests,
+    "/api/v2/manager/hierarchy": manager_hierarchy,
+}
+
+
+# -- reading the website's login --
+_cookie_reader = None
+
+
+def read_session(headers):
+    '''
+        Gives back the Flask session from the request's cookie (the same one
+        the website sets at login), or {} if there isn't a valid one.
+    '''
+    global _cookie_reader
+    if _cookie_reader is None:
+        flask_app = create_app()
+        _cookie_reader = (
+            flask_app.session_interface.get_signing_serializer(flask_app),
+            flask_app.config["SESSION_COOKIE_NAME"],
+            int(flask_app.permanent_session_lifetime.total_seconds()),
+        )
+    serializer, cookie_name, max_age = _cookie_reader
+
+    cookies = SimpleCookie()
+    for name, value in headers:
+        if name == b"cookie":
+            cookies.load(value.decode("latin-1"))
+    if cookie_name not in cookies:
+        return {}
+    try:
+        return serializer.loads(cookies[cookie_name].value, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+# -- the ASGI app --
+async def _send_json(send, status, body):
+    payload = json.dumps(body, default=_json_default).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await dispose_engine()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    handler = ROUTES.get(scope["path"])
+    if handler is None:
+        await _send_json(send, 404, {"error": "not found"})
+        return
+    if scope["method"] not in ("GET", "HEAD"):
+        await _send_json(send, 405, {"error": "method not allowed"})
+        return
+
+    params = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+    try:
+        status, body = await handler(read_session(scope.get("headers", [])), params)
+    except BadRequest as e:
+        status, body = 400, {"error": str(e)}
+    await _send_json(send, status, body)
@@ -0,0 +1,185 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - audit_log.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This audit_log.py file keeps a record of every security check (who tried to
+    see or approve what, and whether they got in)! Writing each event to the
+    database right away would add a trip to the database to every check, so
+    events go into a buffer in memory instead and a background thread writes
+    them with one bulk INSERT every AUDIT_FLUSH_INTERVAL seconds, or sooner
+    once AUDIT_FLUSH_SIZE events are waiting.
+
+    The buffer holds at most AUDIT_BUFFER_SIZE events. If the database can't
+    keep up (or is down) a full buffer makes record() wait a moment for the
+    thread, and if it is still full the oldest event is dropped and counted,
+    so a slow database never stops the website. stats() has the counters.
+
+    The audit_events table is append-only (see models.py).
+'''
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from sqlalchemy import select, insert
+from database import SessionLocal
+from models import AuditEvent
+
+AUDIT_BUFFER_SIZE = int(os.environ.get("AUDIT_BUFFER_SIZE", "10000"))  # events kept in memory at most
+AUDIT_FLUSH_SIZE = int(os.environ.get("AUDIT_FLUSH_SIZE", "200"))  # write as soon as this many are waiting
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", "1"))  # seconds between writes
+AUDIT_FULL_WAIT = float(os.environ.get("AUDIT_FULL_WAIT", "0.05"))  # seconds record() waits when full
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLog:
+    def __init__(self, buffer_size=AUDIT_BUFFER_SIZE, flush_size=AUDIT_FLUSH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL, full_wait=AUDIT_FULL_WAIT):
+        self.buffer_size = buffer_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.full_wait = full_wait
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)  # tells the thread to write now
+        self._space = threading.Condition(self._lock)  # tells record() there is room again
+        self._write_lock = threading.Lock()  # one write at a time (thread or flush())
+        self._thread = None
+        self._pid = None
+        self._counts = {"recorded": 0, "written": 0, "dropped": 0, "waited": 0, "batches": 0, "write_errors": 0}
+
+    # -- adding events --
+    def record(self, actor_type, actor_id, action, client_id, outcome, request_id=None, remote_addr=None,
+               row_count=None):
+        event = {
+            "occurred_at": datetime.utcnow(),
+            "actor_type": actor_type,
+            "actor_id": actor_id,
+            "action": action,
+            "client_id": client_id,
+            "request_id": request_id,
+            "outcome": outcome,
+            "remote_addr": remote_addr,
+            "row_count": row_count,
+        }
+        self._ensure_thread()
+        with self._lock:
+            if len(self._events) >= self.buffer_size:
+                # full: give the thread a moment to make room, then drop the oldest
+                self._counts["waited"] += 1
+                self._wake.notify()
+                self._space.wait_for(lambda: len(self._events) < self.buffer_size, timeout=self.full_wait)
+                while len(self._events) >= self.buffer_size:
+                    self._events.popleft()
+                    self._counts["dropped"] += 1
+            self._events.append(event)
+            self._counts["recorded"] += 1
+            if len(self._events) >= self.flush_size:
+                self._wake.notify()
+
+    # -- writing events --
+    def _take(self):
+        with self._lock:
+            batch = list(self._events)
+            self._events.clear()
+            self._space.notify_all()
+        return batch
+
+    def _put_back(self, batch):
+        # a failed batch goes back in front, as much of it as still fits
+        with self._lock:
+            room = max(self.buffer_size - len(self._events), 0)
+            if room < len(batch):
+                self._counts["dropped"] += len(batch) - room
+                batch = batch[len(batch) - room:]
+            self._events.extendleft(reversed(batch))
+
+    def _write(self, batch):
+        db = SessionLocal()
+        try:
+            db.execute(insert(AuditEvent), batch)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def flush(self):
+        '''
+            Writes everything waiting in the buffer now, with one bulk INSERT.
+            Returns how many events were written.
+        '''
+        with self._write_lock:
+            batch = self._take()
+            if not batch:
+                return 0
+            try:
+                self._write(batch)
+            except Exception:
+                self._put_back(batch)
+                with self._lock:
+                    self._counts["write_errors"] += 1
+                raise
+            with self._lock:
+                self._counts["written"] += len(batch)
+                self._counts["batches"] += 1
+            return len(batch)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wake.wait_for(lambda: len(self._events) >= self.flush_size, timeout=self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("audit log write failed, will try again")
+                time.sleep(self.flush_interval)
+
+    def _ensure_thread(self):
+        # started on first use (and again in a forked worker process, which doesn't get our thread)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, buffered=len(self._events), buffer_size=self.buffer_size)
+
+
+audit_log = AuditLog()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        audit_log.flush()
+    except Exception:
+        logger.exception("audit log could not be written at exit")
+
+
+# -- reading the log --
+def client_access_history(db, client_id, limit=100, before_event_id=None):
+    '''
+        A client's audit events, newest first, limit at a time. Pass the
+        last event_id of a page as before_event_id for the next page.
+    '''
+    # events still in the buffer should show up too, but if they can't be
+    # written right now we still show what is already in the table
+    try:
+        audit_log.flush()
+    except Exception:
+        logger.exception("audit log could not be written, showing the saved history only")
+    stmt = select(AuditEvent).where(AuditEvent.client_id == client_id)
+    if before_event_id is not None:
+        stmt = stmt.where(AuditEvent.event_id < before_event_id)
+    stmt = stmt.order_by(AuditEvent.event_id.desc()).limit(limit)
+    return list(db.scalars(stmt))
@@ -0,0 +1,127 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - auth.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This auth.py file handles checking a users login! Clients log in with their
+    email and employees (advisors and managers) with their work email, so we
+    look both up with ONE query instead of two. Checking a password hash is
+    slow on purpose, so that work is done on a small, limited pool of threads.
+    That way a bunch of logins at once can't take over the server. If a users
+    password was hashed with older settings, we re-hash it when they log in.
+'''
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from sqlalchemy import select, union_all, literal, update, String
+from werkzeug.security import check_password_hash, generate_password_hash
+from models import Client, Employee
+
+HASH_WORKERS = int(os.environ.get("AUTH_HASH_WORKERS", "4"))
+HASH_QUEUE_LIMIT = int(os.environ.get("AUTH_HASH_QUEUE_LIMIT", "32"))  # checks waiting + running
+HASH_WAIT_TIMEOUT = float(os.environ.get("AUTH_HASH_WAIT_TIMEOUT", "2"))  # seconds to wait for a slot
+
+# one row from the login lookup, kind is "client" or "employee"
+Identity = namedtuple("Identity", ["kind", "user_id", "password_hash", "job_title"])
+
+
+class LoginBusyError(Exception):
+    pass
+
+
+# -- bounded pool for password hash checks --
+class BoundedExecutor:
+    def __init__(self, max_workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pwhash")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def run(self, fn, *args, timeout=None):
+        # if everything is busy for too long, give up instead of piling up
+        if not self._slots.acquire(timeout=timeout):
+            raise LoginBusyError("Too many logins at once")
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+
+hash_executor = BoundedExecutor(HASH_WORKERS, max(HASH_QUEUE_LIMIT, HASH_WORKERS))
+
+
+# -- re-hashing passwords with outdated settings --
+@lru_cache(maxsize=1)
+def current_hash_method():
+    # the "method" part of a werkzeug hash is everything before the first $
+    return generate_password_hash("method-check").split("$", 1)[0]
+
+
+def needs_rehash(password_hash):
+    return password_hash.split("$", 1)[0] != current_hash_method()
+
+
+def _verify(password_hash, password):
+    if not password_hash or not check_password_hash(password_hash, password):
+        return False, None
+    if needs_rehash(password_hash):
+        return True, generate_password_hash(password)
+    return True, None
+
+
+def verify_password(password_hash, password):
+    '''
+        Checks a password on the hash pool. Returns (matches, new_hash) where
+        new_hash is only set when the stored hash should be replaced.
+    '''
+    return hash_executor.run(_verify, password_hash, password, timeout=HASH_WAIT_TIMEOUT)
+
+
+# -- one query for clients and employees --
+def find_identities(db, email):
+    clients = select(
+        literal("client", String).label("kind"),
+        Client.client_id.label("user_id"),
+        Client.password_hash,
+        literal(None, String).label("job_title"),
+    ).where(Client.email == email)
+    employees = select(
+        literal("employee", String),
+        Employee.employee_id,
+        Employee.password_hash,
+        Employee.job_title,
+    ).where(Employee.work_email == email)
+
+    rows = [Identity(*row) for row in db.execute(union_all(clients, employees))]
+    # clients get checked first, same as before
+    return sorted(rows, key=lambda row: row.kind != "client")
+
+
+def _store_rehash(db, identity, new_hash):
+    if identity.kind == "client":
+        stmt = update(Client).where(Client.client_id == identity.user_id)
+    else:
+        stmt = update(Employee).where(Employee.employee_id == identity.user_id)
+    try:
+        db.execute(stmt.values(password_hash=new_hash))
+        db.commit()
+    except Exception:
+        # not being able to upgrade the hash shouldn't stop the login
+        db.rollback()
+
+
+def authenticate(db, email, password):
+    '''
+        Returns the Identity that matches the email and password, or None.
+        Raises LoginBusyError if the hash pool is too busy right now.
+    '''
+    for identity in find_identities(db, email):
+        matches, new_hash = verify_password(identity.password_hash, password)
+        if matches:
+            if new_hash:
+                _store_rehash(db, identity, new_hash)
+            return identity
+    return None
@@ -0,0 +1,7 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    benchmarks
+
+    Scripts for measuring how fast parts of our program are. Run them from the
+    main project folder, for example: python -m benchmarks.ssn_bench
+'''
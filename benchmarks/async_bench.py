@@ -0,0 +1,199 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - benchmarks/async_bench.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Compares the sync Flask dashboards with the async JSON API (async_api.py)
+    when lots of users load them at the same time. The sync side runs one
+    thread per user through Flask's test client, the async side runs one
+    asyncio task per user straight into the ASGI app, both in this process and
+    both logged in with the same session cookies. For every route it reports
+    p50/p95/p99 latency and requests per second as JSON.
+
+    This needs a LOCAL database (set DATABASE_URL), for example:
+        DATABASE_URL=sqlite:///bench.db python -m benchmarks.async_bench --concurrency 64
+    Add --seed-data to WIPE that database and make new data first (see route_bench.py).
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import async_api
+import create_data
+from app import create_app
+from database import SessionLocal, get_engine
+from benchmarks.route_bench import RouteStats, pick_users, _percentile
+
+SYNC_ROUTES = ["/client_dashboard", "/employee_dashboard", "/manager_dashboard"]
+ASYNC_ROUTES = ["/api/v2/client/portfolio", "/api/v2/advisor/book",
+                "/api/v2/advisor/requests", "/api/v2/manager/hierarchy"]
+
+
+# -- session cookies for each kind of user --
+def make_cookies(flask_app, users):
+    '''
+        Signs the same session cookie the website sets at login, so neither
+        side spends its time hashing passwords.
+    '''
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    name = flask_app.config["SESSION_COOKIE_NAME"]
+
+    def cookie(user_type, user_id):
+        return name, serializer.dumps({"user_type": user_type, "user_id": user_id})
+
+    db = SessionLocal()
+    try:
+        from models import Employee
+        cookies = []
+        for client_email, advisor_email, manager_email, client_id in users:
+            advisor = db.query(Employee.employee_id).filter(Employee.work_email == advisor_email).scalar()
+            manager = db.query(Employee.employee_id).filter(Employee.work_email == manager_email).scalar()
+            cookies.append({
+                "client": cookie("client", client_id),
+                "employee": cookie("employee", advisor),
+                "manager": cookie("manager", manager),
+            })
+        return cookies
+    finally:
+        db.close()
+
+
+def _who(route):
+    if "client" in route:
+        return "client"
+    if "manager" in route:
+        return "manager"
+    return "employee"
+
+
+def _summary(stats, wall):
+    routes = {}
+    for route, samples in sorted(stats.samples.items()):
+        latencies = [s[0] * 1000 for s in samples]
+        routes[route] = {
+            "count": len(samples),
+            "errors": sum(1 for s in samples if s[2] != 200),
+            "p50_ms": round(_percentile(latencies, 50), 3),
+            "p95_ms": round(_percentile(latencies, 95), 3),
+            "p99_ms": round(_percentile(latencies, 99), 3),
+            "throughput_rps": round(len(samples) / wall, 2),
+        }
+    return {
+        "wall_seconds": round(wall, 3),
+        "total_rps": round(sum(r["count"] for r in routes.values()) / wall, 2),
+        "routes": routes,
+    }
+
+
+# -- sync: one thread per user --
+def run_sync(flask_app, cookies, concurrency, iterations):
+    stats = RouteStats()
+
+    def user(cookie_set):
+        # one test client per kind of user, each holding that user's cookie
+        clients = {}
+        for who, (name, value) in cookie_set.items():
+            clients[who] = flask_app.test_client()
+            clients[who].set_cookie(name, value)
+        for _ in range(iterations):
+            for route in SYNC_ROUTES:
+                started = time.perf_counter()
+                response = clients[_who(route)].get(route)
+                stats.record(route, time.perf_counter() - started, 0, response.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(user, cookies[i % len(cookies)]) for i in range(concurrency)]:
+            future.result()
+    return _summary(stats, time.perf_counter() - started)
+
+
+# -- async: one task per user, called straight into the ASGI app --
+async def _asgi_get(path, cookie):
+    name, value = cookie
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": b"",
+             "headers": [(b"cookie", f"{name}={value}".encode("latin-1"))]}
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await async_api.app(scope, receive, send)
+    return status[0]
+
+
+async def _run_async(cookies, concurrency, iterations):
+    stats = RouteStats()
+
+    async def user(cookie_set):
+        for _ in range(iterations):
+            for route in ASYNC_ROUTES:
+                started = time.perf_counter()
+                status = await _asgi_get(route, cookie_set[_who(route)])
+                stats.record(route, time.perf_counter() - started, 0, status)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(user(cookies[i % len(cookies)]) for i in range(concurrency)))
+        return _summary(stats, time.perf_counter() - started)
+    finally:
+        await async_api.dispose_engine()
+
+
+def run(concurrency, iterations, seed):
+    flask_app = create_app()
+    flask_app.config["TESTING"] = True
+
+    db = SessionLocal()
+    try:
+        users = pick_users(db, concurrency, random.Random(seed))
+    finally:
+        db.close()
+    if not users:
+        raise SystemExit("No data to benchmark with, run with --seed-data first")
+    cookies = make_cookies(flask_app, users)
+
+    return {
+        "database": get_engine().dialect.name,
+        "concurrency": concurrency,
+        "iterations": iterations,
+        "sync": run_sync(flask_app, cookies, concurrency, iterations),
+        "async": asyncio.run(_run_async(cookies, concurrency, iterations)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the sync dashboards with the async JSON API")
+    parser.add_argument("--concurrency", type=int, default=64, help="users loading pages at the same time")
+    parser.add_argument("--iterations", type=int, default=10, help="rounds of every route per user")
+    parser.add_argument("--seed-data", action="store_true", help="WIPE the database and make new data first")
+    parser.add_argument("--companies", type=int, default=200)
+    parser.add_argument("--employees", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=20000)
+    parser.add_argument("--investments", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=622)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    if "DATABASE_URL" not in os.environ:
+        sys.exit("Set DATABASE_URL to a local database first (this would otherwise hit the cloud database)")
+
+    if args.seed_data:
+        create_data.create_scale_data(args.companies, args.employees, args.clients, args.investments,
+                                      seed=args.seed, requests=args.requests)
+
+    results = run(args.concurrency, args.iterations, args.seed)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
@@ -0,0 +1,156 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - benchmarks/explain_bench.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Query plan benchmark! This runs EXPLAIN ANALYZE (EXPLAIN QUERY PLAN on
+    sqlite) on every query the dashboards run all the time, prints how long
+    each one took, and FAILS if any of them reads a whole table (a sequential
+    scan) instead of using the indexes from models.py.
+
+    python -m benchmarks.explain_bench                       (uses the data already in the database)
+    python -m benchmarks.explain_bench --seed-data --clients 200000 --investments 1000000
+        (--seed-data WIPES the database first and makes new data with create_data.py)
+
+    Postgres will happily scan tiny tables, so check with a realistic amount of data.
+'''
+import argparse
+import json
+import sys
+import time
+from sqlalchemy import select, func, text
+from database import get_engine, SessionLocal
+from models import Client, Employee, Investment, InvestmentRequest
+from snn_key import ssn_hash
+import create_data
+
+# tables where a full scan means an index is missing
+GUARDED_TABLES = {"employees", "clients", "investments", "investment_requests"}
+
+
+# -- pick real ids to put into the queries --
+def _sample_ids(db):
+    manager_id = db.scalar(
+        select(Employee.manager_id).where(Employee.manager_id.isnot(None))
+        .group_by(Employee.manager_id).order_by(func.count().desc()).limit(1)
+    )
+    advisor_id = db.scalar(
+        select(Client.advisor_id).group_by(Client.advisor_id).order_by(func.count().desc()).limit(1)
+    )
+    advisor_ids = list(db.scalars(
+        select(Employee.employee_id).where(Employee.manager_id == manager_id).order_by(Employee.employee_id).limit(20)
+    ))
+    client = db.execute(select(Client.client_id, Client.email).where(Client.advisor_id == advisor_id).limit(1)).one()
+    work_email = db.scalar(select(Employee.work_email).where(Employee.employee_id == advisor_id))
+    return {
+        "manager_id": manager_id,
+        "advisor_id": advisor_id,
+        "advisor_ids": advisor_ids or [advisor_id],
+        "client_id": client.client_id,
+        "client_email": client.email,
+        "work_email": work_email,
+    }
+
+
+# -- the hot queries from app.py (same filters and order as the loaders) --
+def hot_queries(ids):
+    row_number = func.row_number().over(partition_by=Client.advisor_id, order_by=Client.client_id).label("rn")
+    return {
+        "login lookup (clients.email)":
+            select(Client.client_id, Client.password_hash).where(Client.email == ids["client_email"]),
+        "login lookup (employees.work_email)":
+            select(Employee.employee_id, Employee.password_hash).where(Employee.work_email == ids["work_email"]),
+        "manager dashboard: employee page":
+            select(Employee).where(Employee.manager_id == ids["manager_id"], Employee.employee_id > 0)
+            .order_by(Employee.employee_id).limit(21),
+        "manager dashboard: first clients":
+            select(Client.client_id, row_number).where(Client.advisor_id.in_(ids["advisor_ids"])),
+        "advisor clients page":
+            select(Client).where(Client.advisor_id == ids["advisor_id"], Client.client_id > 0)
+            .order_by(Client.client_id).limit(26),
+        "client investments":
+            select(Investment).where(Investment.client_id == ids["client_id"]),
+        "client requests":
+            select(InvestmentRequest).where(InvestmentRequest.client_id == ids["client_id"]),
+        "advisor request queue (newest first)":
+            select(InvestmentRequest).where(InvestmentRequest.advisor_id == ids["advisor_id"])
+            .order_by(InvestmentRequest.created_at.desc()),
+        "ssn lookup":
+            select(Client.client_id).where(Client.ssn_hash == ssn_hash("123-45-6789")),
+    }
+
+
+# -- reading the plans --
+def _postgres_scans(plan, found):
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in GUARDED_TABLES:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        _postgres_scans(child, found)
+    return found
+
+
+def explain(conn, stmt):
+    '''
+        Returns (full table scans, milliseconds, plan text) for one query.
+    '''
+    sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    if conn.dialect.name == "postgresql":
+        doc = conn.execute(text("EXPLAIN (ANALYZE, FORMAT JSON) " + sql)).scalar()
+        if isinstance(doc, str):
+            doc = json.loads(doc)
+        top = doc[0]
+        scans = _postgres_scans(top["Plan"], [])
+        return scans, top.get("Execution Time", 0.0), json.dumps(top["Plan"], indent=1)
+
+    # sqlite: "SCAN table" means every row is read, "SEARCH table USING INDEX" is good
+    details = [row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql))]
+    scans = [d.split()[1] for d in details if d.startswith("SCAN ") and d.split()[1] in GUARDED_TABLES]
+    started = time.perf_counter()
+    conn.execute(text(sql)).fetchall()
+    return scans, (time.perf_counter() - started) * 1000, "\n".join(details)
+
+
+def run(verbose=False):
+    db = SessionLocal()
+    try:
+        ids = _sample_ids(db)
+    finally:
+        db.close()
+
+    failures = []
+    with get_engine().connect() as conn:
+        # fresh table statistics so the planner knows how big things are
+        conn.execute(text("ANALYZE"))
+        for name, stmt in hot_queries(ids).items():
+            scans, ms, plan = explain(conn, stmt)
+            status = "SEQ SCAN on " + ", ".join(sorted(set(scans))) if scans else "ok"
+            print(f"  {name:<40} {ms:9.3f} ms  {status}")
+            if verbose or scans:
+                print("    " + plan.replace("\n", "\n    "))
+            if scans:
+                failures.append(name)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the hot queries use indexes")
+    parser.add_argument("--seed-data", action="store_true", help="WIPE the database and make new data first")
+    parser.add_argument("--companies", type=int, default=500)
+    parser.add_argument("--employees", type=int, default=400)
+    parser.add_argument("--clients", type=int, default=100000)
+    parser.add_argument("--investments", type=int, default=500000)
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=622)
+    parser.add_argument("--verbose", action="store_true", help="print every plan")
+    args = parser.parse_args()
+
+    if args.seed_data:
+        create_data.create_scale_data(args.companies, args.employees, args.clients, args.investments,
+                                      seed=args.seed, requests=args.requests)
+
+    print("Query plans:")
+    failed = run(args.verbose)
+    if failed:
+        print(f"FAILED: {len(failed)} hot queries scan a whole table")
+        sys.exit(1)
+    print("All hot queries use indexes")
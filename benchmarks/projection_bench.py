@@ -0,0 +1,173 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - benchmarks/projection_bench.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Compares loading the data for the employee and client dashboards the old
+    way (full ORM objects, every column, kept in the session's identity map)
+    with the read only rows from loaders.py. For the biggest advisor and the
+    client with the most investments it reports, per page, the CPU time, the
+    peak memory while loading (tracemalloc) and the memory still held by the
+    result, as JSON.
+
+    python -m benchmarks.explain_bench --seed-data --clients 20000 --investments 400000   (makes data first)
+    python -m benchmarks.projection_bench --repeat 5
+'''
+import argparse
+import gc
+import json
+import statistics
+import time
+import tracemalloc
+from sqlalchemy import select, func
+from sqlalchemy.orm.attributes import set_committed_value
+from database import SessionLocal
+from models import Employee, Client, Investment, InvestmentRequest, Company
+from company_cache import company_catalog
+import loaders
+
+
+# -- the old ORM versions (whole entities, references attached with set_committed_value) --
+def _old_resolve_references(db, rows, *names):
+    references = {"client": (Client, "client_id"), "company": (Company, "company_id")}
+    for name in names:
+        model, fk = references[name]
+        pk = model.__mapper__.primary_key[0]
+        ids = {getattr(row, fk) for row in rows} - {None}
+        if model is Company:
+            found = company_catalog.get_many(db, ids)
+        else:
+            found = {getattr(obj, pk.key): obj for obj in db.query(model).filter(pk.in_(ids))} if ids else {}
+        for row in rows:
+            set_committed_value(row, name, found.get(getattr(row, fk)))
+    return rows
+
+
+def _old_client_investments(db, client_id):
+    investments = db.query(Investment).filter(Investment.client_id == client_id).all()
+    return _old_resolve_references(db, investments, "company")
+
+
+def _old_employee_page(db, employee_id, verified_client_id):
+    employee = db.query(Employee).get(employee_id)
+    clients = [
+        {"client": client,
+         "investments": _old_client_investments(db, client.client_id) if client.client_id == verified_client_id else []}
+        for client in db.query(Client).filter(Client.advisor_id == employee_id).all()
+    ]
+    requests = db.query(InvestmentRequest).filter(
+        InvestmentRequest.advisor_id == employee_id
+    ).order_by(InvestmentRequest.created_at.desc()).all()
+    _old_resolve_references(db, requests, "client", "company")
+    return employee, clients, requests
+
+
+def _old_client_page(db, client_id):
+    client = db.query(Client).get(client_id)
+    advisor = db.query(Employee).get(client.advisor_id)
+    investments = db.query(Investment).filter(Investment.client_id == client_id).all()
+    requests = db.query(InvestmentRequest).filter(InvestmentRequest.client_id == client_id).all()
+    _old_resolve_references(db, investments + requests, "company")
+    return client, advisor, investments
+
+
+# -- the new versions (same calls as app.py) --
+def _new_employee_page(db, employee_id, verified_client_id):
+    employee = loaders.load_employee(db, employee_id)
+    clients = [
+        {"client": client,
+         "investments": loaders.load_client_investments(db, client.client_id)
+         if client.client_id == verified_client_id else []}
+        for client in loaders.load_advisor_clients(db, employee_id)
+    ]
+    return employee, clients, loaders.load_advisor_requests(db, employee_id)
+
+
+def _new_client_page(db, client_id):
+    client = loaders.load_client(db, client_id)
+    return client, loaders.load_employee(db, client.advisor_id), loaders.load_client_investments(db, client_id)
+
+
+# -- measuring --
+def _measure(load, repeat):
+    cpu, peaks, held, identity = [], [], [], []
+    for _ in range(repeat):
+        db = SessionLocal()
+        try:
+            gc.collect()
+            tracemalloc.start()
+            started = time.process_time()
+            result = load(db)
+            cpu.append(time.process_time() - started)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            peaks.append(peak)
+            held.append(current)
+            identity.append(len(db.identity_map))
+            del result
+        finally:
+            db.close()
+    return {
+        "cpu_ms": round(statistics.median(cpu) * 1000, 2),
+        "peak_kb": round(statistics.median(peaks) / 1024, 1),
+        "held_kb": round(statistics.median(held) / 1024, 1),
+        "orm_objects": identity[0],
+    }
+
+
+def _pick(db):
+    advisor_id = db.scalar(
+        select(Client.advisor_id).group_by(Client.advisor_id).order_by(func.count().desc()).limit(1)
+    )
+    client_id = db.scalar(
+        select(Investment.client_id).group_by(Investment.client_id).order_by(func.count().desc()).limit(1)
+    )
+    clients = db.scalar(select(func.count()).select_from(Client).where(Client.advisor_id == advisor_id))
+    investments = db.scalar(select(func.count()).select_from(Investment).where(Investment.client_id == client_id))
+    return advisor_id, client_id, clients, investments
+
+
+def run(repeat):
+    db = SessionLocal()
+    try:
+        advisor_id, client_id, clients, investments = _pick(db)
+        company_catalog.dropdown(db)  # both sides use the warm catalog
+    finally:
+        db.close()
+    if advisor_id is None:
+        raise SystemExit("No data to benchmark with, make some with create_data.py first")
+
+    pages = {
+        "employee_dashboard": (
+            lambda db: _old_employee_page(db, advisor_id, client_id),
+            lambda db: _new_employee_page(db, advisor_id, client_id),
+        ),
+        "client_dashboard": (
+            lambda db: _old_client_page(db, client_id),
+            lambda db: _new_client_page(db, client_id),
+        ),
+    }
+    results = {"advisor_clients": clients, "client_investments": investments, "repeat": repeat, "pages": {}}
+    for page, (old, new) in pages.items():
+        # one warm up each so both sides have compiled queries cached
+        for load in (old, new):
+            db = SessionLocal()
+            try:
+                load(db)
+            finally:
+                db.close()
+        results["pages"][page] = {"orm": _measure(old, repeat), "rows": _measure(new, repeat)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ORM entities vs read only rows for the dashboards")
+    parser.add_argument("--repeat", type=int, default=5, help="times to load every page (the median is reported)")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    output = json.dumps(run(args.repeat), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
@@ -0,0 +1,204 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - benchmarks/route_bench.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Load benchmark for the web routes! Many workers at once log in and use
+    the client, employee and manager dashboards and the request -> approve
+    flow through Flask's test client (no real web server needed). For every
+    route it reports p50/p95/p99 latency, requests per second and how many
+    SQL queries one request took, as JSON so runs can be compared.
+
+    This needs a LOCAL database (set DATABASE_URL), for example:
+        DATABASE_URL=sqlite:///bench.db python -m benchmarks.route_bench --seed-data --clients 20000
+        DATABASE_URL=postgresql://me:pw@localhost/bench python -m benchmarks.route_bench --workers 32
+    --seed-data WIPES that database and makes new data with create_data.py.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event, select, func
+from sqlalchemy.engine import Engine
+import database
+from database import get_engine, SessionLocal
+from models import Client, Employee, InvestmentRequest, Company
+import create_data
+
+_local = threading.local()
+
+
+# -- counting queries for each request --
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    _local.queries = getattr(_local, "queries", 0) + 1
+
+
+class RouteStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, route, seconds, queries, status):
+        with self._lock:
+            self.samples.setdefault(route, []).append((seconds, queries, status))
+
+
+def _call(stats, route, fn):
+    _local.queries = 0
+    started = time.perf_counter()
+    response = fn()
+    stats.record(route, time.perf_counter() - started, _local.queries, response.status_code)
+    return response
+
+
+def _percentile(values, pct):
+    # nearest rank
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+# -- picking users for each worker --
+def pick_users(db, count, rng):
+    '''
+        Picks (client email, advisor email, manager email, client id) sets
+        where the client belongs to the advisor and the advisor to the manager.
+        The same rng seed picks the same users every run.
+    '''
+    candidates = db.scalars(
+        select(Client.client_id)
+        .join(Employee, Employee.employee_id == Client.advisor_id)
+        .where(Employee.manager_id.isnot(None))
+        .order_by(Client.client_id)
+    ).all()
+    chosen = rng.sample(candidates, min(count, len(candidates)))
+    rows = {
+        row.client_id: row
+        for row in db.execute(
+            select(Client.client_id, Client.email, Employee.work_email, Employee.manager_id)
+            .join(Employee, Employee.employee_id == Client.advisor_id)
+            .where(Client.client_id.in_(chosen))
+        )
+    }
+    managers = dict(db.execute(select(Employee.employee_id, Employee.work_email)).all())
+    return [(rows[client_id].email, rows[client_id].work_email, managers[rows[client_id].manager_id], client_id)
+            for client_id in chosen]
+
+
+def _login(app, stats, email, password):
+    client = app.test_client()
+    _call(stats, "login", lambda: client.post("/login", data={"email": email, "password": password}))
+    return client
+
+
+def worker(app, stats, users, iterations, password, company_ids, seed):
+    rng = random.Random(seed)
+    client_email, advisor_email, manager_email, client_id = users
+    advisor = _login(app, stats, advisor_email, password)
+    manager = _login(app, stats, manager_email, password)
+
+    for _ in range(iterations):
+        client = _login(app, stats, client_email, password)
+        _call(stats, "client_dashboard", lambda: client.get("/client_dashboard"))
+        _call(stats, "employee_dashboard", lambda: advisor.get("/employee_dashboard"))
+        _call(stats, "manager_dashboard", lambda: manager.get("/manager_dashboard"))
+
+        # the request -> approve flow
+        _call(stats, "request_investment", lambda: client.post("/request_investment", data={
+            "company_id": rng.choice(company_ids),
+            "shares": rng.randint(1, 100),
+            "purchase_price_per_share": round(rng.uniform(10, 500), 2),
+        }))
+        db = SessionLocal()
+        try:
+            request_id = db.scalar(
+                select(func.max(InvestmentRequest.request_id)).where(InvestmentRequest.client_id == client_id)
+            )
+        finally:
+            db.close()
+        if request_id:
+            _call(stats, "approve_request", lambda: advisor.post(f"/approve_request/{request_id}"))
+
+
+def run(workers, iterations, password, seed):
+    from app import create_app
+    app = create_app()
+    app.config["TESTING"] = True
+
+    rng = random.Random(seed)
+    db = SessionLocal()
+    try:
+        users = pick_users(db, workers, rng)
+        company_ids = list(db.scalars(select(Company.company_id)))
+    finally:
+        db.close()
+    if not users or not company_ids:
+        raise SystemExit("No data to benchmark with, run with --seed-data first")
+
+    stats = RouteStats()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(worker, app, stats, users[i % len(users)], iterations, password, company_ids, seed + i)
+            for i in range(workers)
+        ]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - started
+
+    routes = {}
+    for route, samples in sorted(stats.samples.items()):
+        latencies = [s[0] * 1000 for s in samples]
+        routes[route] = {
+            "count": len(samples),
+            "errors": sum(1 for s in samples if s[2] >= 500),
+            "p50_ms": round(_percentile(latencies, 50), 3),
+            "p95_ms": round(_percentile(latencies, 95), 3),
+            "p99_ms": round(_percentile(latencies, 99), 3),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "throughput_rps": round(len(samples) / wall, 2),
+            "queries_per_request": round(sum(s[1] for s in samples) / len(samples), 2),
+        }
+    return {
+        "database": get_engine().dialect.name,
+        "workers": workers,
+        "iterations": iterations,
+        "wall_seconds": round(wall, 3),
+        "total_requests": sum(r["count"] for r in routes.values()),
+        "pool": database.pool_stats(),
+        "routes": routes,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the web routes against a local database")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=20, help="rounds of the flow per worker")
+    parser.add_argument("--seed-data", action="store_true", help="WIPE the database and make new data first")
+    parser.add_argument("--companies", type=int, default=200)
+    parser.add_argument("--employees", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=20000)
+    parser.add_argument("--investments", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=622)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    if "DATABASE_URL" not in os.environ:
+        sys.exit("Set DATABASE_URL to a local database first (this would otherwise hit the cloud database)")
+
+    if args.seed_data:
+        create_data.create_scale_data(args.companies, args.employees, args.clients, args.investments,
+                                      seed=args.seed, requests=args.requests)
+
+    results = run(args.workers, args.iterations, create_data.DEFAULT_PASSWORD, args.seed)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
@@ -0,0 +1,73 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - benchmarks/ssn_bench.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Microbenchmark for the SSN encryption in snn_key.py! This compares doing
+    one SSN at a time (the old way, a new AESGCM for every call) with the
+    batch functions that reuse one cipher, and optionally with a process pool.
+
+    python -m benchmarks.ssn_bench --count 100000 --processes 4
+'''
+import argparse
+import base64
+import os
+import time
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives import hashes, hmac
+import snn_key
+
+
+# -- the old per call versions (new cipher / HMAC every time) --
+def _old_encrypt(plain_ssn):
+    aes = AESGCM(snn_key.ENC_KEY)
+    nonce = os.urandom(12)
+    ct = aes.encrypt(nonce, plain_ssn.encode("utf-8"), None)
+    return base64.b64encode(nonce + ct).decode("ascii")
+
+
+def _old_decrypt(b64_payload):
+    raw = base64.b64decode(b64_payload)
+    aes = AESGCM(snn_key.ENC_KEY)
+    return aes.decrypt(raw[:12], raw[12:], None).decode("utf-8")
+
+
+def _old_hash(plain_ssn):
+    h = hmac.HMAC(snn_key.HMAC_KEY, hashes.SHA256())
+    h.update(plain_ssn.encode("utf-8"))
+    return h.finalize().hex()
+
+
+def _time(label, count, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {elapsed:8.3f}s  {count / elapsed:14,.0f} values/sec")
+    return elapsed
+
+
+def run(count, processes):
+    ssns = [f"{i % 900 + 100:03d}-{i % 99 + 1:02d}-{i % 9999 + 1:04d}" for i in range(count)]
+    payloads = snn_key.encrypt_ssn_many(ssns)
+
+    print(f"{count:,} SSNs")
+    for name, old, single, many in [
+        ("encrypt", _old_encrypt, snn_key.encrypt_ssn, snn_key.encrypt_ssn_many),
+        ("decrypt", _old_decrypt, snn_key.decrypt_ssn, snn_key.decrypt_ssn_many),
+        ("hash", _old_hash, snn_key.ssn_hash, snn_key.ssn_hash_many),
+    ]:
+        data = payloads if name == "decrypt" else ssns
+        print(f"{name}:")
+        _time("per call, new cipher each time", count, lambda: [old(v) for v in data])
+        _time("per call, cached cipher", count, lambda: [single(v) for v in data])
+        _time("batch", count, lambda: many(data))
+        if processes and processes > 1:
+            _time(f"batch, {processes} processes", count, lambda: many(data, processes=processes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per call and batch SSN encryption")
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--processes", type=int, default=0)
+    args = parser.parse_args()
+    run(args.count, args.processes)
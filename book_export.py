@@ -0,0 +1,162 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - book_export.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This book_export.py file exports an advisor's (or a manager's whole team's)
+    clients and investments as CSV or JSON lines! It is one query that walks
+    advisor -> client -> investment in order, and the rows are streamed from
+    the database (yield_per, a server side cursor on postgres) and written out
+    a few hundred at a time, so a million positions never sit in memory and
+    the first bytes go out straight away. Clients without investments get one
+    row with the investment columns empty.
+
+    SSNs and contact details are never exported, only what the dashboards show.
+    On the website the investment columns are only filled in for the client the
+    advisor passed the security check for (investment_client_ids), and every
+    export needs the password again and is written to the audit log (app.py).
+
+    python book_export.py --manager 3 --format csv --output team.csv
+    python book_export.py --advisor 12 --format jsonl
+'''
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from sqlalchemy import select
+from database import SessionLocal
+from models import Employee, Client, Investment, Company
+
+# rows fetched from the database at a time
+FETCH_SIZE = 2000
+# rows written out together (one chunk of the response)
+WRITE_SIZE = 500
+# seconds a password re-check is good for on the website's export
+EXPORT_REAUTH_SECONDS = int(os.environ.get("EXPORT_REAUTH_SECONDS", "300"))
+
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+COLUMNS = [
+    "advisor_id", "advisor_first_name", "advisor_last_name",
+    "client_id", "client_first_name", "client_last_name",
+    "investment_id", "company_name", "date", "shares_purchased", "purchase_price_per_share",
+    "current_price", "market_value", "gain_loss_percent", "exit_date",
+]
+
+
+def book_query(advisor_id=None, manager_id=None, investment_client_ids=None):
+    '''
+        Every client of one advisor, or of every advisor under a manager, with
+        their investments, in advisor / client / investment order. When
+        investment_client_ids is given only those clients get their
+        investments, everyone else gets one row with the investment columns empty.
+    '''
+    investments_join = Investment.client_id == Client.client_id
+    if investment_client_ids is not None:
+        investments_join = investments_join & Client.client_id.in_(list(investment_client_ids))
+    stmt = (
+        select(
+            Employee.employee_id, Employee.first_name, Employee.last_name,
+            Client.client_id, Client.first_name, Client.last_name,
+            Investment.investment_id, Company.company_name, Investment.date, Investment.shares_purchased,
+            Investment.purchase_price_per_share, Investment.current_price, Investment.market_value,
+            Investment.gain_loss_percent, Investment.exit_date,
+        )
+        .select_from(Employee)
+        .join(Client, Client.advisor_id == Employee.employee_id)
+        .outerjoin(Investment, investments_join)
+        .outerjoin(Company, Company.company_id == Investment.company_id)
+        .order_by(Employee.employee_id, Client.client_id, Investment.investment_id)
+    )
+    if advisor_id is not None:
+        stmt = stmt.where(Employee.employee_id == advisor_id)
+    if manager_id is not None:
+        stmt = stmt.where(Employee.manager_id == manager_id)
+    return stmt
+
+
+def stream_rows(db, advisor_id=None, manager_id=None, investment_client_ids=None, fetch_size=FETCH_SIZE):
+    # yield_per streams the result instead of loading it all first
+    stmt = book_query(advisor_id, manager_id, investment_client_ids)
+    result = db.execute(stmt.execution_options(yield_per=fetch_size))
+    for partition in result.partitions():
+        yield from partition
+
+
+# -- formats (each gives back text chunks of up to WRITE_SIZE rows) --
+def _csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % WRITE_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_chunks(rows):
+    lines = []
+    for row in rows:
+        # dates become "YYYY-MM-DD"
+        lines.append(json.dumps(dict(zip(COLUMNS, row)), default=str))
+        if len(lines) == WRITE_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def export_chunks(db, export_format, advisor_id=None, manager_id=None, investment_client_ids=None,
+                  on_finish=None):
+    '''
+        The export as text chunks. on_finish(row_count, completed) is called
+        once the last chunk went out, or when the download stopped early.
+    '''
+    if export_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}, not {export_format!r}")
+    count = {"rows": 0}
+
+    def counted():
+        for row in stream_rows(db, advisor_id, manager_id, investment_client_ids):
+            count["rows"] += 1
+            yield row
+
+    chunks = _csv_chunks(counted()) if export_format == "csv" else _jsonl_chunks(counted())
+    if on_finish is None:
+        return chunks
+
+    def finishing():
+        completed = False
+        try:
+            yield from chunks
+            completed = True
+        finally:
+            on_finish(count["rows"], completed)
+    return finishing()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export an advisor's or a manager's book")
+    who = parser.add_mutually_exclusive_group(required=True)
+    who.add_argument("--advisor", type=int, help="employee_id of the advisor")
+    who.add_argument("--manager", type=int, help="employee_id of the manager (exports the whole team)")
+    parser.add_argument("--format", choices=list(FORMATS), default="csv")
+    parser.add_argument("--output", help="file to write (default: print it)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for chunk in export_chunks(db, args.format, advisor_id=args.advisor, manager_id=args.manager):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+        db.close()
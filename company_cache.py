@@ -0,0 +1,100 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - company_cache.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This company_cache.py file keeps a copy of the companies table in memory!
+    The companies table is tiny and pretty much never changes, but every
+    dashboard and the request form were asking the database for it over and
+    over. Now we load it once, hand out read only records, and throw the copy
+    away when it gets too old (TTL) or when someone changes a company.
+'''
+import os
+import time
+import threading
+from collections import namedtuple
+from itertools import chain
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from models import Company
+
+# the price feed changes these all the time, so they stay out of the cache
+# (read them from the database when you need a live price)
+_VOLATILE_COLUMNS = {"current_price", "price_updated_at"}
+_CACHED_COLUMNS = [column for column in Company.__table__.columns if column.key not in _VOLATILE_COLUMNS]
+
+# read only copy of a company row (same attribute names as the Company model)
+CompanyRecord = namedtuple("CompanyRecord", [column.key for column in _CACHED_COLUMNS])
+
+COMPANY_CACHE_TTL = float(os.environ.get("COMPANY_CACHE_TTL", "300"))  # seconds
+
+
+# -- company catalog --
+class CompanyCatalog:
+    def __init__(self, ttl=COMPANY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._by_id = None
+        self._dropdown = ()
+        self._loaded_at = 0.0
+
+    def _fresh(self):
+        return self._by_id is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _load(self, db):
+        if self._fresh():
+            return self._by_id, self._dropdown
+
+        # only one thread reloads at a time, the rest wait and use its copy
+        with self._lock:
+            if self._fresh():
+                return self._by_id, self._dropdown
+
+            generation = self._generation
+            rows = db.execute(select(*_CACHED_COLUMNS)).all()
+            by_id = {row.company_id: CompanyRecord(*row) for row in rows}
+            dropdown = tuple(sorted(by_id.values(), key=lambda c: (c.company_name or "").lower()))
+
+            # if a company changed while we were loading, don't keep this copy
+            if generation == self._generation:
+                self._by_id, self._dropdown = by_id, dropdown
+                self._loaded_at = time.monotonic()
+            return by_id, dropdown
+
+    def get(self, db, company_id):
+        return self._load(db)[0].get(company_id)
+
+    def get_many(self, db, company_ids):
+        by_id = self._load(db)[0]
+        return {company_id: by_id[company_id] for company_id in company_ids if company_id in by_id}
+
+    def dropdown(self, db):
+        # every company sorted by name, for the request form
+        return self._load(db)[1]
+
+    def invalidate(self):
+        self._generation += 1
+        self._by_id = None
+
+
+company_catalog = CompanyCatalog()
+
+
+# -- invalidate the catalog when a company is added / changed / deleted --
+@event.listens_for(Session, "after_flush")
+def _note_company_changes(db, flush_context):
+    changed = chain(db.new, db.dirty, db.deleted)
+    if any(isinstance(obj, Company) for obj in changed):
+        db.info["companies_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(db):
+    if db.info.pop("companies_changed", False):
+        company_catalog.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_on_rollback(db):
+    db.info.pop("companies_changed", None)
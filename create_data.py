@@ -9,17 +9,30 @@
     randomly, but there became a lot more overlap and this library seemed to solve that
     issue!
 '''
+import argparse
+import csv
+import io
+import multiprocessing
 import random
+import time
+from datetime import date, datetime, timedelta
 from faker import Faker
+from sqlalchemy import text
 from werkzeug.security import generate_password_hash
-from database import SessionLocal, engine
+from database import SessionLocal, get_engine
 from models import Base, Employee, Client, Investment, Company
-from snn_key import encrypt_ssn, ssn_hash
+from snn_key import encrypt_ssn, ssn_hash, encrypt_ssn_many, ssn_hash_many, current_key_version
+from ssn_lookup import split_duplicate_ssns
+from rollups import rebuild as rebuild_rollups
 import secrets
 import string
 
 fake = Faker()
 
+# every generated (non fixed) account uses this password, so only hash it once
+DEFAULT_PASSWORD = "password"
+DEFAULT_PASSWORD_HASH = generate_password_hash(DEFAULT_PASSWORD)
+
 
 # -- generate passwords --
 def generate_given_passwords():
@@ -62,7 +75,7 @@ def create_employees():
         last_name = fake.last_name()
         job_title = "Manager" if i < 2 else random.choice(["Financial Advisor", "Analyst"])
         work_email = f"{first_name.lower()}.{last_name.lower()}@fakeinvest.com"
-        password_hash = generate_password_hash("password")
+        password_hash = DEFAULT_PASSWORD_HASH
 
         # create the employee data
         emp = Employee(
@@ -156,7 +169,7 @@ def create_clients(employees, companies):
         first_name = fake.first_name_male() if gender == "Male" else fake.first_name_female()
         last_name = fake.last_name()
         email = fake.email()
-        password_hash = generate_password_hash("password")
+        password_hash = DEFAULT_PASSWORD_HASH
         advisor = random.choice(advisors)
         plain_ssn = fake.ssn()
 
@@ -271,6 +284,7 @@ def main():
     db = SessionLocal()
 
     # create new tables
+    engine = get_engine()
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
 
@@ -294,6 +308,9 @@ def main():
     # add all to the db!
     db.commit()
 
+    # add up the totals for every client, advisor and manager
+    rebuild_rollups(db)
+
     # printing for double check on success
     print("Database created successfully!")
     print("\nSample Login Credentials:")
@@ -301,5 +318,348 @@ def main():
     print("Advisor login: advisor@example.com, Password: "+str(fixed_advisor_pwd))
     print("Client login: client@example.com, Password: "+str(fixed_client_pwd))
 
+# -------------------------------------------------------------------------
+#   SCALE MODE
+#   python create_data.py --scale --clients 1000000 --investments 5000000
+#
+#   This makes datasets as big as production so we can test with real load.
+#   Rows are made in chunks on several processes (faker is slow!), then loaded
+#   with one bulk insert per chunk (or COPY on postgres). Everything comes from
+#   the seed, so the same seed always gives the same data.
+# -------------------------------------------------------------------------
+
+INDUSTRIES = ["Technology", "Finance", "Healthcare", "Energy", "Education",
+              "Retail", "Manufacturing", "Telecom", "Real Estate", "Transportation"]
+
+_worker_fake = None
+
+
+# -- random tools for one chunk (same seed + chunk = same rows) --
+def _chunk_tools(plan, table, start):
+    global _worker_fake
+    if _worker_fake is None:
+        _worker_fake = Faker()
+    rng = random.Random(f"{plan['seed']}-{table}-{start}")
+    _worker_fake.seed_instance(rng.getrandbits(64))
+    return rng, _worker_fake
+
+
+def _chunks(first_id, total, chunk_size):
+    for start in range(first_id, first_id + total, chunk_size):
+        yield start, min(chunk_size, first_id + total - start)
+
+
+def _advisor_for(client_id, plan):
+    # spread clients over the advisors without needing a lookup table
+    return plan["first_advisor"] + (client_id * 2654435761) % plan["advisors"]
+
+
+def _days_ago(rng, max_days):
+    return date.today() - timedelta(days=rng.randint(0, max_days))
+
+
+# -- row generators (these run in the worker processes) --
+def _gen_companies(spec):
+    start, count, plan = spec
+    rng, f = _chunk_tools(plan, "companies", start)
+    rows = []
+    for company_id in range(start, start + count):
+        name = f.company()
+        rows.append({
+            "company_id": company_id,
+            "company_name": name,
+            "abbreviation": "".join(ch for ch in name.upper() if ch.isalpha())[:4],
+            "isin": "US" + "".join(rng.choices(string.digits, k=10)),
+            "industry": rng.choice(INDUSTRIES),
+            "country": f.country_code(),
+            "company_type": rng.choice(["Public", "Private"]),
+            "market_cap": round(rng.uniform(1e8, 5e11), 2),
+            "revenue": round(rng.uniform(1e7, 1e11), 2),
+            "earnings_per_share": round(rng.uniform(-5, 25), 2),
+            "target_price": round(rng.uniform(10, 600), 2),
+        })
+    return rows
+
+
+def _gen_employees(spec):
+    start, count, plan = spec
+    rng, f = _chunk_tools(plan, "employees", start)
+    rows = []
+    for employee_id in range(start, start + count):
+        is_manager = employee_id < plan["first_advisor"]
+        gender = rng.choice(["Male", "Female"])
+        first_name = f.first_name_male() if gender == "Male" else f.first_name_female()
+        last_name = f.last_name()
+        rows.append({
+            "employee_id": employee_id,
+            "first_name": first_name,
+            "last_name": last_name,
+            "date_of_birth": _days_ago(rng, 40 * 365) - timedelta(days=25 * 365),
+            "gender": gender,
+            "work_email": f"{first_name.lower()}.{last_name.lower()}.{employee_id}@fakeinvest.com",
+            "password_hash": plan["password_hash"],
+            "phone_number": f.phone_number(),
+            "address": f.address(),
+            "start_date": _days_ago(rng, 10 * 365),
+            "job_title": "Manager" if is_manager else rng.choice(["Financial Advisor", "Analyst"]),
+            "base_salary": rng.randint(60000, 150000),
+            "commission_rate": round(rng.uniform(0.01, 0.05), 2),
+            "license_number": "".join(rng.choices(string.digits, k=6)),
+            "license_expiry_date": date.today() + timedelta(days=rng.randint(365, 5 * 365)),
+            "manager_id": None if is_manager else rng.randint(1, plan["managers"]),
+        })
+    return rows
+
+
+def _gen_clients(spec):
+    start, count, plan = spec
+    rng, f = _chunk_tools(plan, "clients", start)
+    rows = []
+    plain_ssns = []
+    for client_id in range(start, start + count):
+        gender = rng.choice(["Male", "Female"])
+        first_name = f.first_name_male() if gender == "Male" else f.first_name_female()
+        last_name = f.last_name()
+        plain_ssns.append(f.ssn())
+        rows.append({
+            "client_id": client_id,
+            "first_name": first_name,
+            "last_name": last_name,
+            "date_of_birth": _days_ago(rng, 55 * 365) - timedelta(days=25 * 365),
+            "gender": gender,
+            "marital_status": rng.choice(["Single", "Married", "Divorced", "Widowed"]),
+            "email": f"{first_name.lower()}.{last_name.lower()}.{client_id}@example.com",
+            "password_hash": plan["password_hash"],
+            "phone_number": f.phone_number(),
+            "address": f.address(),
+            "employment_status": rng.choice(["Employed", "Self-employed", "Retired"]),
+            "annual_income": rng.randint(40000, 250000),
+            "risk_tolerance": rng.choice(["Conservative", "Moderate", "Aggressive"]),
+            "advisor_id": _advisor_for(client_id, plan),
+        })
+
+    # encrypt and hash the whole chunk at once
+    for row, encrypted, hashed in zip(rows, encrypt_ssn_many(plain_ssns), ssn_hash_many(plain_ssns)):
+        row["encrypted_ssn"] = encrypted
+        row["ssn_hash"] = hashed
+    return rows
+
+
+def _gen_investments(spec):
+    start, count, plan = spec
+    rng, f = _chunk_tools(plan, "investments", start)
+    rows = []
+    for investment_id in range(start, start + count):
+        client_id = rng.randint(1, plan["clients"])
+        shares = rng.randint(10, 500)
+        purchase_price = round(rng.uniform(10, 500), 2)
+        current_price = round(rng.uniform(10, 600), 2)
+        rows.append({
+            "investment_id": investment_id,
+            "client_id": client_id,
+            "advisor_id": _advisor_for(client_id, plan),
+            "company_id": rng.randint(1, plan["companies"]),
+            "date": _days_ago(rng, 2 * 365),
+            "shares_purchased": shares,
+            "purchase_price_per_share": purchase_price,
+            "broker_fees": round(rng.uniform(5, 50), 2),
+            "current_price": current_price,
+            "market_value": round(shares * current_price, 2),
+            "gain_loss_percent": round((current_price - purchase_price) / purchase_price * 100, 2),
+            "exit_date": None,
+        })
+    return rows
+
+
+def _gen_requests(spec):
+    start, count, plan = spec
+    rng, f = _chunk_tools(plan, "investment_requests", start)
+    rows = []
+    now = datetime.utcnow()
+    for request_id in range(start, start + count):
+        client_id = rng.randint(1, plan["clients"])
+        rows.append({
+            "request_id": request_id,
+            "client_id": client_id,
+            "advisor_id": _advisor_for(client_id, plan),
+            "company_id": rng.randint(1, plan["companies"]),
+            "shares": rng.randint(1, 200),
+            "purchase_price_per_share": round(rng.uniform(10, 500), 2),
+            "status": rng.choices(["Pending", "Approved", "Rejected"], weights=[2, 6, 1])[0],
+            "created_at": now - timedelta(seconds=rng.randint(0, 90 * 24 * 3600)),
+        })
+        rows[-1]["updated_at"] = rows[-1]["created_at"]
+    return rows
+
+
+# -- SSN duplicate check for clients --
+def _replacement_ssn(plan, client_id, attempt):
+    rng = random.Random(f"{plan['seed']}-ssn-{client_id}-{attempt}")
+    area = rng.choice([n for n in range(1, 900) if n != 666])
+    return f"{area:03d}-{rng.randint(1, 99):02d}-{rng.randint(1, 9999):04d}"
+
+
+def _dedupe_clients(conn, rows, plan):
+    '''
+        Faker can hand out the same SSN twice, and ssn_hash is unique, so one
+        repeat would fail the whole chunk. Clients with a repeated SSN get a new
+        one (we keep their client_id since investments point at it).
+    '''
+    seen = set()
+    unique, duplicates = split_duplicate_ssns(conn, rows, seen)
+    replaced = len(duplicates)
+    attempt = 0
+    while duplicates:
+        attempt += 1
+        new_ssns = [_replacement_ssn(plan, row["client_id"], attempt) for row in duplicates]
+        for row, encrypted, hashed in zip(duplicates, encrypt_ssn_many(new_ssns), ssn_hash_many(new_ssns)):
+            row["encrypted_ssn"] = encrypted
+            row["ssn_hash"] = hashed
+        _, duplicates = split_duplicate_ssns(conn, duplicates, seen)
+    return rows, replaced
+
+
+# -- loading rows into the database --
+def _copy_rows(conn, table, rows):
+    # postgres COPY is the fastest way to load lots of rows
+    columns = [column.name for column in table.columns]
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(["" if row.get(col) is None else row.get(col) for col in columns])
+    buf.seek(0)
+    with conn.connection.driver_connection.cursor() as cur:
+        cur.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def _load_table(pool, table, generator, specs, use_copy, plan):
+    started = time.perf_counter()
+    total = 0
+    replaced = 0
+    chunks = pool.imap(generator, specs) if pool else map(generator, specs)
+    for rows in chunks:
+        with get_engine().connect() as conn:
+            if table.name == "clients":
+                rows, n = _dedupe_clients(conn, rows, plan)
+                replaced += n
+            if use_copy:
+                _copy_rows(conn, table, rows)
+            else:
+                conn.execute(table.insert(), rows)
+            conn.commit()
+        total += len(rows)
+
+    elapsed = time.perf_counter() - started
+    rate = total / elapsed if elapsed else 0
+    print(f"  {table.name:<20} {total:>10,} rows  {elapsed:8.2f}s  {rate:12,.0f} rows/sec")
+    if replaced:
+        print(f"  {'':<20} ({replaced:,} repeated SSNs were replaced)")
+    return {"table": table.name, "rows": total, "seconds": elapsed, "rows_per_sec": rate}
+
+
+def _fix_sequences():
+    # we gave every row its own id, so move the postgres id counters past them
+    engine = get_engine()
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for table, key in [("companies", "company_id"), ("employees", "employee_id"),
+                           ("clients", "client_id"), ("investments", "investment_id"),
+                           ("investment_requests", "request_id")]:
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', '{key}'), "
+                f"COALESCE((SELECT MAX({key}) FROM {table}), 0) + 1, false)"
+            ))
+
+
+def create_scale_data(companies, employees, clients, investments, seed=622,
+                      chunk_size=5000, workers=None, use_copy=None, requests=0):
+    if employees < 2:
+        raise ValueError("Need at least 2 employees (a manager and an advisor)")
+
+    managers = max(1, employees // 10)
+    plan = {
+        "seed": seed,
+        "companies": companies,
+        "managers": managers,
+        "first_advisor": managers + 1,
+        "advisors": employees - managers,
+        "clients": clients,
+        "password_hash": DEFAULT_PASSWORD_HASH,
+    }
+    engine = get_engine()
+    if use_copy is None:
+        use_copy = engine.dialect.name == "postgresql"
+    workers = workers or multiprocessing.cpu_count()
+
+    # create new tables
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    print(f"Generating data with seed {seed} on {workers} worker(s)"
+          f" using {'COPY' if use_copy else 'bulk INSERT'}:")
+    tables = Base.metadata.tables
+    steps = [
+        ("companies", _gen_companies, companies),
+        ("employees", _gen_employees, employees),
+        ("clients", _gen_clients, clients),
+        ("investments", _gen_investments, investments),
+        ("investment_requests", _gen_requests, requests),
+    ]
+
+    # load (or generate) the SSN key before the workers start, so they all
+    # inherit the same one instead of each making its own temporary key
+    current_key_version()
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    report = []
+    try:
+        for name, generator, count in steps:
+            if name == "employees":
+                # managers first so every advisor's manager already exists
+                specs = [(start, n, plan) for start, n in _chunks(1, managers, chunk_size)]
+                specs += [(start, n, plan) for start, n in _chunks(managers + 1, count - managers, chunk_size)]
+            else:
+                specs = [(start, n, plan) for start, n in _chunks(1, count, chunk_size)]
+            report.append(_load_table(pool, tables[name], generator, specs, use_copy, plan))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    _fix_sequences()
+
+    # add up the totals for every client, advisor and manager
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        rebuild_rollups(db)
+    finally:
+        db.close()
+    print(f"  {'rollups':<20} rebuilt in {time.perf_counter() - started:.2f}s")
+    print(f"Every account's password is: {DEFAULT_PASSWORD}")
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Create the data for the fake investing database")
+    parser.add_argument("--scale", action="store_true", help="make a big generated dataset instead of the demo one")
+    parser.add_argument("--companies", type=int, default=500)
+    parser.add_argument("--employees", type=int, default=400)
+    parser.add_argument("--clients", type=int, default=100000)
+    parser.add_argument("--investments", type=int, default=500000)
+    parser.add_argument("--requests", type=int, default=0, help="investment requests to make")
+    parser.add_argument("--seed", type=int, default=622)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of CPUs)")
+    parser.add_argument("--no-copy", action="store_true", help="use bulk INSERT even on postgres")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.scale:
+        create_scale_data(args.companies, args.employees, args.clients, args.investments,
+                          seed=args.seed, chunk_size=args.chunk_size, workers=args.workers,
+                          use_copy=False if args.no_copy else None, requests=args.requests)
+    else:
+        main()
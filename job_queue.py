@@ -0,0 +1,245 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - job_queue.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This job_queue.py file is a work queue that lives in the database! When a
+    request is approved the web page only flips its status and adds a row to
+    investment_jobs, then worker.py makes the actual investment in the
+    background (priced with the company's latest price).
+
+    Approving is a conditional UPDATE (only a Pending request can become
+    Approved), and every request can only ever have one job (unique
+    request_id), so clicking approve twice can't make two investments. Workers
+    claim jobs with SELECT ... FOR UPDATE SKIP LOCKED on postgres so many can
+    run at once without waiting on each other. sqlite doesn't have that, so
+    there a worker picks some jobs and a conditional UPDATE decides who got
+    them. A job that fails is tried again later (waiting longer every time)
+    and after JOB_MAX_ATTEMPTS it is marked failed.
+'''
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, insert, func, or_, and_
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Investment, InvestmentRequest, InvestmentJob, Company
+from revaluation import value_position
+from rollups import record_new_investments
+from valuation_history import record_valuations
+
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "2"))  # seconds, doubled every attempt
+LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "300"))  # a running job older than this is taken back
+
+# statuses a request can be approved from
+APPROVABLE = ("Pending", "AdvisorCreated")
+
+
+class JobError(Exception):
+    # a problem trying again won't fix (the job fails straight away)
+    pass
+
+
+# -- adding jobs --
+def enqueue(db, request_ids):
+    '''
+        Adds a job for each request. A request that already has a job is
+        skipped, so this is safe to call twice. This doesn't commit.
+    '''
+    now = datetime.utcnow()
+    rows = [
+        {"request_id": request_id, "status": "queued", "attempts": 0, "run_after": now,
+         "created_at": now, "updated_at": now}
+        for request_id in dict.fromkeys(request_ids)
+    ]
+    if not rows:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        db.execute(dialect_insert(InvestmentJob).on_conflict_do_nothing(index_elements=["request_id"]), rows)
+        return
+
+    # any other database: leave out the ones that are already there
+    existing = set(db.scalars(
+        select(InvestmentJob.request_id).where(InvestmentJob.request_id.in_([r["request_id"] for r in rows]))
+    ))
+    rows = [row for row in rows if row["request_id"] not in existing]
+    if rows:
+        db.execute(insert(InvestmentJob), rows)
+
+
+def approve_and_enqueue(db, request_id, advisor_id=None, client_id=None, from_statuses=APPROVABLE):
+    '''
+        Moves one request to Approved and queues its investment, but only if it
+        is still in from_statuses (and belongs to the advisor / client when
+        given). Returns False if someone else got there first. This doesn't commit.
+    '''
+    conditions = [InvestmentRequest.request_id == request_id, InvestmentRequest.status.in_(from_statuses)]
+    if advisor_id is not None:
+        conditions.append(InvestmentRequest.advisor_id == advisor_id)
+    if client_id is not None:
+        conditions.append(InvestmentRequest.client_id == client_id)
+    result = db.execute(
+        update(InvestmentRequest).where(*conditions).values(status="Approved")
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return False
+    enqueue(db, [request_id])
+    return True
+
+
+# -- claiming jobs --
+def claim_jobs(db, worker_id, limit):
+    '''
+        Takes up to limit jobs that are ready to run for this worker and
+        commits, so other workers see them as taken. Jobs whose worker went
+        away (running for longer than LEASE_SECONDS) can be taken again.
+        Returns the job ids.
+    '''
+    now = datetime.utcnow()
+    ready = and_(
+        or_(
+            InvestmentJob.status == "queued",
+            and_(InvestmentJob.status == "running",
+                 InvestmentJob.locked_at < now - timedelta(seconds=LEASE_SECONDS)),
+        ),
+        InvestmentJob.run_after <= now,
+    )
+    pick = select(InvestmentJob.job_id).where(ready).order_by(InvestmentJob.job_id).limit(limit)
+    if db.get_bind().dialect.name == "postgresql":
+        # rows another worker has locked are skipped instead of waited for
+        pick = pick.with_for_update(skip_locked=True)
+    job_ids = list(db.scalars(pick))
+    if not job_ids:
+        db.commit()
+        return []
+
+    # only takes the jobs that are still free (matters when there is no SKIP LOCKED)
+    stmt = (
+        update(InvestmentJob)
+        .where(InvestmentJob.job_id.in_(job_ids), ready)
+        .values(status="running", locked_by=worker_id, locked_at=now, attempts=InvestmentJob.attempts + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if db.get_bind().dialect.update_returning:
+        claimed = list(db.scalars(stmt.returning(InvestmentJob.job_id)))
+    else:
+        db.execute(stmt)
+        claimed = list(db.scalars(
+            select(InvestmentJob.job_id)
+            .where(InvestmentJob.job_id.in_(job_ids), InvestmentJob.locked_by == worker_id,
+                   InvestmentJob.locked_at == now)
+        ))
+    db.commit()
+    return sorted(claimed)
+
+
+# -- running a job --
+def price_investment(req, current_price):
+    '''
+        The investment for an approved request. It is bought at the requested
+        price per share and valued at the company's latest price (or the
+        purchase price if the company has never had one).
+    '''
+    if not req.shares or req.purchase_price_per_share is None:
+        raise JobError(f"request {req.request_id} has no shares or price")
+    current_price = current_price if current_price is not None else req.purchase_price_per_share
+    market_value, gain_loss_percent = value_position(req.shares, req.purchase_price_per_share, current_price)
+    return Investment(
+        client_id=req.client_id,
+        advisor_id=req.advisor_id,
+        company_id=req.company_id,
+        date=datetime.utcnow().date(),
+        shares_purchased=req.shares,
+        purchase_price_per_share=req.purchase_price_per_share,
+        current_price=current_price,
+        market_value=market_value,
+        gain_loss_percent=gain_loss_percent,
+    )
+
+
+def run_job(db, job_id, worker_id):
+    '''
+        Makes the investment for one claimed job, all in one transaction with
+        marking the job done, so a job either fully happens or not at all.
+        Returns "done", "retry", "failed" or "lost" (another worker has it now).
+    '''
+    try:
+        job = db.get(InvestmentJob, job_id)
+        if job is None or job.locked_by != worker_id:
+            db.rollback()
+            return "lost"
+
+        req = db.get(InvestmentRequest, job.request_id)
+        if req is None:
+            raise JobError(f"request {job.request_id} doesn't exist")
+        if req.status != "Approved":
+            raise JobError(f"request {req.request_id} is {req.status}, not Approved")
+
+        current_price = db.scalar(select(Company.current_price).where(Company.company_id == req.company_id))
+        investment = price_investment(req, current_price)
+        db.add(investment)
+        db.flush()
+        record_new_investments(db, [investment])
+        record_valuations(db, [{
+            "investment_id": investment.investment_id, "client_id": investment.client_id,
+            "current_price": investment.current_price, "market_value": investment.market_value,
+        }])
+
+        # only finish it if it is still ours (a worker that was too slow lost it)
+        finished = db.execute(
+            update(InvestmentJob)
+            .where(InvestmentJob.job_id == job_id, InvestmentJob.status == "running",
+                   InvestmentJob.locked_by == worker_id)
+            .values(status="done", investment_id=investment.investment_id, last_error=None,
+                    locked_by=None, locked_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        if finished.rowcount != 1:
+            db.rollback()
+            return "lost"
+        db.commit()
+        return "done"
+    except Exception as e:
+        db.rollback()
+        return _record_failure(db, job_id, worker_id, e)
+
+
+def _record_failure(db, job_id, worker_id, error):
+    job = db.get(InvestmentJob, job_id)
+    if job is None or job.locked_by != worker_id:
+        db.rollback()
+        return "lost"
+
+    job.last_error = f"{type(error).__name__}: {error}"[:500]
+    job.locked_by = None
+    job.locked_at = None
+    if isinstance(error, JobError) or job.attempts >= MAX_ATTEMPTS:
+        job.status = "failed"
+        db.execute(
+            update(InvestmentRequest)
+            .where(InvestmentRequest.request_id == job.request_id, InvestmentRequest.status == "Approved")
+            .values(status="Failed")
+            .execution_options(synchronize_session=False)
+        )
+        outcome = "failed"
+    else:
+        job.status = "queued"
+        job.run_after = datetime.utcnow() + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        outcome = "retry"
+    db.commit()
+    return outcome
+
+
+# -- how the queue is doing --
+def queue_stats(db):
+    counts = dict(db.execute(select(InvestmentJob.status, func.count()).group_by(InvestmentJob.status)).all())
+    oldest = db.scalar(select(func.min(InvestmentJob.created_at)).where(InvestmentJob.status == "queued"))
+    return {
+        "queued": counts.get("queued", 0),
+        "running": counts.get("running", 0),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "oldest_queued_sec": (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0,
+    }
@@ -0,0 +1,195 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - key_rotation.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This key_rotation.py file moves every client's SSN onto the current key
+    (see the key versions in snn_key.py)! It goes through the clients table in
+    order of client_id a chunk at a time: read the chunk (streamed from the
+    database), decrypt it with whatever key it was written with, encrypt and
+    hash it again with the new key, and write it back with one bulk UPDATE.
+    Every chunk is its own short transaction together with the checkpoint in
+    key_rotations, so nothing stays locked for long and a rotation that is
+    stopped (or crashes) carries on after the last chunk it finished.
+
+    The crypto can be spread over a few processes with --processes, while this
+    process keeps reading and writing chunks in order.
+
+    SECRET_KEY_V2=<new base64 key> python key_rotation.py --chunk 5000 --processes 4
+    python key_rotation.py --status
+'''
+import argparse
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import select, update, bindparam
+from database import SessionLocal
+from models import Client, KeyRotation
+from snn_key import (current_key_version, payload_key_version, decrypt_ssn_many,
+                     encrypt_ssn_many, ssn_hash_many)
+
+DEFAULT_CHUNK = 2000
+
+_clients = Client.__table__
+
+# only writes the row if its SSN didn't change since we read it (the website
+# already writes new SSNs with the new key, so a changed row is done anyway)
+_REWRITE = (
+    update(_clients)
+    .where(_clients.c.client_id == bindparam("b_client_id"), _clients.c.encrypted_ssn == bindparam("b_old"))
+    .values(encrypted_ssn=bindparam("b_encrypted"), ssn_hash=bindparam("b_hash"))
+)
+
+
+# -- one chunk --
+def reencrypt_chunk(rows, to_version):
+    '''
+        rows are (client_id, encrypted_ssn). Returns the UPDATE parameters for
+        the rows that aren't on to_version yet, and how many already were.
+    '''
+    todo = [(client_id, payload) for client_id, payload in rows if payload_key_version(payload) != to_version]
+    plain_ssns = decrypt_ssn_many([payload for _, payload in todo])
+    encrypted = encrypt_ssn_many(plain_ssns, version=to_version)
+    hashed = ssn_hash_many(plain_ssns, version=to_version)
+    updates = [
+        {"b_client_id": client_id, "b_old": payload, "b_encrypted": new_payload, "b_hash": new_hash}
+        for (client_id, payload), new_payload, new_hash in zip(todo, encrypted, hashed)
+    ]
+    return updates, len(rows) - len(todo)
+
+
+def _read_chunk(db, after, chunk_size):
+    # keyed on client_id, so every chunk is a quick index range scan (no OFFSET)
+    stmt = (
+        select(_clients.c.client_id, _clients.c.encrypted_ssn)
+        .where(_clients.c.client_id > after)
+        .order_by(_clients.c.client_id)
+        .limit(chunk_size)
+        .execution_options(stream_results=True, yield_per=chunk_size)  # server side cursor on postgres
+    )
+    return [tuple(row) for row in db.execute(stmt)]
+
+
+def _write_chunk(db, to_version, last_client_id, updates, skipped):
+    '''
+        Writes one chunk and moves the checkpoint past it in the same
+        transaction. Returns how many rows were rewritten.
+    '''
+    rotated = 0
+    if updates:
+        result = db.execute(_REWRITE, updates)
+        # not every driver can count the rows of a bulk UPDATE
+        rotated = result.rowcount if db.get_bind().dialect.supports_sane_multi_rowcount else len(updates)
+    db.execute(
+        update(KeyRotation)
+        .where(KeyRotation.to_version == to_version)
+        .values(last_client_id=last_client_id,
+                rows_rotated=KeyRotation.rows_rotated + rotated,
+                rows_skipped=KeyRotation.rows_skipped + skipped + len(updates) - rotated)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return rotated
+
+
+# -- checkpoint --
+def _start(db, to_version, restart):
+    state = db.get(KeyRotation, to_version)
+    if state is None:
+        state = KeyRotation(to_version=to_version, last_client_id=0, rows_rotated=0, rows_skipped=0)
+        db.add(state)
+    elif restart:
+        state.last_client_id = 0
+        state.rows_rotated = 0
+        state.rows_skipped = 0
+        state.started_at = datetime.utcnow()
+        state.finished_at = None
+    db.commit()
+    return state.last_client_id
+
+
+def status(db):
+    return [
+        {"to_version": state.to_version, "last_client_id": state.last_client_id,
+         "rows_rotated": state.rows_rotated, "rows_skipped": state.rows_skipped,
+         "started_at": str(state.started_at), "finished_at": str(state.finished_at) if state.finished_at else None}
+        for state in db.scalars(select(KeyRotation).order_by(KeyRotation.to_version))
+    ]
+
+
+# -- the whole table --
+def rotate(chunk_size=DEFAULT_CHUNK, processes=None, restart=False):
+    '''
+        Moves every client onto the current key version, carrying on from
+        the checkpoint. Returns what it did and how fast.
+    '''
+    to_version = current_key_version()
+    pool = ProcessPoolExecutor(max_workers=processes) if processes and processes > 1 else None
+    # a couple of chunks per process waiting, so the processes never run dry
+    in_flight = processes * 2 if pool else 1
+    counts = {"rotated": 0, "skipped": 0, "chunks": 0}
+    db = SessionLocal()
+    started = time.perf_counter()
+    try:
+        after = resumed_from = _start(db, to_version, restart)
+        pending = deque()
+        more = True
+        while True:
+            while more and len(pending) < in_flight:
+                rows = _read_chunk(db, after, chunk_size)
+                if not rows:
+                    more = False
+                    break
+                after = rows[-1][0]
+                job = pool.submit(reencrypt_chunk, rows, to_version) if pool else reencrypt_chunk(rows, to_version)
+                pending.append((after, len(rows), job))
+            if not pending:
+                break
+
+            # chunks are written in order, so the checkpoint only moves past finished ones
+            last_client_id, row_count, job = pending.popleft()
+            updates, skipped = job.result() if pool else job
+            rotated = _write_chunk(db, to_version, last_client_id, updates, skipped)
+            counts["rotated"] += rotated
+            counts["skipped"] += row_count - rotated
+            counts["chunks"] += 1
+
+        db.execute(
+            update(KeyRotation).where(KeyRotation.to_version == to_version)
+            .values(finished_at=datetime.utcnow()).execution_options(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+    seconds = time.perf_counter() - started
+    rows = counts["rotated"] + counts["skipped"]
+    return {
+        "to_version": to_version,
+        "resumed_from_client_id": resumed_from,
+        **counts,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds, 1) if seconds else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-encrypt every client's SSN with the current key")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK, help="clients per chunk (and per transaction)")
+    parser.add_argument("--processes", type=int, default=1, help="processes doing the encryption")
+    parser.add_argument("--restart", action="store_true", help="start from the first client instead of the checkpoint")
+    parser.add_argument("--status", action="store_true", help="only show the checkpoints")
+    args = parser.parse_args()
+
+    if args.status:
+        db = SessionLocal()
+        try:
+            print(json.dumps({"current_version": current_key_version(), "rotations": status(db)}, indent=2))
+        finally:
+            db.close()
+    else:
+        print(json.dumps(rotate(args.chunk, args.processes, args.restart), indent=2))
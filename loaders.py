@@ -0,0 +1,198 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - loaders.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This loaders.py file holds the data loaders for our dashboards! Before this,
+    each dashboard walked the employees, clients and investments one at a time
+    and asked the database for every row separately, which is a LOT of trips to
+    the cloud database once a manager has a big team. These loaders get what a
+    page needs in a fixed number of queries no matter how many employees or
+    clients there are, and big lists are split into pages.
+
+    The loaders only select the columns the templates show and hand back small
+    read only rows (named tuples) instead of full ORM objects, so a dashboard
+    never loads SSNs, password hashes or addresses, nothing goes into the
+    session's identity map, and there is nothing that could be changed and
+    committed by accident.
+'''
+from collections import namedtuple
+from sqlalchemy import select, func
+from models import Employee, Client, Investment, InvestmentRequest
+from company_cache import company_catalog
+
+# how much of a manager's team goes on one page
+EMPLOYEE_PAGE_SIZE = 20
+CLIENTS_PER_EMPLOYEE = 25
+
+
+# -- read only rows (the columns each template uses) --
+EmployeeRow = namedtuple("EmployeeRow", ["employee_id", "first_name", "last_name"])
+ClientRow = namedtuple("ClientRow", ["client_id", "first_name", "last_name", "advisor_id"])
+InvestmentRow = namedtuple("InvestmentRow", [
+    "investment_id", "client_id", "company_id", "shares_purchased", "purchase_price_per_share",
+    "current_price", "market_value", "gain_loss_percent", "company_name",
+])
+RequestRow = namedtuple("RequestRow", [
+    "request_id", "client_id", "company_id", "shares", "purchase_price_per_share", "status",
+    "created_at", "client_first_name", "client_last_name", "company_name",
+])
+
+_EMPLOYEE_COLUMNS = (Employee.employee_id, Employee.first_name, Employee.last_name)
+_CLIENT_COLUMNS = (Client.client_id, Client.first_name, Client.last_name, Client.advisor_id)
+_INVESTMENT_COLUMNS = (
+    Investment.investment_id, Investment.client_id, Investment.company_id, Investment.shares_purchased,
+    Investment.purchase_price_per_share, Investment.current_price, Investment.market_value,
+    Investment.gain_loss_percent,
+)
+_REQUEST_COLUMNS = (
+    InvestmentRequest.request_id, InvestmentRequest.client_id, InvestmentRequest.company_id,
+    InvestmentRequest.shares, InvestmentRequest.purchase_price_per_share, InvestmentRequest.status,
+    InvestmentRequest.created_at, Client.first_name, Client.last_name,
+)
+
+
+def _company_names(db, rows):
+    # company names come from the in memory company catalog, not the database
+    companies = company_catalog.get_many(db, {row.company_id for row in rows} - {None})
+    return {company_id: company.company_name for company_id, company in companies.items()}
+
+
+# -- single rows --
+def load_employee(db, employee_id):
+    row = db.execute(select(*_EMPLOYEE_COLUMNS).where(Employee.employee_id == employee_id)).first()
+    return EmployeeRow(*row) if row else None
+
+
+def load_client(db, client_id):
+    row = db.execute(select(*_CLIENT_COLUMNS).where(Client.client_id == client_id)).first()
+    return ClientRow(*row) if row else None
+
+
+# -- load investments (with company names) for one client --
+def load_client_investments(db, client_id):
+    rows = db.execute(
+        select(*_INVESTMENT_COLUMNS).where(Investment.client_id == client_id).order_by(Investment.investment_id)
+    ).all()
+    names = _company_names(db, rows)
+    return [InvestmentRow(*row, names.get(row.company_id)) for row in rows]
+
+
+# -- an advisor's request queue, newest first --
+def load_advisor_requests(db, advisor_id):
+    rows = db.execute(
+        select(*_REQUEST_COLUMNS)
+        .outerjoin(Client, Client.client_id == InvestmentRequest.client_id)
+        .where(InvestmentRequest.advisor_id == advisor_id)
+        .order_by(InvestmentRequest.created_at.desc())
+    ).all()
+    names = _company_names(db, rows)
+    return [RequestRow(*row, names.get(row.company_id)) for row in rows]
+
+
+# -- every client of an advisor --
+def load_advisor_clients(db, advisor_id):
+    return [
+        ClientRow(*row)
+        for row in db.execute(
+            select(*_CLIENT_COLUMNS).where(Client.advisor_id == advisor_id).order_by(Client.client_id)
+        )
+    ]
+
+
+# -- keyset paging for a list of clients --
+def load_advisor_clients_page(db, advisor_id, after_client_id=0, limit=CLIENTS_PER_EMPLOYEE):
+    '''
+        One page of an advisor's clients ordered by client_id, starting after
+        after_client_id. Returns (clients, next_after) where next_after is the
+        value to ask for the next page with (None on the last page).
+    '''
+    clients = [
+        ClientRow(*row)
+        for row in db.execute(
+            select(*_CLIENT_COLUMNS)
+            .where(Client.advisor_id == advisor_id, Client.client_id > after_client_id)
+            .order_by(Client.client_id)
+            .limit(limit + 1)
+        )
+    ]
+    if len(clients) > limit:
+        return clients[:limit], clients[limit - 1].client_id
+    return clients, None
+
+
+def _first_clients_per_advisor(db, advisor_ids, limit):
+    # the first limit+1 clients of every advisor in one query (window function)
+    if not advisor_ids:
+        return {}
+    row_number = func.row_number().over(
+        partition_by=Client.advisor_id, order_by=Client.client_id
+    ).label("row_number")
+    numbered = (
+        select(*_CLIENT_COLUMNS, row_number)
+        .where(Client.advisor_id.in_(advisor_ids))
+        .subquery()
+    )
+    rows = db.execute(
+        select(numbered.c.client_id, numbered.c.first_name, numbered.c.last_name, numbered.c.advisor_id)
+        .where(numbered.c.row_number <= limit + 1)
+        .order_by(numbered.c.advisor_id, numbered.c.client_id)
+    )
+    by_advisor = {}
+    for row in rows:
+        client = ClientRow(*row)
+        by_advisor.setdefault(client.advisor_id, []).append(client)
+    return by_advisor
+
+
+# -- manager hierarchy --
+def load_manager_hierarchy(db, manager_id, verified_client_id=None, after_employee_id=0,
+                           page_size=EMPLOYEE_PAGE_SIZE, clients_per_employee=CLIENTS_PER_EMPLOYEE):
+    '''
+        Builds one page of the employee -> clients -> investments structure for
+        the manager dashboard. Employees are paged by employee_id (keyset, so
+        page 500 costs the same as page 1) and only the first few clients of
+        each employee are loaded, the rest come from the JSON endpoints.
+        This always takes at most 3 queries: one for the employees, one for
+        their first clients, and one for the investments of the verified
+        client (companies come from the company catalog).
+        Returns (employees, hierarchy, next_after_employee_id).
+    '''
+    employees = [
+        EmployeeRow(*row)
+        for row in db.execute(
+            select(*_EMPLOYEE_COLUMNS)
+            .where(Employee.manager_id == manager_id, Employee.employee_id > after_employee_id)
+            .order_by(Employee.employee_id)
+            .limit(page_size + 1)
+        )
+    ]
+    next_after = None
+    if len(employees) > page_size:
+        employees = employees[:page_size]
+        next_after = employees[-1].employee_id
+
+    clients_by_advisor = _first_clients_per_advisor(
+        db, [employee.employee_id for employee in employees], clients_per_employee
+    )
+
+    # create the table information for the employees and their clients
+    hierarchy = []
+    for employee in employees:
+        emp_clients = clients_by_advisor.get(employee.employee_id, [])
+        more_after = None
+        if len(emp_clients) > clients_per_employee:
+            emp_clients = emp_clients[:clients_per_employee]
+            more_after = emp_clients[-1].client_id
+
+        clients_list = []
+        for client in emp_clients:
+            # only the verified client gets to show their investments
+            if verified_client_id == client.client_id:
+                c_investments = load_client_investments(db, client.client_id)
+            else:
+                c_investments = []
+            clients_list.append({"client": client, "investments": c_investments})
+        hierarchy.append({"employee": employee, "clients": clients_list, "more_clients_after": more_after})
+
+    return employees, hierarchy, next_after
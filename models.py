@@ -7,7 +7,7 @@
     (aka models or objects :) )for the program! This will create the employee,
     client, company, and investment.
 '''
-from sqlalchemy import Column, Integer, String, Float, Date, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Float, Date, ForeignKey, DateTime, Index, text, event, DDL
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
 
@@ -32,7 +32,7 @@ class Employee(Base):
     commission_rate = Column(Float)
     license_number = Column(String)
     license_expiry_date = Column(Date)
-    manager_id = Column(Integer, ForeignKey("employees.employee_id"), nullable=True)  # Managers can be null
+    manager_id = Column(Integer, ForeignKey("employees.employee_id"), nullable=True, index=True)  # Managers can be null
 
     # create relationships
     clients = relationship("Client", back_populates="advisor")
@@ -57,7 +57,7 @@ class Client(Base):
     employment_status = Column(String)
     annual_income = Column(Float)
     risk_tolerance = Column(String)
-    advisor_id = Column(Integer, ForeignKey("employees.employee_id"))
+    advisor_id = Column(Integer, ForeignKey("employees.employee_id"), index=True)
 
     # Relationships
     advisor = relationship("Employee", back_populates="clients")
@@ -69,9 +69,9 @@ class Investment(Base):
     __tablename__ = "investments"
 
     investment_id = Column(Integer, primary_key=True, index=True)
-    client_id = Column(Integer, ForeignKey("clients.client_id"))
+    client_id = Column(Integer, ForeignKey("clients.client_id"), index=True)
     advisor_id = Column(Integer, ForeignKey("employees.employee_id"))
-    company_id = Column(Integer, ForeignKey("companies.company_id"))
+    company_id = Column(Integer, ForeignKey("companies.company_id"), index=True)
     date = Column(Date)
     shares_purchased = Column(Float)
     purchase_price_per_share = Column(Float)
@@ -89,18 +89,45 @@ class Investment(Base):
 class InvestmentRequest(Base):
     __tablename__ = "investment_requests"
     request_id = Column(Integer, primary_key=True, autoincrement=True)
-    client_id = Column(Integer, ForeignKey("clients.client_id"))
+    client_id = Column(Integer, ForeignKey("clients.client_id"), index=True)
     advisor_id = Column(Integer, ForeignKey("employees.employee_id"))
     company_id = Column(Integer, ForeignKey("companies.company_id"))
     shares = Column(Integer)
     purchase_price_per_share = Column(Float, nullable=True)
     status = Column(String, default="Pending")  # Pending, Approved, Rejected
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # dashboard ETags use this
 
     client = relationship("Client", back_populates="requests")
     advisor = relationship("Employee")
     company = relationship("Company")
 
+    # the employee dashboard lists an advisor's requests newest first
+    __table_args__ = (
+        Index("ix_investment_requests_advisor_created", "advisor_id", text("created_at DESC")),
+    )
+
+
+# -- create investment job (the worker turns an approved request into an investment, see job_queue.py)
+class InvestmentJob(Base):
+    __tablename__ = "investment_jobs"
+    job_id = Column(Integer, primary_key=True, autoincrement=True)
+    request_id = Column(Integer, ForeignKey("investment_requests.request_id"), unique=True, nullable=False)  # one job per request
+    status = Column(String, default="queued", nullable=False)  # queued, running, done, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    run_after = Column(DateTime, default=datetime.utcnow, nullable=False)  # later after a failed attempt
+    locked_by = Column(String, nullable=True)  # the worker running it
+    locked_at = Column(DateTime, nullable=True)
+    investment_id = Column(Integer, ForeignKey("investments.investment_id"), nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # workers look for queued jobs that are ready to run
+    __table_args__ = (
+        Index("ix_investment_jobs_claim", "status", "run_after"),
+    )
+
 
 # -- create company --
 class Company(Base):
@@ -117,6 +144,136 @@ class Company(Base):
     revenue = Column(Float)
     earnings_per_share = Column(Float)
     target_price = Column(Float)
+    current_price = Column(Float, nullable=True)  # latest price from the price feed
+    price_updated_at = Column(DateTime, nullable=True)
 
     # relationship to investments
-    investments = relationship("Investment", back_populates="company")
\ No newline at end of file
+    investments = relationship("Investment", back_populates="company")
+
+# -- key rotation checkpoint (see key_rotation.py) --
+# one row per key version we rotated to, so a stopped rotation carries on
+# after the last client it finished
+class KeyRotation(Base):
+    __tablename__ = "key_rotations"
+
+    to_version = Column(Integer, primary_key=True)
+    last_client_id = Column(Integer, default=0, nullable=False)
+    rows_rotated = Column(Integer, default=0, nullable=False)
+    rows_skipped = Column(Integer, default=0, nullable=False)  # already on the new key
+    started_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+# -- valuation history (written every time investments are revalued, see valuation_history.py) --
+# one row per investment per day (the last value of the day). On postgres the
+# table is split into a partition per month, so old months can just be dropped.
+# No foreign keys, the history stays even if an investment is removed.
+class InvestmentValuation(Base):
+    __tablename__ = "investment_valuations"
+
+    investment_id = Column(Integer, primary_key=True)
+    as_of = Column(Date, primary_key=True)
+    client_id = Column(Integer, nullable=False)
+    current_price = Column(Float)
+    market_value = Column(Float)
+
+    __table_args__ = (
+        Index("ix_investment_valuations_client_day", "client_id", "as_of"),
+        Index("ix_investment_valuations_as_of", "as_of"),
+        {"postgresql_partition_by": "RANGE (as_of)"},
+    )
+
+
+# rows outside every monthly partition land here instead of failing
+event.listen(
+    InvestmentValuation.__table__, "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS investment_valuations_default "
+        "PARTITION OF investment_valuations DEFAULT").execute_if(dialect="postgresql"),
+)
+
+
+# a client's value for each day, week and month (kept up to date as values come in),
+# so a chart of many years is one small range read
+class ClientValuation(Base):
+    __tablename__ = "client_valuations"
+
+    client_id = Column(Integer, ForeignKey("clients.client_id"), primary_key=True)
+    granularity = Column(String, primary_key=True)  # day, week or month
+    period_start = Column(Date, primary_key=True)
+    market_value = Column(Float, default=0)  # the latest value in the period
+    cost_basis = Column(Float, default=0)
+    high_value = Column(Float, default=0)
+    low_value = Column(Float, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+# -- audit log of the security checks (written in batches by audit_log.py) --
+class AuditEvent(Base):
+    __tablename__ = "audit_events"
+
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
+    occurred_at = Column(DateTime, nullable=False)
+    actor_type = Column(String, nullable=False)  # client, employee or manager
+    actor_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)  # view_investments, approve_request, export_reauth or export_book
+    client_id = Column(Integer, nullable=True)  # whose data it was (a book export's verified client, if any)
+    request_id = Column(Integer, nullable=True)
+    outcome = Column(String, nullable=False)  # granted, denied, completed, aborted, ...
+    remote_addr = Column(String, nullable=True)
+    row_count = Column(Integer, nullable=True)  # rows in a book export
+
+    # a client's access history, newest first
+    __table_args__ = (
+        Index("ix_audit_events_client_event", "client_id", "event_id"),
+    )
+
+
+# the audit log can only be added to, the database refuses updates and deletes
+for _dialect, _ddl in [
+    ("sqlite", [
+        "CREATE TRIGGER audit_events_no_update BEFORE UPDATE ON audit_events "
+        "BEGIN SELECT RAISE(ABORT, 'audit_events is append-only'); END",
+        "CREATE TRIGGER audit_events_no_delete BEFORE DELETE ON audit_events "
+        "BEGIN SELECT RAISE(ABORT, 'audit_events is append-only'); END",
+    ]),
+    ("postgresql", [
+        "CREATE OR REPLACE FUNCTION audit_events_append_only() RETURNS trigger AS $$ "
+        "BEGIN RAISE EXCEPTION 'audit_events is append-only'; END; $$ LANGUAGE plpgsql",
+        "CREATE TRIGGER audit_events_append_only BEFORE UPDATE OR DELETE OR TRUNCATE ON audit_events "
+        "FOR EACH STATEMENT EXECUTE FUNCTION audit_events_append_only()",
+    ]),
+]:
+    for _statement in _ddl:
+        event.listen(AuditEvent.__table__, "after_create", DDL(_statement).execute_if(dialect=_dialect))
+
+# -- running totals (assets under management) --
+# these are kept up to date by rollups.py every time investments are made or
+# revalued, so the dashboards can show totals without adding up every investment
+class ClientRollup(Base):
+    __tablename__ = "client_rollups"
+
+    client_id = Column(Integer, ForeignKey("clients.client_id"), primary_key=True)
+    position_count = Column(Integer, default=0)
+    cost_basis = Column(Float, default=0)
+    market_value = Column(Float, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class AdvisorRollup(Base):
+    __tablename__ = "advisor_rollups"
+
+    advisor_id = Column(Integer, ForeignKey("employees.employee_id"), primary_key=True)
+    position_count = Column(Integer, default=0)
+    cost_basis = Column(Float, default=0)
+    market_value = Column(Float, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ManagerRollup(Base):
+    __tablename__ = "manager_rollups"
+
+    manager_id = Column(Integer, ForeignKey("employees.employee_id"), primary_key=True)
+    position_count = Column(Integer, default=0)
+    cost_basis = Column(Float, default=0)
+    market_value = Column(Float, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,146 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - page_cache.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This page_cache.py file stops the client and employee dashboards from
+    being rebuilt when nothing on them changed! Before building a page we run
+    one small query for a "version" of what the page shows (the totals'
+    updated_at, how many investments / requests / clients there are and when
+    the requests last changed). The version becomes the page's ETag and
+    Last-Modified, so when the browser already has that version it just gets
+    a 304 back and the big queries and the template are skipped.
+
+    Pages are also kept in memory for a few seconds (PAGE_CACHE_TTL, 0 turns
+    it off) for each user and verified client, and only reused while the
+    version still matches, so a cached page is never out of date.
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import timezone
+from flask import request, make_response
+from sqlalchemy import select, func
+from models import Client, Investment, InvestmentRequest, ClientRollup, AdvisorRollup
+
+PAGE_CACHE_TTL = float(os.environ.get("PAGE_CACHE_TTL", "30"))  # seconds
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", "1000"))  # pages kept at most
+
+# etag is the hash of everything in the version, last_modified the newest time in it
+PageVersion = namedtuple("PageVersion", ["etag", "last_modified"])
+
+
+# -- versions (one query each) --
+def _scalar(stmt):
+    return stmt.scalar_subquery()
+
+
+def _page_version(db, kind, key, *parts):
+    values = db.execute(select(*parts)).one()
+    stamp = repr((kind, key) + tuple(values))
+    times = [value for value in values if hasattr(value, "tzinfo")]
+    last_modified = max(times).replace(tzinfo=timezone.utc, microsecond=0) if times else None
+    return PageVersion(hashlib.sha1(stamp.encode("utf-8")).hexdigest(), last_modified)
+
+
+def client_page_version(db, client_id):
+    # totals, investments and requests of one client
+    return _page_version(
+        db, "client", client_id,
+        _scalar(select(ClientRollup.updated_at).where(ClientRollup.client_id == client_id)),
+        _scalar(select(ClientRollup.position_count).where(ClientRollup.client_id == client_id)),
+        _scalar(select(func.count()).select_from(Investment).where(Investment.client_id == client_id)),
+        _scalar(select(func.count()).select_from(InvestmentRequest).where(InvestmentRequest.client_id == client_id)),
+        _scalar(select(func.max(InvestmentRequest.updated_at)).where(InvestmentRequest.client_id == client_id)),
+    )
+
+
+def advisor_page_version(db, advisor_id, verified_client_id=None):
+    # totals of the whole book, the clients and the request queue of one advisor
+    return _page_version(
+        db, "advisor", (advisor_id, verified_client_id),
+        _scalar(select(AdvisorRollup.updated_at).where(AdvisorRollup.advisor_id == advisor_id)),
+        _scalar(select(AdvisorRollup.position_count).where(AdvisorRollup.advisor_id == advisor_id)),
+        _scalar(select(func.count()).select_from(Client).where(Client.advisor_id == advisor_id)),
+        _scalar(select(func.max(Client.client_id)).where(Client.advisor_id == advisor_id)),
+        _scalar(select(func.count()).select_from(InvestmentRequest).where(InvestmentRequest.advisor_id == advisor_id)),
+        _scalar(select(func.max(InvestmentRequest.updated_at)).where(InvestmentRequest.advisor_id == advisor_id)),
+    )
+
+
+# -- rendered pages --
+class PageCache:
+    def __init__(self, ttl=PAGE_CACHE_TTL, size=PAGE_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()  # key -> (etag, body, stored at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, etag):
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None or entry[0] != etag or time.monotonic() - entry[2] >= self.ttl:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, etag, body):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._pages[key] = (etag, body, time.monotonic())
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+page_cache = PageCache()
+
+
+def _not_modified(version):
+    # If-None-Match wins when the browser sends both
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(version.etag)
+    if version.last_modified and request.if_modified_since:
+        return version.last_modified <= request.if_modified_since
+    return False
+
+
+def conditional_page(key, version, render):
+    '''
+        Sends 304 if the browser has this version already, otherwise the
+        cached page for key if it is still this version, otherwise whatever
+        render() gives back. key should name the page, the user and anything
+        else in the session that changes the page (like the verified client).
+    '''
+    if _not_modified(version):
+        response = make_response("", 304)
+    else:
+        body = page_cache.get(key, version.etag)
+        if body is None:
+            response = make_response(render())
+            if response.status_code != 200:
+                return response
+            page_cache.put(key, version.etag, response.get_data())
+        else:
+            response = make_response(body)
+
+    response.set_etag(version.etag, weak=True)
+    if version.last_modified:
+        response.last_modified = version.last_modified
+    # the browser keeps it, but has to check with us before every use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,225 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - price_feed.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This price_feed.py file gets stock prices into our system! It reads price
+    "ticks" (a company_id and a price, plus an optional timestamp) one line at a
+    time from a file or a socket, either as csv or as JSON lines:
+
+        company_id,price,timestamp          {"company_id": 101, "price": 52.3, "ts": 1700000000.5}
+        101,52.30,1700000000.5
+
+    A company can tick many times a second, so ticks are gathered over a short
+    window and only the last price for each company is kept. Then we update just
+    those companies and their open investments (exit_date IS NULL).
+
+    python price_feed.py ticks.csv --window 1.0
+    python price_feed.py --socket localhost:9009 --window 0.5
+'''
+import argparse
+import json
+import socket
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import update, bindparam
+from database import SessionLocal
+from models import Company
+from revaluation import revalue_all, known_prices
+
+Tick = namedtuple("Tick", ["company_id", "price", "ts"])
+
+DEFAULT_WINDOW = 1.0  # seconds
+
+
+# -- reading ticks --
+def parse_tick(line):
+    '''
+        Turns one line into a Tick, or None if it is blank / a header / broken.
+        Ticks without a timestamp get the time they were read.
+    '''
+    line = line.strip()
+    if not line or line.startswith("company_id"):
+        return None
+    try:
+        if line.startswith("{"):
+            data = json.loads(line)
+            company_id, price, ts = data["company_id"], data["price"], data.get("ts")
+        else:
+            parts = line.split(",")
+            company_id, price = parts[0], parts[1]
+            ts = parts[2] if len(parts) > 2 and parts[2] else None
+        return Tick(int(company_id), float(price), float(ts) if ts is not None else time.time())
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def read_lines(source, idle_timeout):
+    '''
+        Gives back lines from a file path, "-" (stdin) or "host:port" socket.
+        On a socket, None is given back whenever nothing came in for
+        idle_timeout seconds so the current window can still be flushed.
+    '''
+    if isinstance(source, tuple):
+        with socket.create_connection(source) as conn:
+            conn.settimeout(idle_timeout)
+            buffer = b""
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except socket.timeout:
+                    yield None
+                    continue
+                if not data:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    yield line.decode("utf-8", "replace")
+            if buffer:
+                yield buffer.decode("utf-8", "replace")
+    elif source == "-":
+        yield from sys.stdin
+    else:
+        with open(source) as f:
+            yield from f
+
+
+# -- metrics --
+class FeedMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.ticks_read = 0
+        self.ticks_bad = 0
+        self.ticks_unknown = 0
+        self.ticks_applied = 0
+        self.windows = 0
+        self.companies_updated = 0
+        self.investments_updated = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def record_window(self, ticks, result, applied_at):
+        # lag is from the oldest tick in the window to when it was committed
+        lag = max(0.0, applied_at - min(tick.ts for tick in ticks))
+        self.windows += 1
+        self.ticks_applied += result["companies"]
+        self.ticks_unknown += len(ticks) - result["companies"]
+        self.companies_updated += result["companies"]
+        self.investments_updated += result["updated"]
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "ticks_read": self.ticks_read,
+            "ticks_bad": self.ticks_bad,
+            "ticks_unknown": self.ticks_unknown,
+            "ticks_applied": self.ticks_applied,
+            "windows": self.windows,
+            "companies_updated": self.companies_updated,
+            "investments_updated": self.investments_updated,
+            "ticks_per_sec": self.ticks_read / elapsed if elapsed else 0.0,
+            "avg_lag_sec": self.total_lag / self.windows if self.windows else 0.0,
+            "max_lag_sec": self.max_lag,
+            "last_lag_sec": self.last_lag,
+        }
+
+
+# -- applying prices --
+def apply_prices(db, ticks):
+    '''
+        Writes the latest price for each company in ticks, then revalues only
+        the open investments in those companies. Ticks for companies we don't
+        have are skipped.
+    '''
+    prices = known_prices(db, {tick.company_id: tick.price for tick in ticks})
+    if not prices:
+        return {"scanned": 0, "updated": 0, "seconds": 0.0, "rows_per_sec": 0.0, "client_deltas": {}, "companies": 0}
+
+    companies = Company.__table__
+    stmt = (
+        update(companies)
+        .where(companies.c.company_id == bindparam("tick_company_id"))
+        .values(current_price=bindparam("tick_price"), price_updated_at=bindparam("tick_time"))
+    )
+    now = datetime.utcnow()
+    db.execute(stmt, [
+        {"tick_company_id": company_id, "tick_price": price, "tick_time": now}
+        for company_id, price in prices.items()
+    ])
+    db.commit()
+
+    result = revalue_all(db, prices, company_ids=prices.keys())
+    result["companies"] = len(prices)
+    return result
+
+
+# -- the pipeline --
+def run_feed(db, lines, window=DEFAULT_WINDOW, metrics=None, on_window=None):
+    '''
+        Reads ticks from lines and applies them once per window. Only the last
+        tick of each company in a window is kept.
+    '''
+    metrics = metrics or FeedMetrics()
+    pending = {}
+    window_started = None
+
+    def flush():
+        ticks = list(pending.values())
+        pending.clear()
+        result = apply_prices(db, ticks)
+        metrics.record_window(ticks, result, time.time())
+        if on_window:
+            on_window(metrics, result)
+
+    for line in lines:
+        if line is not None:
+            tick = parse_tick(line)
+            if tick is None:
+                if line.strip() and not line.startswith("company_id"):
+                    metrics.ticks_bad += 1
+            else:
+                metrics.ticks_read += 1
+                pending[tick.company_id] = tick
+                if window_started is None:
+                    window_started = time.monotonic()
+
+        if pending and time.monotonic() - window_started >= window:
+            flush()
+            window_started = None
+
+    if pending:
+        flush()
+    return metrics
+
+
+def _print_window(metrics, result):
+    stats = metrics.summary()
+    print(f"window {stats['windows']}: {result['updated']:,} investments revalued, "
+          f"{stats['ticks_per_sec']:,.0f} ticks/sec, lag {stats['last_lag_sec'] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load price ticks into companies and investments")
+    parser.add_argument("source", nargs="?", default="-", help="csv / json lines file, or - for stdin")
+    parser.add_argument("--socket", help="host:port to read ticks from instead of a file")
+    parser.add_argument("--window", type=float, default=DEFAULT_WINDOW, help="seconds to gather ticks for")
+    args = parser.parse_args()
+
+    source = args.source
+    if args.socket:
+        host, port = args.socket.rsplit(":", 1)
+        source = (host, int(port))
+
+    db = SessionLocal()
+    try:
+        metrics = run_feed(db, read_lines(source, args.window), args.window, on_window=_print_window)
+    finally:
+        db.close()
+    print(json.dumps(metrics.summary(), indent=2))
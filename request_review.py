@@ -0,0 +1,95 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - request_review.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This request_review.py file approves or denies many investment requests at
+    once! Doing them one at a time means a lookup, a commit and a dashboard
+    reload for every request. Here an advisor sends a list of request ids and
+    we check them all with one query, change their status with one UPDATE and
+    queue the investments for the approved ones with one bulk INSERT (worker.py
+    makes them), all in the caller's transaction (so it is all or nothing).
+    Every request id gets its own result back.
+'''
+from sqlalchemy import select, update
+from models import InvestmentRequest
+from job_queue import enqueue, APPROVABLE
+
+# the most requests one call can review
+MAX_BULK_REVIEW = 500
+
+# statuses an advisor can still approve or deny
+REVIEWABLE = APPROVABLE
+
+_NEW_STATUS = {"approve": "Approved", "deny": "Rejected"}
+
+
+def review_requests(db, advisor_id, request_ids, action):
+    '''
+        action is "approve" or "deny". Only the advisor's own requests that are
+        still Pending (or AdvisorCreated) are changed. This doesn't commit.
+        Returns {request_id: result} where result has a "result" of
+        approved / denied / not_found / not_allowed / already_<status> /
+        changed_by_someone_else. Results are in the same order as request_ids.
+    '''
+    if action not in _NEW_STATUS:
+        raise ValueError(f"action must be approve or deny, not {action!r}")
+    request_ids = list(dict.fromkeys(request_ids))
+    if len(request_ids) > MAX_BULK_REVIEW:
+        raise ValueError(f"Can't review more than {MAX_BULK_REVIEW} requests at once")
+
+    # every request in one query
+    found = {
+        req.request_id: req
+        for req in db.execute(
+            select(InvestmentRequest.request_id, InvestmentRequest.advisor_id, InvestmentRequest.status)
+            .where(InvestmentRequest.request_id.in_(request_ids))
+        )
+    }
+
+    results = {}
+    candidates = []
+    for request_id in request_ids:
+        req = found.get(request_id)
+        if req is None:
+            results[request_id] = {"result": "not_found"}
+        elif req.advisor_id != advisor_id:
+            results[request_id] = {"result": "not_allowed"}
+        elif req.status not in REVIEWABLE:
+            results[request_id] = {"result": "already_" + (req.status or "unknown").lower()}
+        else:
+            candidates.append(request_id)
+    if not candidates:
+        return {request_id: results[request_id] for request_id in request_ids}
+
+    # one UPDATE, and only for rows nobody else changed since we looked
+    stmt = (
+        update(InvestmentRequest)
+        .where(
+            InvestmentRequest.request_id.in_(candidates),
+            InvestmentRequest.advisor_id == advisor_id,
+            InvestmentRequest.status.in_(REVIEWABLE),
+        )
+        .values(status=_NEW_STATUS[action])
+        .execution_options(synchronize_session=False)
+    )
+    if db.get_bind().dialect.update_returning:
+        changed = set(db.scalars(stmt.returning(InvestmentRequest.request_id)))
+    else:
+        db.execute(stmt)
+        changed = set(candidates)
+
+    for request_id in candidates:
+        if request_id not in changed:
+            results[request_id] = {"result": "changed_by_someone_else"}
+        elif action == "deny":
+            results[request_id] = {"result": "denied"}
+
+    if action == "approve":
+        # the worker makes the investments (see job_queue.py), one bulk insert of jobs here
+        approved = [request_id for request_id in candidates if request_id in changed]
+        enqueue(db, approved)
+        for request_id in approved:
+            results[request_id] = {"result": "approved"}
+
+    return {request_id: results[request_id] for request_id in request_ids}
@@ -0,0 +1,198 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - revaluation.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This revaluation.py file re-prices everyone's investments! The market value
+    and gain/loss of an investment used to be worked out once when the data was
+    made and then never again. Here we read the open investments in big
+    batches of plain columns, do the math for a whole batch at once with numpy
+    using a price for each company, and only write back the rows that changed
+    with one bulk UPDATE per batch.
+
+    python revaluation.py                       (uses each company's current price,
+                                                 or its target price if it has none)
+    python revaluation.py --prices prices.csv   (csv with company_id,price)
+'''
+import argparse
+import csv
+import time
+from sqlalchemy import select, update, func
+from database import SessionLocal
+from models import Investment, Company
+from rollups import record_revaluation
+from valuation_history import record_valuations, record_client_values
+
+REVALUE_BATCH = 50000
+
+_COLUMNS = [
+    Investment.investment_id,
+    Investment.client_id,
+    Investment.company_id,
+    Investment.shares_purchased,
+    Investment.purchase_price_per_share,
+    Investment.current_price,
+    Investment.market_value,
+    Investment.gain_loss_percent,
+]
+
+
+# -- one position (for when we make a single investment) --
+def value_position(shares, purchase_price, current_price):
+    market_value = round((shares or 0) * (current_price or 0), 2)
+    if purchase_price:
+        gain_loss_percent = round((current_price - purchase_price) / purchase_price * 100, 2)
+    else:
+        gain_loss_percent = 0.0
+    return market_value, gain_loss_percent
+
+
+# -- prices --
+def price_vector(prices):
+    '''
+        Turns {company_id: price} into a numpy array where prices[company_id]
+        is the price, and NaN means we don't have a price for that company.
+    '''
+    import numpy as np  # only the batch code needs numpy, the web app just uses value_position
+
+    size = max(prices, default=0) + 1
+    vector = np.full(size, np.nan)
+    for company_id, price in prices.items():
+        if price is not None:
+            vector[company_id] = price
+    return vector
+
+
+def known_prices(db, prices):
+    # only companies we actually have, so a bad company_id can't make price_vector huge
+    known = set(db.scalars(select(Company.company_id)))
+    return {company_id: price for company_id, price in prices.items() if company_id in known}
+
+
+def load_current_prices(db):
+    # the latest feed price, or the target price for companies with no feed yet
+    price = func.coalesce(Company.current_price, Company.target_price)
+    return dict(db.execute(select(Company.company_id, price)).all())
+
+
+def load_price_file(path):
+    with open(path, newline="") as f:
+        return {int(row["company_id"]): float(row["price"]) for row in csv.DictReader(f)}
+
+
+# -- revalue one batch --
+def revalue_batch(rows, prices):
+    '''
+        rows is a list of tuples in _COLUMNS order. Returns the bulk UPDATE
+        parameters for the rows that changed, and the change in market value
+        for each client (used to keep totals up to date).
+    '''
+    import numpy as np
+
+    data = np.array(rows, dtype=float)  # None turns into NaN
+    ids = data[:, 0].astype(np.int64)
+    client_ids = data[:, 1]
+    company_ids = data[:, 2]
+    shares, purchase, old_price, old_value, old_gain = data[:, 3], data[:, 4], data[:, 5], data[:, 6], data[:, 7]
+
+    # look up every row's price in one go (unknown company -> NaN)
+    known = ~np.isnan(company_ids) & (company_ids < len(prices))
+    new_price = np.full(len(rows), np.nan)
+    new_price[known] = prices[company_ids[known].astype(np.int64)]
+    has_price = ~np.isnan(new_price)
+
+    new_value = np.round(np.nan_to_num(shares) * new_price, 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        new_gain = np.where(purchase > 0, np.round((new_price - purchase) / purchase * 100, 2), 0.0)
+
+    # NaN never equals anything, so rows that had no value yet count as changed
+    changed = has_price & ~(
+        (old_price == new_price) & (old_value == new_value) & (old_gain == new_gain)
+    )
+
+    params = [
+        {"investment_id": int(i), "current_price": float(p), "market_value": float(v), "gain_loss_percent": float(g)}
+        for i, p, v, g in zip(ids[changed], new_price[changed], new_value[changed], new_gain[changed])
+    ]
+
+    value_delta = new_value[changed] - np.nan_to_num(old_value[changed])
+    client_deltas = {}
+    for client_id, delta in zip(client_ids[changed], value_delta):
+        if not np.isnan(client_id):
+            client_deltas[int(client_id)] = client_deltas.get(int(client_id), 0.0) + float(delta)
+    return params, client_deltas
+
+
+# -- revalue everything --
+def revalue_all(db, prices, batch_size=REVALUE_BATCH, company_ids=None):
+    '''
+        Revalues every open investment (no exit_date) against prices, which is
+        {company_id: price}. Each batch is committed on its own. company_ids
+        limits it to the investments in just those companies.
+    '''
+    vector = price_vector(known_prices(db, prices))
+    started = time.perf_counter()
+    scanned = updated = 0
+    client_deltas = {}
+    revalued_clients = set()
+    last_id = 0
+
+    query = select(*_COLUMNS).where(Investment.exit_date.is_(None))
+    if company_ids is not None:
+        query = query.where(Investment.company_id.in_(list(company_ids)))
+
+    while True:
+        rows = db.execute(
+            query.where(Investment.investment_id > last_id)
+            .order_by(Investment.investment_id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        scanned += len(rows)
+
+        params, deltas = revalue_batch(rows, vector)
+        if params:
+            db.execute(update(Investment), params)
+            updated += len(params)
+            # and today's point in the valuation history of every changed row
+            client_of = {row[0]: row[1] for row in rows}
+            changed = [dict(p, client_id=client_of[p["investment_id"]]) for p in params]
+            record_valuations(db, changed, client_values=False)
+            revalued_clients.update(inv["client_id"] for inv in changed)
+        for client_id, delta in deltas.items():
+            client_deltas[client_id] = client_deltas.get(client_id, 0.0) + delta
+        # the totals change in the same transaction as the investments
+        record_revaluation(db, deltas)
+        db.commit()
+
+    # a client's investments can be in many batches, so their history point
+    # is only written once all of them have their new value
+    record_client_values(db, revalued_clients)
+    db.commit()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "scanned": scanned,
+        "updated": updated,
+        "seconds": elapsed,
+        "rows_per_sec": scanned / elapsed if elapsed else 0.0,
+        "client_deltas": client_deltas,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Revalue every open investment")
+    parser.add_argument("--prices", help="csv file with company_id,price columns (default: current prices)")
+    parser.add_argument("--batch-size", type=int, default=REVALUE_BATCH)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        prices = load_price_file(args.prices) if args.prices else load_current_prices(db)
+        result = revalue_all(db, prices, args.batch_size)
+    finally:
+        db.close()
+    print(f"Revalued {result['scanned']:,} investments, {result['updated']:,} changed, "
+          f"in {result['seconds']:.2f}s ({result['rows_per_sec']:,.0f} rows/sec)")
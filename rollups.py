@@ -0,0 +1,237 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - rollups.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This rollups.py file keeps the running totals for every client, advisor
+    and manager (how many open investments, what they cost, and what they are
+    worth now). Instead of adding up every investment each time a dashboard
+    loads, whenever an investment is made or revalued we just add the change
+    to the totals. The totals only count open investments (no exit_date), and
+    a client's totals count towards their current advisor and that advisor's
+    manager.
+
+    python rollups.py rebuild   (throws the totals away and adds them up again)
+    python rollups.py check     (compares the totals with the real investments)
+'''
+import sys
+from datetime import datetime
+from sqlalchemy import select, func, delete, insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+from database import SessionLocal
+from models import Client, Employee, Investment, ClientRollup, AdvisorRollup, ManagerRollup
+
+# how far apart (in dollars) totals can be before check calls them wrong
+CHECK_TOLERANCE = 0.01
+
+_ROLLUPS = [
+    (ClientRollup, ClientRollup.client_id),
+    (AdvisorRollup, AdvisorRollup.advisor_id),
+    (ManagerRollup, ManagerRollup.manager_id),
+]
+
+
+# -- adding changes to the totals --
+def _upsert(db, model, key_column, rows):
+    '''
+        Adds each row's numbers onto the stored totals, making the total row
+        first if it isn't there yet. Postgres and sqlite do it in one statement.
+    '''
+    if not rows:
+        return
+    table = model.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = dialect_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[key_column.name],
+            set_={
+                "position_count": table.c.position_count + stmt.excluded.position_count,
+                "cost_basis": table.c.cost_basis + stmt.excluded.cost_basis,
+                "market_value": table.c.market_value + stmt.excluded.market_value,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        db.execute(stmt, rows)
+        return
+
+    # any other database: try the update, insert if nothing was there
+    for row in rows:
+        result = db.execute(
+            update(table)
+            .where(table.c[key_column.name] == row[key_column.name])
+            .values(
+                position_count=table.c.position_count + row["position_count"],
+                cost_basis=table.c.cost_basis + row["cost_basis"],
+                market_value=table.c.market_value + row["market_value"],
+                updated_at=row["updated_at"],
+            )
+        )
+        if result.rowcount == 0:
+            db.execute(insert(table).values(**row))
+
+
+def apply_deltas(db, deltas):
+    '''
+        deltas is {client_id: (positions, cost_basis, market_value)} with the
+        CHANGE for each client. Adds it to the client, advisor and manager
+        totals. This doesn't commit, so it goes in the same transaction as
+        whatever changed the investments.
+    '''
+    deltas = {cid: d for cid, d in deltas.items() if any(d)}
+    if not deltas:
+        return
+
+    # who is each client's advisor and manager (one query)
+    owners = db.execute(
+        select(Client.client_id, Client.advisor_id, Employee.manager_id)
+        .outerjoin(Employee, Employee.employee_id == Client.advisor_id)
+        .where(Client.client_id.in_(list(deltas)))
+    ).all()
+
+    now = datetime.utcnow()
+    per_client, per_advisor, per_manager = {}, {}, {}
+    for client_id, advisor_id, manager_id in owners:
+        change = deltas[client_id]
+        for totals, key in ((per_client, client_id), (per_advisor, advisor_id), (per_manager, manager_id)):
+            if key is None:
+                continue
+            current = totals.get(key, (0, 0.0, 0.0))
+            totals[key] = tuple(a + b for a, b in zip(current, change))
+
+    for (model, key_column), totals in zip(_ROLLUPS, (per_client, per_advisor, per_manager)):
+        _upsert(db, model, key_column, [
+            {key_column.name: key, "position_count": count, "cost_basis": cost,
+             "market_value": value, "updated_at": now}
+            for key, (count, cost, value) in totals.items()
+        ])
+
+
+def investment_delta(investment):
+    # what one new open investment adds to its client's totals
+    cost = (investment.shares_purchased or 0) * (investment.purchase_price_per_share or 0)
+    return (1, cost, investment.market_value or 0)
+
+
+def record_new_investments(db, investments):
+    deltas = {}
+    for investment in investments:
+        if investment.exit_date is not None:
+            continue
+        current = deltas.get(investment.client_id, (0, 0.0, 0.0))
+        deltas[investment.client_id] = tuple(a + b for a, b in zip(current, investment_delta(investment)))
+    apply_deltas(db, deltas)
+
+
+def record_revaluation(db, client_value_deltas):
+    # revaluing only changes what things are worth, not the count or cost
+    apply_deltas(db, {cid: (0, 0.0, value) for cid, value in client_value_deltas.items()})
+
+
+# -- reading the totals --
+def get_rollup(db, model, key):
+    return db.get(model, key)
+
+
+def get_rollups(db, model, keys):
+    key_column = dict(_ROLLUPS)[model]
+    return {getattr(r, key_column.key): r for r in db.query(model).filter(key_column.in_(list(keys)))}
+
+
+# -- full rebuild and consistency check --
+def _true_totals():
+    '''
+        The real totals, added up from the investments. Returns one select per
+        rollup table with columns (key, position_count, cost_basis, market_value).
+    '''
+    per_client = (
+        select(
+            Investment.client_id.label("client_id"),
+            func.count().label("position_count"),
+            func.coalesce(func.sum(Investment.shares_purchased * Investment.purchase_price_per_share), 0).label("cost_basis"),
+            func.coalesce(func.sum(Investment.market_value), 0).label("market_value"),
+        )
+        .where(Investment.exit_date.is_(None), Investment.client_id.isnot(None))
+        .group_by(Investment.client_id)
+        .subquery()
+    )
+    client_totals = select(per_client)
+
+    with_owner = (
+        select(per_client, Client.advisor_id, Employee.manager_id)
+        .join(Client, Client.client_id == per_client.c.client_id)
+        .outerjoin(Employee, Employee.employee_id == Client.advisor_id)
+        .subquery()
+    )
+
+    def grouped(key):
+        return (
+            select(
+                with_owner.c[key],
+                func.sum(with_owner.c.position_count),
+                func.sum(with_owner.c.cost_basis),
+                func.sum(with_owner.c.market_value),
+            )
+            .where(with_owner.c[key].isnot(None))
+            .group_by(with_owner.c[key])
+        )
+
+    return [client_totals, grouped("advisor_id"), grouped("manager_id")]
+
+
+def rebuild(db):
+    now = datetime.utcnow()
+    counts = {}
+    for (model, key_column), totals in zip(_ROLLUPS, _true_totals()):
+        db.execute(delete(model))
+        rows = [
+            {key_column.name: key, "position_count": count, "cost_basis": cost,
+             "market_value": value, "updated_at": now}
+            for key, count, cost, value in db.execute(totals)
+        ]
+        if rows:
+            db.execute(insert(model), rows)
+        counts[model.__tablename__] = len(rows)
+    db.commit()
+    return counts
+
+
+def check(db, tolerance=CHECK_TOLERANCE):
+    '''
+        Compares every stored total with the real one. Returns a list of
+        (table, key, stored, actual) for every total that is off.
+    '''
+    problems = []
+    for (model, key_column), totals in zip(_ROLLUPS, _true_totals()):
+        actual = {row[0]: tuple(row[1:]) for row in db.execute(totals)}
+        stored = {
+            row[0]: tuple(row[1:])
+            for row in db.execute(select(key_column, model.position_count, model.cost_basis, model.market_value))
+        }
+        for key in set(actual) | set(stored):
+            want = actual.get(key, (0, 0.0, 0.0))
+            have = stored.get(key, (0, 0.0, 0.0))
+            if want[0] != have[0] or any(abs((a or 0) - (b or 0)) > tolerance for a, b in zip(want[1:], have[1:])):
+                problems.append((model.__tablename__, key, have, want))
+    return problems
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    db = SessionLocal()
+    try:
+        if command == "rebuild":
+            for table, count in rebuild(db).items():
+                print(f"{table}: {count:,} rows")
+        elif command == "check":
+            problems = check(db)
+            for table, key, have, want in problems[:50]:
+                print(f"{table} #{key}: stored {have}, actual {want}")
+            print(f"{len(problems)} totals are off" if problems else "All totals match")
+            sys.exit(1 if problems else 0)
+        else:
+            print("usage: python rollups.py [rebuild|check]")
+            sys.exit(2)
+    finally:
+        db.close()
@@ -1,55 +1,213 @@
 import os
 import base64
+import re
+import hashlib
+import hmac as std_hmac
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
-# Try SECRET_KEY first
-_MASTER_B64 = os.environ.get("SECRET_KEY")
+# the keys are only worked out the first time an SSN is encrypted or hashed,
+# so importing this file (and app.py) doesn't read or generate SECRET_KEY
+#
+# key versions: SECRET_KEY is version 1, SECRET_KEY_V2, SECRET_KEY_V3, ... are
+# newer ones. New SSNs use SSN_KEY_VERSION (the newest key if not set), older
+# ones stay readable until key_rotation.py has moved them to the new key.
+# Version 1 ciphertext is plain base64 like it always was, later versions
+# start with "v<version>:" (base64 never has a ":" in it).
+_Keys = namedtuple("_Keys", ["version", "master", "enc_key", "hmac_key", "cipher", "hmac_base"])
+_Keyring = namedtuple("_Keyring", ["current", "versions"])  # current _Keys, {version: _Keys}
+_keys_lock = threading.Lock()
+_keys = None
+_VERSION_ENV = re.compile(r"^SECRET_KEY_V(\d+)$")
 
-# If no key is set, generate one automatically
-if not _MASTER_B64:
-    print("⚠️ SECRET_KEY not found. Generating a temporary key automatically.")
-    _MASTER_B64 = base64.b64encode(os.urandom(32)).decode("ascii")
-    os.environ["SECRET_KEY"] = _MASTER_B64  # set in environment for this session
 
-# Decode base64
-try:
-    MASTER = base64.b64decode(_MASTER_B64)
-except Exception as e:
-    raise RuntimeError("Failed to base64-decode the key env var.") from e
+def _decode_master(name, master_b64):
+    # Decode base64
+    try:
+        master = base64.b64decode(master_b64)
+    except Exception as e:
+        raise RuntimeError(f"Failed to base64-decode {name}.") from e
 
-if len(MASTER) < 32:
-    raise RuntimeError(
-        f"Key too short: need >= 32 bytes after base64 decode, got {len(MASTER)}."
-    )
+    if len(master) < 32:
+        raise RuntimeError(
+            f"{name} too short: need >= 32 bytes after base64 decode, got {len(master)}."
+        )
+    return master
+
+def _load_master():
+    # Try SECRET_KEY first
+    master_b64 = os.environ.get("SECRET_KEY")
+
+    # If no key is set, generate one automatically
+    if not master_b64:
+        print("⚠️ SECRET_KEY not found. Generating a temporary key automatically.")
+        master_b64 = base64.b64encode(os.urandom(32)).decode("ascii")
+        os.environ["SECRET_KEY"] = master_b64  # set in environment for this session
 
-def _derive_keys(master: bytes):
+    return _decode_master("SECRET_KEY", master_b64)
+
+def _derive_keys(master: bytes, version=1):
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
         length=64,
         salt=None,
-        info=b"ssn-storage-v1"
+        info=f"ssn-storage-v{version}".encode("ascii")
     )
     out = hkdf.derive(master)
     return out[:32], out[32:]  # enc_key, hmac_key
 
-ENC_KEY, HMAC_KEY = _derive_keys(MASTER)
+def _make_keys(version, master):
+    enc_key, hmac_key = _derive_keys(master, version)
+    # the cipher and the keyed HMAC only depend on the keys, so build them once
+    return _Keys(version, master, enc_key, hmac_key, AESGCM(enc_key),
+                 std_hmac.new(hmac_key, digestmod=hashlib.sha256))
+
+def _load_keyring():
+    versions = {1: _make_keys(1, _load_master())}
+    for name, value in os.environ.items():
+        match = _VERSION_ENV.match(name)
+        if match and value and int(match.group(1)) > 1:
+            version = int(match.group(1))
+            versions[version] = _make_keys(version, _decode_master(name, value))
+
+    current = int(os.environ.get("SSN_KEY_VERSION") or max(versions))
+    if current not in versions:
+        raise RuntimeError(f"SSN_KEY_VERSION is {current} but there is no key for it.")
+    return _Keyring(versions[current], versions)
+
+def _get_keyring():
+    global _keys
+    if _keys is None:
+        with _keys_lock:
+            if _keys is None:
+                _keys = _load_keyring()
+    return _keys
+
+def _get_keys(version=None):
+    # the current key, or the key of one version
+    keyring = _get_keyring()
+    if version is None:
+        return keyring.current
+    try:
+        return keyring.versions[version]
+    except KeyError:
+        raise RuntimeError(f"No key for SSN key version {version} (set SECRET_KEY_V{version}).") from None
+
+def current_key_version() -> int:
+    return _get_keyring().current.version
+
+def key_versions() -> list:
+    # every version we have a key for, the current one first
+    keyring = _get_keyring()
+    return [keyring.current.version] + sorted(v for v in keyring.versions if v != keyring.current.version)
+
+def __getattr__(name):
+    # snn_key.MASTER / ENC_KEY / HMAC_KEY still work, they just load the keys
+    if name == "MASTER":
+        return _get_keys().master
+    if name == "ENC_KEY":
+        return _get_keys().enc_key
+    if name == "HMAC_KEY":
+        return _get_keys().hmac_key
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# -- the version written in front of the ciphertext --
+def _with_version(version, b64_payload):
+    return b64_payload if version == 1 else f"v{version}:{b64_payload}"
+
+def _split_version(b64_payload):
+    head, sep, rest = b64_payload.partition(":")
+    return (int(head[1:]), rest) if sep else (1, b64_payload)
+
+def payload_key_version(b64_payload: str) -> int:
+    return _split_version(b64_payload)[0]
+
+# batches bigger than this get split over worker processes (if asked for)
+PARALLEL_MIN_BATCH = 200000
+PARALLEL_CHUNK = 5000
 
 def encrypt_ssn(plain_ssn: str) -> str:
-    aes = AESGCM(ENC_KEY)
+    keys = _get_keys()
     nonce = os.urandom(12)
-    ct = aes.encrypt(nonce, plain_ssn.encode("utf-8"), None)
-    return base64.b64encode(nonce + ct).decode("ascii")
+    ct = keys.cipher.encrypt(nonce, plain_ssn.encode("utf-8"), None)
+    return _with_version(keys.version, base64.b64encode(nonce + ct).decode("ascii"))
 
 def decrypt_ssn(b64_payload: str) -> str:
+    version, b64_payload = _split_version(b64_payload)
     raw = base64.b64decode(b64_payload)
     nonce, ct = raw[:12], raw[12:]
-    aes = AESGCM(ENC_KEY)
-    pt = aes.decrypt(nonce, ct, None)
+    pt = _get_keys(version).cipher.decrypt(nonce, ct, None)
     return pt.decode("utf-8")
 
-def ssn_hash(plain_ssn: str) -> str:
-    h = hmac.HMAC(HMAC_KEY, hashes.SHA256())
+def ssn_hash(plain_ssn: str, version=None) -> str:
+    # same HMAC-SHA256 as before, copying the keyed state skips re-keying
+    h = _get_keys(version).hmac_base.copy()
     h.update(plain_ssn.encode("utf-8"))
-    return h.finalize().hex()
+    return h.hexdigest()
+
+def ssn_hash_all_versions(plain_ssn: str) -> list:
+    # the blind index under every key we have (for lookups while a rotation is running)
+    return [ssn_hash(plain_ssn, version) for version in key_versions()]
+
+# -- batch versions (take any iterable, give back a list in the same order) --
+def _encrypt_chunk(values, version=None):
+    keys = _get_keys(version)
+    encrypt = keys.cipher.encrypt
+    b64 = base64.b64encode
+    prefix = _with_version(keys.version, "")
+    # one big urandom call gives the nonces for the whole chunk
+    nonces = os.urandom(12 * len(values))
+    out = []
+    for i, value in enumerate(values):
+        nonce = nonces[12 * i:12 * i + 12]
+        out.append(prefix + b64(nonce + encrypt(nonce, value.encode("utf-8"), None)).decode("ascii"))
+    return out
+
+def _decrypt_chunk(payloads):
+    versions = _get_keyring().versions
+    b64decode = base64.b64decode
+    out = []
+    for payload in payloads:
+        version, payload = _split_version(payload)
+        keys = versions.get(version) or _get_keys(version)  # _get_keys says which key is missing
+        raw = b64decode(payload)
+        out.append(keys.cipher.decrypt(raw[:12], raw[12:], None).decode("utf-8"))
+    return out
+
+def _hash_chunk(values, version=None):
+    copy = _get_keys(version).hmac_base.copy
+    out = []
+    for value in values:
+        h = copy()
+        h.update(value.encode("utf-8"))
+        out.append(h.hexdigest())
+    return out
+
+def _run_batch(fn, values, processes, version=None):
+    values = list(values)
+    if version is not None:
+        fn = partial(fn, version=version)
+    if not processes or processes < 2 or len(values) < PARALLEL_MIN_BATCH:
+        return fn(values)
+    # load (or generate) the key here so every worker process uses the same one
+    _get_keyring()
+    chunks = [values[i:i + PARALLEL_CHUNK] for i in range(0, len(values), PARALLEL_CHUNK)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        out = []
+        for part in pool.map(fn, chunks):
+            out.extend(part)
+        return out
+
+def encrypt_ssn_many(plain_ssns, processes=None, version=None) -> list:
+    return _run_batch(_encrypt_chunk, plain_ssns, processes, version)
+
+def decrypt_ssn_many(b64_payloads, processes=None) -> list:
+    return _run_batch(_decrypt_chunk, b64_payloads, processes)
+
+def ssn_hash_many(plain_ssns, processes=None, version=None) -> list:
+    return _run_batch(_hash_chunk, plain_ssns, processes, version)
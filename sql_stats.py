@@ -0,0 +1,195 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - sql_stats.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This sql_stats.py file keeps track of the SQL each web request runs! For
+    every request we count the queries, add up the time spent in the database,
+    remember the slowest statements and flag "N+1" patterns (the same
+    statement run over and over with different values, like a query inside a
+    for loop). The numbers go in the response headers and are added up at
+    /internal/sql_stats (app.py). The headers are sent before a streamed
+    response (like /export/book) runs its queries, so they only count what
+    ran before it started; the totals wait until all of it was sent, so they
+    count everything. Only a sample of requests is tracked if
+    SQL_STATS_SAMPLE_RATE is below 1, and only statements slower than
+    SQL_SLOW_MS get logged.
+'''
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SAMPLE_RATE = float(os.environ.get("SQL_STATS_SAMPLE_RATE", "1.0"))
+SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "100"))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("SQL_N_PLUS_ONE_THRESHOLD", "5"))
+TOP_STATEMENTS = 10
+
+logger = logging.getLogger("sql_stats")
+
+# stats for the request being handled right now (None = not sampled)
+_current = ContextVar("sql_request_stats", default=None)
+
+
+# -- one request --
+class RequestStats:
+    def __init__(self):
+        self.query_count = 0
+        self.total_time = 0.0
+        self.statements = {}  # statement -> [count, total time, set of parameter sets]
+        self.slowest = []  # heap of (seconds, statement)
+
+    def record(self, statement, parameters, elapsed):
+        self.query_count += 1
+        self.total_time += elapsed
+        entry = self.statements.setdefault(statement, [0, 0.0, set()])
+        entry[0] += 1
+        entry[1] += elapsed
+        if len(entry[2]) <= N_PLUS_ONE_THRESHOLD:
+            entry[2].add(repr(parameters))
+
+        item = (elapsed, statement)
+        if len(self.slowest) < TOP_STATEMENTS:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def n_plus_one(self):
+        # the same statement, lots of times, with different values each time
+        return [
+            (statement, count)
+            for statement, (count, _, params) in self.statements.items()
+            if count >= N_PLUS_ONE_THRESHOLD and len(params) > 1
+        ]
+
+
+# -- everything since the server started --
+class SqlStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.endpoints = {}  # endpoint -> [requests, queries, seconds]
+            self.slowest = []
+            self.n_plus_one = {}  # (endpoint, statement) -> times seen
+
+    def add(self, endpoint, stats):
+        with self._lock:
+            self.requests += 1
+            totals = self.endpoints.setdefault(endpoint, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += stats.query_count
+            totals[2] += stats.total_time
+            for elapsed, statement in stats.slowest:
+                item = (elapsed, endpoint, statement)
+                if len(self.slowest) < TOP_STATEMENTS:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heappushpop(self.slowest, item)
+            for statement, _ in stats.n_plus_one():
+                key = (endpoint, statement)
+                self.n_plus_one[key] = self.n_plus_one.get(key, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return {
+                "sampled_requests": self.requests,
+                "sample_rate": SAMPLE_RATE,
+                "endpoints": {
+                    endpoint: {
+                        "requests": n,
+                        "avg_queries": round(queries / n, 2),
+                        "avg_db_ms": round(seconds / n * 1000, 3),
+                    }
+                    for endpoint, (n, queries, seconds) in sorted(self.endpoints.items())
+                },
+                "slowest_statements": [
+                    {"ms": round(elapsed * 1000, 3), "endpoint": endpoint, "statement": statement}
+                    for elapsed, endpoint, statement in sorted(self.slowest, reverse=True)
+                ],
+                "n_plus_one": [
+                    {"endpoint": endpoint, "statement": statement, "requests": count}
+                    for (endpoint, statement), count in sorted(self.n_plus_one.items(), key=lambda i: -i[1])
+                ],
+            }
+
+
+sql_stats = SqlStats()
+
+
+# -- hooking into the engines and the app --
+# listening on the Engine class covers the engine database.py makes later on,
+# so instrumenting doesn't force the engine (or a connection) to exist
+_instrumented = False
+_instrument_lock = threading.Lock()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None or not conn.info.get("query_start"):
+        return
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats.record(statement, parameters, elapsed)
+    if elapsed * 1000 >= SLOW_MS:
+        logger.warning("slow query (%.1f ms): %s", elapsed * 1000, statement)
+
+
+def instrument_engines():
+    global _instrumented
+    with _instrument_lock:
+        if not _instrumented:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            _instrumented = True
+
+
+def _finish_request_stats(endpoint, token):
+    stats = _current.get()
+    if stats is not None:
+        sql_stats.add(endpoint, stats)
+    _current.reset(token)
+
+
+def init_app(app):
+    instrument_engines()
+
+    @app.before_request
+    def _start_request_stats():
+        if SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE:
+            request.sql_stats_token = _current.set(RequestStats())
+
+    @app.after_request
+    def _add_stats_headers(response):
+        stats = _current.get()
+        if stats is not None:
+            response.headers["X-DB-Query-Count"] = str(stats.query_count)
+            response.headers["X-DB-Time-Ms"] = f"{stats.total_time * 1000:.3f}"
+            response.headers["X-DB-N-Plus-One"] = str(len(stats.n_plus_one()))
+            # a streamed response runs its queries after this, so it is added
+            # up once the server has sent all of it
+            token = request.__dict__.pop("sql_stats_token", None) if response.is_streamed else None
+            if token is not None:
+                endpoint = request.endpoint or "unknown"
+                response.call_on_close(lambda: _finish_request_stats(endpoint, token))
+        return response
+
+    @app.teardown_request
+    def _end_request_stats(exception=None):
+        # streamed responses (stream_with_context) tear the request down twice
+        token = request.__dict__.pop("sql_stats_token", None)
+        if token is not None:
+            _finish_request_stats(request.endpoint or "unknown", token)
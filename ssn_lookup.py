@@ -0,0 +1,81 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - ssn_lookup.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This ssn_lookup.py file finds clients by their SSN without ever decrypting
+    anything! The SSNs are stored encrypted, but every client also has an
+    ssn_hash (a keyed HMAC from snn_key.py, also called a "blind index"). We
+    hash the SSNs we are looking for the same way and look the hashes up in
+    the unique ssn_hash column, so even thousands of SSNs only take one query.
+    While key_rotation.py is moving clients to a new key some hashes are still
+    made with the old key, so we look for the hash under every key we have.
+'''
+from sqlalchemy import select
+from models import Client
+from snn_key import ssn_hash_all_versions, ssn_hash_many, key_versions
+
+# how many hashes go into one IN (...) query (keeps us under parameter limits)
+LOOKUP_CHUNK = 10000
+
+
+def _chunked(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+# -- single lookup --
+def find_client_by_ssn(db, plain_ssn):
+    return db.query(Client).filter(Client.ssn_hash.in_(ssn_hash_all_versions(plain_ssn))).one_or_none()
+
+
+# -- bulk lookup --
+def find_client_ids_by_ssns(db, plain_ssns):
+    '''
+        Checks a list of SSNs against the clients table. Returns a dict of
+        SSN -> client_id for every SSN that already belongs to a client.
+    '''
+    plain_ssns = list(dict.fromkeys(plain_ssns))
+    by_hash = {}
+    for version in key_versions():
+        by_hash.update(zip(ssn_hash_many(plain_ssns, version=version), plain_ssns))
+
+    found = {}
+    for hashes in _chunked(list(by_hash), LOOKUP_CHUNK):
+        rows = db.execute(select(Client.ssn_hash, Client.client_id).where(Client.ssn_hash.in_(hashes)))
+        for hashed, client_id in rows:
+            found[by_hash[hashed]] = client_id
+    return found
+
+
+def existing_ssn_hashes(db, hashes):
+    # which of these blind index values are already in the clients table
+    hashes = list(set(hashes))
+    existing = set()
+    for chunk in _chunked(hashes, LOOKUP_CHUNK):
+        existing.update(db.scalars(select(Client.ssn_hash).where(Client.ssn_hash.in_(chunk))))
+    return existing
+
+
+# -- duplicate check before a bulk insert --
+def split_duplicate_ssns(db, rows, seen=None):
+    '''
+        Splits client rows (dicts with an "ssn_hash") into the ones that are
+        safe to insert and the ones whose SSN is already in the table or shows
+        up earlier in the same batch. One duplicate would otherwise make the
+        unique ssn_hash column reject the whole bulk insert.
+        seen is an optional set of hashes that are taken but not inserted yet.
+    '''
+    existing = existing_ssn_hashes(db, [row["ssn_hash"] for row in rows])
+    if seen is not None:
+        existing |= seen
+    unique, duplicates = [], []
+    for row in rows:
+        if row["ssn_hash"] in existing:
+            duplicates.append(row)
+        else:
+            existing.add(row["ssn_hash"])
+            unique.append(row)
+    if seen is not None:
+        seen.update(row["ssn_hash"] for row in unique)
+    return unique, duplicates
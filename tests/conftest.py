@@ -0,0 +1,19 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - tests/conftest.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Points the app at a throwaway sqlite file before anything connects (the
+    engine is only made on first use, see database.py), so the tests never
+    touch the real database!
+'''
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="finance-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+os.environ.setdefault("SECRET_KEY", "dGVzdC1rZXktdGVzdC1rZXktdGVzdC1rZXktdGVzdC1rZXk=")
+
+# the modules live in the folder above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
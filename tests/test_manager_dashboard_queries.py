@@ -0,0 +1,106 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - tests/test_manager_dashboard_queries.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Makes sure the manager dashboard takes the same number of queries no
+    matter how big the manager's team is (see loaders.load_manager_hierarchy)!
+
+    python -m pytest tests
+'''
+from contextlib import contextmanager
+import pytest
+from sqlalchemy import event, insert, func, select
+from database import init_db, get_engine, SessionLocal
+from models import Employee, Client, Investment, Company
+from rollups import rebuild as rebuild_rollups
+from app import create_app
+
+MANAGER_ID = 1
+VERIFIED_CLIENT_ID = 1
+
+
+@contextmanager
+def count_queries():
+    counts = {"queries": 0}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counts["queries"] += 1
+
+    engine = get_engine()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counts
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def grow_team(advisors, clients_per_advisor):
+    # adds advisors under the manager, each with their clients (the first client gets investments)
+    db = SessionLocal()
+    try:
+        next_employee = db.scalar(select(func.coalesce(func.max(Employee.employee_id), 0))) + 1
+        next_client = db.scalar(select(func.coalesce(func.max(Client.client_id), 0))) + 1
+        if next_employee == 1:
+            db.execute(insert(Employee), [{"employee_id": MANAGER_ID, "first_name": "Mia", "last_name": "Manager",
+                                           "work_email": "manager@example.com", "job_title": "Manager"}])
+            db.execute(insert(Company), [{"company_id": i, "company_name": f"Company {i}", "target_price": 10.0}
+                                         for i in range(1, 4)])
+            next_employee += 1
+
+        employees, clients, investments = [], [], []
+        for employee_id in range(next_employee, next_employee + advisors):
+            employees.append({"employee_id": employee_id, "first_name": "Ada", "last_name": f"Advisor{employee_id}",
+                              "work_email": f"advisor{employee_id}@example.com", "job_title": "Financial Advisor",
+                              "manager_id": MANAGER_ID})
+            for _ in range(clients_per_advisor):
+                clients.append({"client_id": next_client, "first_name": "Cal", "last_name": f"Client{next_client}",
+                                "encrypted_ssn": f"ssn-{next_client}", "ssn_hash": f"hash-{next_client}",
+                                "email": f"client{next_client}@example.com", "advisor_id": employee_id})
+                if next_client == VERIFIED_CLIENT_ID:
+                    investments += [{"client_id": next_client, "advisor_id": employee_id, "company_id": i,
+                                     "shares_purchased": 10, "purchase_price_per_share": 9.0, "current_price": 10.0,
+                                     "market_value": 100.0, "gain_loss_percent": 11.11} for i in range(1, 4)]
+                next_client += 1
+        db.execute(insert(Employee), employees)
+        db.execute(insert(Client), clients)
+        if investments:
+            db.execute(insert(Investment), investments)
+        rebuild_rollups(db)
+        db.commit()
+    finally:
+        db.close()
+
+
+@pytest.fixture(scope="module")
+def manager_client():
+    init_db()
+    app = create_app()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_type"] = "manager"
+        session["user_id"] = MANAGER_ID
+        session["verified_client_id"] = VERIFIED_CLIENT_ID
+    return client
+
+
+def dashboard_queries(client):
+    client.get("/manager_dashboard")  # warms the company catalog
+    with count_queries() as counts:
+        response = client.get("/manager_dashboard")
+    assert response.status_code == 200
+    return counts["queries"], response
+
+
+def test_query_count_does_not_grow_with_the_team(manager_client):
+    grow_team(advisors=2, clients_per_advisor=3)
+    small, response = dashboard_queries(manager_client)
+    assert b"Company 1" in response.data  # the verified client's investments are there
+
+    grow_team(advisors=40, clients_per_advisor=50)
+    big, response = dashboard_queries(manager_client)
+
+    assert big == small, (small, big)
+    # the manager, a page of employees, their first clients, the verified
+    # client's investments, the team totals and the employees' totals
+    assert small <= 6, small
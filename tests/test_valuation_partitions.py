@@ -0,0 +1,52 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - tests/test_valuation_partitions.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    Makes sure ensure_partition only remembers a month's partition once it was
+    committed, so a rolled back CREATE TABLE gets made again (see
+    valuation_history.py)!
+
+    python -m pytest tests
+'''
+from datetime import date
+import pytest
+from sqlalchemy import text
+from database import init_db, SessionLocal
+import valuation_history
+
+DAY = date(2024, 3, 15)
+
+
+@pytest.fixture
+def created(monkeypatch):
+    # pretend to be postgres and write down every partition that gets made
+    init_db()
+    made = []
+
+    def create_partition(db, month):
+        db.execute(text("SELECT 1"))  # starts the transaction like the CREATE TABLE would
+        made.append(month)
+
+    monkeypatch.setattr(valuation_history, "_is_postgres", lambda db: True)
+    monkeypatch.setattr(valuation_history, "_create_partition", create_partition)
+    monkeypatch.setattr(valuation_history, "_partitions", set())
+    return made
+
+
+def test_rolled_back_partition_is_made_again(created):
+    db = SessionLocal()
+    try:
+        valuation_history.ensure_partition(db, DAY)
+        valuation_history.ensure_partition(db, DAY)
+        assert created == [date(2024, 3, 1)]
+        db.rollback()
+
+        valuation_history.ensure_partition(db, DAY)
+        assert created == [date(2024, 3, 1), date(2024, 3, 1)]
+        db.commit()
+
+        valuation_history.ensure_partition(db, DAY)
+        assert len(created) == 2
+    finally:
+        db.close()
@@ -0,0 +1,343 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - valuation_history.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This valuation_history.py file remembers what investments and clients were
+    worth over time! An investment only stores its latest price and value, so
+    every time investments are revalued (revaluation.py, the price feed) or
+    made (job_queue.py) we also write, in bulk:
+
+      investment_valuations   the value of each changed investment for today
+                              (one row per investment per day, the day's last value)
+      client_valuations       each of those clients' totals for today, this week
+                              and this month (latest, highest and lowest value),
+                              so charts never have to add up investments
+
+    On postgres investment_valuations is partitioned by month, which keeps the
+    indexes small and lets prune() drop whole months at once. sqlite has no
+    partitions, so there it is a range DELETE on the as_of index instead.
+
+    python valuation_history.py snapshot                 (records today's values of everything)
+    python valuation_history.py show --client 12 --start 2024-01-01
+    python valuation_history.py prune --before 2023-01-01
+'''
+import argparse
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from sqlalchemy import select, delete, update, insert, case, text, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Investment, InvestmentValuation, ClientValuation, ClientRollup
+
+GRANULARITIES = ("day", "week", "month")
+
+# how many clients / investments go into one statement
+HISTORY_CHUNK = 10000
+
+# one point of a client's chart
+ValuationPoint = namedtuple("ValuationPoint", ["period_start", "market_value", "cost_basis", "high_value", "low_value"])
+
+
+def period_start(day, granularity):
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())  # weeks start on monday
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+
+def _chunked(values, size=HISTORY_CHUNK):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _dialect_insert(db):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    return None
+
+
+# -- monthly partitions (postgres) --
+_partitions = set()  # months whose partition was committed in this process
+
+
+def _next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def _is_postgres(db):
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def _create_partition(db, month):
+    db.execute(text(
+        f"CREATE TABLE IF NOT EXISTS investment_valuations_{month:%Y_%m} PARTITION OF investment_valuations "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+    ))
+
+
+def ensure_partition(db, day):
+    '''
+        Makes the investment_valuations partition for day's month if it isn't
+        there yet. Does nothing on other databases. The CREATE TABLE is part
+        of db's transaction, so the month is only remembered once it commits
+        (a rollback takes the partition away again).
+    '''
+    if not _is_postgres(db):
+        return
+    month = day.replace(day=1)
+    pending = db.info.setdefault("pending_partitions", set())
+    if month in _partitions or month in pending:
+        return
+    _create_partition(db, month)
+    pending.add(month)
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_partitions(db):
+    _partitions.update(db.info.pop("pending_partitions", ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_partitions(db):
+    db.info.pop("pending_partitions", None)
+
+
+# -- writing history --
+def _upsert_investment_values(db, rows):
+    dialect_insert = _dialect_insert(db)
+    if dialect_insert is not None:
+        stmt = dialect_insert(InvestmentValuation)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["investment_id", "as_of"],
+            set_={"current_price": stmt.excluded.current_price, "market_value": stmt.excluded.market_value,
+                  "client_id": stmt.excluded.client_id},
+        )
+        db.execute(stmt, rows)
+        return
+
+    # any other database: try the update, insert if nothing was there
+    for row in rows:
+        result = db.execute(
+            update(InvestmentValuation)
+            .where(InvestmentValuation.investment_id == row["investment_id"], InvestmentValuation.as_of == row["as_of"])
+            .values(current_price=row["current_price"], market_value=row["market_value"])
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            db.execute(insert(InvestmentValuation), [row])
+
+
+def _upsert_client_values(db, rows):
+    table = ClientValuation.__table__
+    dialect_insert = _dialect_insert(db)
+    if dialect_insert is not None:
+        stmt = dialect_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["client_id", "granularity", "period_start"],
+            set_={
+                "market_value": stmt.excluded.market_value,
+                "cost_basis": stmt.excluded.cost_basis,
+                "high_value": case((stmt.excluded.high_value > table.c.high_value, stmt.excluded.high_value),
+                                   else_=table.c.high_value),
+                "low_value": case((stmt.excluded.low_value < table.c.low_value, stmt.excluded.low_value),
+                                  else_=table.c.low_value),
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        db.execute(stmt, rows)
+        return
+
+    for row in rows:
+        current = db.execute(
+            select(table.c.high_value, table.c.low_value).where(
+                table.c.client_id == row["client_id"], table.c.granularity == row["granularity"],
+                table.c.period_start == row["period_start"])
+        ).first()
+        if current is None:
+            db.execute(insert(table), [row])
+        else:
+            db.execute(
+                update(table)
+                .where(table.c.client_id == row["client_id"], table.c.granularity == row["granularity"],
+                       table.c.period_start == row["period_start"])
+                .values(market_value=row["market_value"], cost_basis=row["cost_basis"],
+                        high_value=max(current.high_value, row["high_value"]),
+                        low_value=min(current.low_value, row["low_value"]), updated_at=row["updated_at"])
+            )
+
+
+def record_client_values(db, client_ids, day=None):
+    '''
+        Copies the clients' current totals (client_rollups) into today's,
+        this week's and this month's client_valuations rows. Call it after
+        the totals were updated, in the same transaction.
+    '''
+    day = day or date.today()
+    now = datetime.utcnow()
+    for chunk in _chunked(sorted(set(client_ids) - {None})):
+        totals = db.execute(
+            select(ClientRollup.client_id, ClientRollup.market_value, ClientRollup.cost_basis)
+            .where(ClientRollup.client_id.in_(chunk))
+        ).all()
+        rows = []
+        for client_id, market_value, cost_basis in totals:
+            market_value, cost_basis = round(market_value or 0.0, 2), round(cost_basis or 0.0, 2)
+            for granularity in GRANULARITIES:
+                rows.append({
+                    "client_id": client_id, "granularity": granularity, "period_start": period_start(day, granularity),
+                    "market_value": market_value, "cost_basis": cost_basis,
+                    "high_value": market_value, "low_value": market_value, "updated_at": now,
+                })
+        if rows:
+            _upsert_client_values(db, rows)
+
+
+def record_valuations(db, investments, day=None, client_values=True):
+    '''
+        investments is a list of dicts with investment_id, client_id,
+        current_price and market_value (what they are worth now). Writes
+        their history for today and their clients' totals. This doesn't commit.
+        Pass client_values=False when the clients' totals are still changing
+        (call record_client_values once they are done).
+    '''
+    day = day or date.today()
+    rows = [
+        {"investment_id": inv["investment_id"], "as_of": day, "client_id": inv["client_id"],
+         "current_price": inv["current_price"], "market_value": inv["market_value"]}
+        for inv in investments if inv["client_id"] is not None
+    ]
+    if not rows:
+        return
+    ensure_partition(db, day)
+    for chunk in _chunked(rows):
+        _upsert_investment_values(db, chunk)
+    if client_values:
+        record_client_values(db, [row["client_id"] for row in rows], day)
+
+
+# -- reading history --
+def pick_granularity(start, end):
+    # about a hundred to a few hundred points whatever the range
+    days = (end - start).days
+    if days <= 180:
+        return "day"
+    if days <= 3 * 365:
+        return "week"
+    return "month"
+
+
+def client_history(db, client_id, start, end, granularity=None):
+    '''
+        A client's value from start to end (dates) in one query, oldest first.
+        Returns (granularity, [ValuationPoint]), picking the granularity from
+        the length of the range when it isn't given.
+    '''
+    granularity = granularity or pick_granularity(start, end)
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}, not {granularity!r}")
+    rows = db.execute(
+        select(ClientValuation.period_start, ClientValuation.market_value, ClientValuation.cost_basis,
+               ClientValuation.high_value, ClientValuation.low_value)
+        .where(ClientValuation.client_id == client_id,
+               ClientValuation.granularity == granularity,
+               ClientValuation.period_start >= period_start(start, granularity),
+               ClientValuation.period_start <= end)
+        .order_by(ClientValuation.period_start)
+    ).all()
+    return granularity, [ValuationPoint(*row) for row in rows]
+
+
+# -- whole table jobs --
+def snapshot(db, batch_size=HISTORY_CHUNK, day=None):
+    '''
+        Records today's value of every open investment (and every client's
+        totals), a batch at a time. Good for starting the history off.
+    '''
+    day = day or date.today()
+    last_id = 0
+    count = 0
+    while True:
+        rows = db.execute(
+            select(Investment.investment_id, Investment.client_id, Investment.current_price, Investment.market_value)
+            .where(Investment.exit_date.is_(None), Investment.investment_id > last_id)
+            .order_by(Investment.investment_id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].investment_id
+        record_valuations(db, [row._asdict() for row in rows], day)
+        db.commit()
+        count += len(rows)
+    return count
+
+
+def _old_partitions(db, before):
+    # monthly partitions that end on or before the cutoff
+    names = db.scalars(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'investment_valuations'"
+    ))
+    old = []
+    for name in names:
+        suffix = name.rsplit("_", 2)[-2:]
+        if len(suffix) == 2 and all(part.isdigit() for part in suffix):
+            month = date(int(suffix[0]), int(suffix[1]), 1)
+            if _next_month(month) <= before:
+                old.append((name, month))
+    return old
+
+
+def prune(db, before):
+    '''
+        Throws away the investment history and the daily client values from
+        before the given date (weekly and monthly client values are kept).
+    '''
+    if db.get_bind().dialect.name == "postgresql":
+        # whole months go by dropping their partition, the rest is deleted
+        for name, month in _old_partitions(db, before):
+            db.execute(text(f"DROP TABLE {name}"))
+            _partitions.discard(month)
+    db.execute(delete(InvestmentValuation).where(InvestmentValuation.as_of < before))
+    db.execute(delete(ClientValuation).where(ClientValuation.granularity == "day",
+                                             ClientValuation.period_start < before))
+    db.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Investment and client valuation history")
+    parser.add_argument("command", choices=["snapshot", "show", "prune"])
+    parser.add_argument("--client", type=int, help="client_id to show")
+    parser.add_argument("--start", type=date.fromisoformat, help="first day (default: a year ago)")
+    parser.add_argument("--end", type=date.fromisoformat, help="last day (default: today)")
+    parser.add_argument("--granularity", choices=GRANULARITIES)
+    parser.add_argument("--before", type=date.fromisoformat, help="prune everything before this day")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "snapshot":
+            print(f"Recorded {snapshot(db):,} investments")
+        elif args.command == "show":
+            if args.client is None:
+                parser.error("show needs --client")
+            end = args.end or date.today()
+            granularity, points = client_history(db, args.client, args.start or end - timedelta(days=365),
+                                                 end, args.granularity)
+            print(f"{len(points)} points ({granularity})")
+            for point in points:
+                print(f"  {point.period_start}  value {point.market_value:14,.2f}  cost {point.cost_basis:14,.2f}"
+                      f"  high {point.high_value:14,.2f}  low {point.low_value:14,.2f}")
+        else:
+            if args.before is None:
+                parser.error("prune needs --before")
+            prune(db, args.before)
+            print(f"Removed history before {args.before}")
+    finally:
+        db.close()
@@ -0,0 +1,91 @@
+'''
+    CSCI - 622 - Data Security & Privacy
+    Project Phase 4 - worker.py
+    Authors: Samuel Roberts (svr9047) & Lianna Pottgen (lrp2755)
+
+    This worker.py file runs the investment job queue from job_queue.py! Each
+    worker process takes a few jobs at a time, makes their investments and
+    goes back for more, sleeping for a moment when there is nothing to do.
+    Start more processes (here or on other machines) to get through more jobs.
+
+    python worker.py                        (runs until stopped with Ctrl+C)
+    python worker.py --processes 4 --batch 20
+    python worker.py --once                 (does every job that is ready, then stops)
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from database import SessionLocal
+from job_queue import claim_jobs, run_job, queue_stats
+
+DEFAULT_BATCH = 10
+DEFAULT_POLL = 1.0  # seconds to sleep when the queue is empty
+
+_stopping = False
+
+
+def _stop(signum, frame):
+    # finish the jobs we already took, then stop
+    global _stopping
+    _stopping = True
+
+
+def work(worker_number=0, batch=DEFAULT_BATCH, poll=DEFAULT_POLL, once=False):
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{worker_number}"
+    # put the old handler back at the end so a process pool can still stop us
+    previous_handler = signal.signal(signal.SIGTERM, _stop)
+    counts = {"done": 0, "retry": 0, "failed": 0, "lost": 0}
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        while not _stopping:
+            job_ids = claim_jobs(db, worker_id, batch)
+            if not job_ids:
+                if once:
+                    break
+                time.sleep(poll)
+                continue
+            for job_id in job_ids:
+                outcome = run_job(db, job_id, worker_id)
+                counts[outcome] += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+        signal.signal(signal.SIGTERM, previous_handler)
+    counts["seconds"] = time.perf_counter() - started
+    return counts
+
+
+def _work(args):
+    return work(*args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make the investments for approved requests")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to run")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="jobs a worker takes at a time")
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL, help="seconds to wait when there is nothing to do")
+    parser.add_argument("--once", action="store_true", help="stop when no job is ready instead of waiting")
+    args = parser.parse_args()
+
+    specs = [(n, args.batch, args.poll, args.once) for n in range(args.processes)]
+    if args.processes > 1:
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(_work, specs)
+    else:
+        results = [_work(specs[0])]
+
+    total = {key: sum(r[key] for r in results) for key in ("done", "retry", "failed", "lost")}
+    seconds = max(r["seconds"] for r in results)
+    total["jobs_per_sec"] = round(total["done"] / seconds, 2) if seconds else 0.0
+    db = SessionLocal()
+    try:
+        total["queue"] = queue_stats(db)
+    finally:
+        db.close()
+    print(json.dumps(total, indent=2))